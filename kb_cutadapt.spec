@@ -11,17 +11,80 @@ module kb_cutadapt {
 
     /* unfortunately, we have to name the fields uniquely between
     3' and 5' options due to the current implementation of grouped
-    parameters */
+    parameters.
+
+        adapter_sequences_5P / adapter_sequences_3P - more adapters of
+            the same end, e.g. for pooled libraries.
+        adapter_fasta_5P / adapter_fasta_3P - more adapters as FASTA text.
+        All the adapters of an end are searched for in the same cutadapt
+        pass, and the best matching one is trimmed from each read.
+        anchored_5P / anchored_3P apply to each of them. */
     typedef structure {
         string adapter_sequence_5P;
+        list<string> adapter_sequences_5P;
+        string adapter_fasta_5P;
         boolean anchored_5P;
     } FivePrimeOptions;
 
     typedef structure {
         string adapter_sequence_3P;
+        list<string> adapter_sequences_3P;
+        string adapter_fasta_3P;
         boolean anchored_3P;
     } ThreePrimeOptions;
 
+    /*
+        cores - number of cores cutadapt may use per library.  0 or unset
+            uses the deploy.cfg default, which in turn defaults to the
+            container's cgroup CPU quota / affinity mask.
+        stream_input - stream the stored reads from Shock into cutadapt
+            instead of downloading them to scratch first.  Libraries that
+            can't be streamed are downloaded as usual.
+        compressed_input - copy the stored read files from Shock to scratch
+            as they are, gzip, bzip2 or xz compressed, for cutadapt to
+            decompress as it reads them, instead of having ReadsUtils
+            download them uncompressed.  Paired-end files stored separately
+            are trimmed separately.  Unset uses the deploy.cfg default.
+        split_paired_end - download paired-end libraries as separate
+            forward and reverse files and trim them as such, instead of
+            having ReadsUtils interleave them first.
+        max_parallel_libraries - number of ReadsSet or RNASeqSampleSet
+            members trimmed at once.  0 or unset uses the deploy.cfg
+            default.  Unless cores is set, the available cores are
+            shared out between the libraries running at once.
+        pipeline_libraries - for sets, download the next libraries and
+            upload the previous ones while the current ones are trimmed,
+            keeping at most the deploy.cfg max-staged-libraries on
+            scratch.  Unset uses the deploy.cfg default.
+        output_compression - none, gzip or zstd: compress the trimmed reads
+            as cutadapt writes them, on the cores given to the library.
+            gzip output is uploaded without being compressed again.  Unset
+            uses the deploy.cfg default.
+        output_compression_level - 1-9 for gzip, 1-19 for zstd.  Unset uses
+            the deploy.cfg default, or else 6 for gzip and 3 for zstd.
+        auto_detect - look for known adapters (Illumina TruSeq, Nextera
+            and small RNA, poly-A, poly-G) in the first reads of the
+            library and trim the best supported one of each end that
+            five_prime or three_prime leave unset.  The report lists the
+            reads supporting each adapter.  The reads are downloaded to
+            scratch even if stream_input is set.
+        no_indels - allow mismatches but no insertions or deletions in
+            adapter matches.  Unset turns it on only where cutadapt can
+            then index several anchored 5' adapters (cutadapt 2.0 and
+            later).
+        quality_cutoff_3P / quality_cutoff_5P - trim bases of lower
+            quality from the 3' / 5' end of the reads before removing the
+            adapters.
+        quality_base - 33 (the default) or 64, the quality encoding.
+        nextseq_trim - 3' quality cutoff for two-colour chemistry
+            (NextSeq, NovaSeq), which also trims the poly-G of dark cycles.
+        max_n - discard reads with more N bases than this, or with a
+            greater fraction of Ns if below 1.
+        max_read_length - discard reads longer than this after trimming.
+        trim_poly_a - trim poly-A tails from the 3' end of the reads (and
+            poly-T heads from the 5' end of second reads of pairs).
+        All of these run in the same cutadapt pass as adapter removal.
+    */
     typedef structure {
         string output_workspace;
         string output_object_name;
@@ -35,6 +98,24 @@ module kb_cutadapt {
         int min_overlap_length;
 	int min_read_length;
 	boolean discard_untrimmed;
+
+        int cores;
+        boolean stream_input;
+        boolean compressed_input;
+        boolean split_paired_end;
+        int max_parallel_libraries;
+        boolean pipeline_libraries;
+        string output_compression;
+        int output_compression_level;
+        boolean auto_detect;
+        boolean no_indels;
+        int quality_cutoff_3P;
+        int quality_cutoff_5P;
+        int quality_base;
+        int nextseq_trim;
+        float max_n;
+        int max_read_length;
+        boolean trim_poly_a;
     } RemoveAdaptersParams;
 
     typedef structure {
@@ -49,6 +130,22 @@ module kb_cutadapt {
 
         float error_tolerance;
         int min_overlap_length;
+
+        int cores;
+        boolean stream_input;
+        boolean compressed_input;
+        boolean split_paired_end;
+        string output_compression;
+        int output_compression_level;
+        boolean auto_detect;
+        boolean no_indels;
+        int quality_cutoff_3P;
+        int quality_cutoff_5P;
+        int quality_base;
+        int nextseq_trim;
+        float max_n;
+        int max_read_length;
+        boolean trim_poly_a;
     } exec_RemoveAdaptersParams;
 
 
@@ -57,9 +154,37 @@ module kb_cutadapt {
         string output_reads_ref;
     } RemoveAdaptersResult;
 
+    /*
+        Counts parsed from the cutadapt report.  For paired-end libraries
+        the read counts are read pairs, except reads_with_adapters which
+        adds up read 1 and read 2.  adapter_matches maps each adapter
+        sequence to the number of reads it was trimmed from.
+    */
+    typedef structure {
+        int reads_in;
+        int reads_with_adapters;
+        int reads_too_short;
+        int reads_too_long;
+        int reads_too_many_n;
+        int reads_written;
+        int bp_in;
+        int bp_quality_trimmed;
+        int bp_out;
+        mapping<string, int> adapter_matches;
+    } CutadaptStats;
+
+    /*
+        stats - summed over all libraries when the input is a set
+        cache_hits, cache_misses - number of libraries whose trimmed reads
+            were / were not reused from the result cache.  Both are 0 when
+            the cache is turned off.
+    */
     typedef structure {
         string report;
         string output_reads_ref;
+        CutadaptStats stats;
+        int cache_hits;
+        int cache_misses;
     } exec_RemoveAdaptersResult;
 
     /*
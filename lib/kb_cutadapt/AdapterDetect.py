@@ -0,0 +1,146 @@
+import os
+import bz2
+import gzip
+import time
+from array import array
+
+
+# adapters looked for by auto-detection: (name, sequence, end), where end is
+# 3 for adapters read into at the end of reads (cutadapt -a) and 5 for those
+# at the start (cutadapt -g)
+KNOWN_ADAPTERS = [
+    ('Illumina TruSeq', 'AGATCGGAAGAGC', 3),
+    ('Illumina Nextera', 'CTGTCTCTTATACACATCT', 3),
+    ('Illumina small RNA 3\'', 'TGGAATTCTCGGGTGCCAAGG', 3),
+    ('poly-A', 'AAAAAAAAAAAAAAAAAAAA', 3),
+    ('poly-G (two-color chemistry)', 'GGGGGGGGGGGGGGGGGGGG', 3),
+    ('Illumina small RNA 5\'', 'GTTCAGAGTTCTACAGTCCGACGATC', 5),
+    ('Illumina TruSeq 5\'', 'ACACTCTTTCCCTACACGACGCTCTTCCGATCT', 5),
+]
+
+# bases of each adapter looked for, as in Trim Galore: long enough that a
+# match by chance is rare, short enough to be found when the read ends early
+KMER_LENGTH = 12
+
+# a 5' adapter has to end within this many bases of the start of the read
+FIVE_PRIME_WINDOW = 40
+
+
+def _open(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.bz2'):
+        return bz2.BZ2File(path, 'rb')
+    return open(path, 'rb')
+
+
+def can_sample(path):
+    """Whether reads can be sampled from path without using them up, i.e. it's a file cutadapt reads more than once."""
+    # a FIFO can only be read once, and python 2 has no lzma module for xz
+    return path is not None and os.path.isfile(path) and not path.endswith('.xz')
+
+
+def sample_sequences(path, max_reads):
+    """The sequences of the first max_reads FASTQ or FASTA records of path."""
+    sequences = []
+    with _open(path) as f:
+        line = f.readline()
+        fasta = line.startswith(b'>')
+        while line and len(sequences) < max_reads:
+            seq = f.readline().strip()
+            if fasta:
+                line = f.readline()
+                # multi-line FASTA records are rare for reads; their first
+                # line is enough for 5' detection and a sample for 3'
+                while line and not line.startswith(b'>'):
+                    line = f.readline()
+            else:
+                f.readline()
+                f.readline()
+                line = f.readline()
+            sequences.append(seq.upper())
+    return sequences
+
+
+class AdapterDetector:
+    """
+    Finds which of the KNOWN_ADAPTERS are in a sample of reads.  The first
+    KMER_LENGTH bases of each 3' adapter, and the last of each 5' adapter
+    (near the start of the read), are looked up in every sampled read with a
+    substring search; the number of reads holding each one is counted in an
+    array indexed like KNOWN_ADAPTERS.  A 12-mer occurs by chance about once
+    in 170,000 read positions, so an adapter in min_fraction of the reads
+    (0.1% by default) is over-represented by orders of magnitude.  The best
+    supported adapter of each end is picked.
+    """
+
+    def __init__(self, max_reads=50000, min_fraction=0.001, adapters=None):
+        self.max_reads = int(max_reads)
+        self.min_fraction = float(min_fraction)
+        self.adapters = adapters or KNOWN_ADAPTERS
+        self.kmers = [(seq[:KMER_LENGTH] if end == 3 else seq[-KMER_LENGTH:]).encode('ascii')
+                      for _, seq, end in self.adapters]
+
+    def count(self, sequences):
+        """Number of sequences holding each adapter's k-mer, in an array indexed like self.adapters."""
+        counts = array('l', [0] * len(self.adapters))
+        three_prime = [(i, kmer) for i, (kmer, (_, _, end)) in
+                       enumerate(zip(self.kmers, self.adapters)) if end == 3]
+        five_prime = [(i, kmer) for i, (kmer, (_, _, end)) in
+                      enumerate(zip(self.kmers, self.adapters)) if end == 5]
+        for seq in sequences:
+            for i, kmer in three_prime:
+                if kmer in seq:
+                    counts[i] += 1
+            if five_prime:
+                start = seq[:FIVE_PRIME_WINDOW]
+                for i, kmer in five_prime:
+                    if kmer in start:
+                        counts[i] += 1
+        return counts
+
+    def detect(self, paths):
+        """
+        Samples up to max_reads reads from each of paths (one, or the
+        forward and reverse files of a library) and returns a dict with the
+        'three_prime' and 'five_prime' adapters picked, each None or a
+        (name, sequence, support) tuple, the 'support' of every adapter as
+        a list of (name, sequence, end, reads), the number of 'reads'
+        sampled and the 'seconds' it took.
+        """
+        start = time.time()
+        sequences = []
+        for path in paths:
+            sequences.extend(sample_sequences(path, self.max_reads))
+        counts = self.count(sequences)
+        min_reads = max(1, int(self.min_fraction * len(sequences)))
+        result = {'reads': len(sequences),
+                  'support': [(name, seq, end, counts[i])
+                              for i, (name, seq, end) in enumerate(self.adapters)],
+                  'three_prime': None,
+                  'five_prime': None}
+        for key, end in [('three_prime', 3), ('five_prime', 5)]:
+            best = None
+            for i, (name, seq, adapter_end) in enumerate(self.adapters):
+                if adapter_end == end and counts[i] >= min_reads and \
+                        (best is None or counts[i] > best[2]):
+                    best = (name, seq, counts[i])
+            result[key] = best
+        result['seconds'] = time.time() - start
+        return result
+
+
+def detection_report(detected):
+    """Report text for the result of AdapterDetector.detect()."""
+    lines = ['Adapter auto-detection, on ' + str(detected['reads']) + ' sampled reads in ' +
+             '%.2f' % detected['seconds'] + ' s:']
+    for name, seq, end, reads in detected['support']:
+        lines.append('    ' + str(end) + "' " + name + ' (' + seq + '): ' + str(reads) + ' reads')
+    for key, label in [('three_prime', "3'"), ('five_prime', "5'")]:
+        if detected[key]:
+            name, seq, reads = detected[key]
+            lines.append('Detected ' + label + ' adapter: ' + name + ' ' + seq + ' (' +
+                         str(reads) + ' supporting reads)')
+        else:
+            lines.append('No ' + label + ' adapter detected')
+    return '\n'.join(lines) + '\n\n'
@@ -0,0 +1,229 @@
+"""
+Futures for service calls, and asynchronous facades over the generated
+service clients for the methods kb_cutadapt uses.  Each facade method
+returns a Future instead of blocking, so one thread can have many calls in
+flight, e.g.
+
+    ws = AsyncWorkspace(registry.workspace())
+    futures = [ws.get_object_info3({'objects': [{'ref': r}]}) for r in refs]
+    infos = [f.result()['infos'][0] for f in futures]
+
+A facade shares the BaseClient (url, token, service version and
+connections) of the synchronous client it wraps, and its calls go through
+the same BaseClient code as the synchronous ones, run on the threads of a
+shared executor.
+"""
+import threading
+try:
+    import Queue as queue  # py2
+except ImportError:
+    import queue  # py3
+
+
+class Future:
+    """
+    The eventual result of a call made with call_method_async,
+    run_job_async or submit_jobs.  job_id is set once an SDK job has been
+    submitted.
+    """
+
+    def __init__(self, job_id=None):
+        self.job_id = job_id
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+
+    def _set(self, result=None, error=None):
+        self._result = result
+        self._error = error
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def exception(self, timeout=None):
+        """
+        The exception the call failed with, or None.  Raises
+        FutureTimeoutError if it hasn't finished within timeout seconds.
+        """
+        if not self._done.wait(timeout):
+            raise FutureTimeoutError('call has not finished' if self.job_id is None
+                                     else 'job ' + str(self.job_id) + ' has not finished')
+        return self._error
+
+    def result(self, timeout=None):
+        """
+        The call's result, as the matching synchronous method would return
+        it.  Raises the call's error if it failed, or FutureTimeoutError if
+        it hasn't finished within timeout seconds.
+        """
+        error = self.exception(timeout)
+        if error is not None:
+            raise error
+        return self._result
+
+
+class FutureTimeoutError(Exception):
+    pass
+
+
+class _CallExecutor:
+    """
+    Runs asynchronous calls on up to max_workers daemon threads, started as
+    calls queue up.  A call started from one of the workers runs inline, so
+    calls that make further calls can't starve the pool.
+    """
+
+    def __init__(self, max_workers=32):
+        self.max_workers = max_workers
+        self._queue = queue.Queue()
+        self._workers = 0
+        self._idle = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def configure(self, max_workers=None):
+        with self._lock:
+            if max_workers is not None:
+                self.max_workers = max(1, int(max_workers))
+
+    @staticmethod
+    def _run(future, function, args):
+        try:
+            result = function(*args)
+        except Exception as e:
+            future._set(error=e)
+        else:
+            future._set(result=result)
+
+    def submit(self, function, *args):
+        future = Future()
+        if getattr(self._local, 'worker', False):
+            self._run(future, function, args)
+            return future
+        with self._lock:
+            self._queue.put((future, function, args))
+            if self._queue.qsize() > self._idle and self._workers < self.max_workers:
+                self._workers += 1
+                worker = threading.Thread(target=self._work, name='sdk-client-call')
+                worker.daemon = True
+                worker.start()
+        return future
+
+    def _work(self):
+        self._local.worker = True
+        while True:
+            with self._lock:
+                self._idle += 1
+            task = self._queue.get()
+            with self._lock:
+                self._idle -= 1
+            self._run(*task)
+
+
+_call_executor = _CallExecutor()
+
+
+def configure_async_calls(max_workers=None):
+    """Sets the number of threads that run asynchronous calls."""
+    _call_executor.configure(max_workers)
+
+
+def call_method_async(client, service_method, args, service_ver=None, context=None):
+    """
+    Calls a standard or dynamic service on a worker thread and returns a
+    Future for its result.  client is a BaseClient; the other arguments are
+    as for its call_method.
+    """
+    return _call_executor.submit(client.call_method, service_method, args, service_ver, context)
+
+
+def run_job_async(client, service_method, args, service_ver=None, context=None):
+    """
+    Runs an SDK method as a job and returns a Future for its result.  The job
+    is submitted on a worker thread and then polled along with the other
+    outstanding jobs of client's kind.  client is a BaseClient; the other
+    arguments are as for its run_job.
+    """
+    future = Future()
+    # _start_job sets future once the job has finished, or failed to start
+    _call_executor.submit(client._start_job, future, service_method, args, service_ver, context)
+    return future
+
+
+def submit_jobs(client, calls, service_ver=None, context=None):
+    """
+    Runs many SDK methods as jobs and returns a Future for each, in order.
+    calls is a list of (service_method, args) pairs.  A job that can't be
+    submitted gives a future holding the error, so the other jobs still run.
+    """
+    return [run_job_async(client, service_method, args, service_ver, context)
+            for service_method, args in calls]
+
+
+class _AsyncFacade:
+    # the service's module name
+    _service = None
+    # True for SDK modules whose methods run as callback jobs
+    _jobs = False
+
+    def __init__(self, client):
+        self._client = client._client
+        self._service_ver = client._service_ver
+
+    def _method(self, method, params, context=None):
+        name = self._service + '.' + method
+        if self._jobs:
+            return run_job_async(self._client, name, [params], self._service_ver, context)
+        return call_method_async(self._client, name, [params], self._service_ver, context)
+
+
+class AsyncWorkspace(_AsyncFacade):
+    _service = 'Workspace'
+
+    def get_object_info_new(self, params, context=None):
+        return self._method('get_object_info_new', params, context)
+
+    def get_object_info3(self, params, context=None):
+        return self._method('get_object_info3', params, context)
+
+    def get_objects2(self, params, context=None):
+        return self._method('get_objects2', params, context)
+
+    def save_objects(self, params, context=None):
+        return self._method('save_objects', params, context)
+
+    def copy_object(self, params, context=None):
+        return self._method('copy_object', params, context)
+
+
+class AsyncSetAPI(_AsyncFacade):
+    _service = 'SetAPI'
+
+    def get_reads_set_v1(self, params, context=None):
+        return self._method('get_reads_set_v1', params, context)
+
+    def save_reads_set_v1(self, params, context=None):
+        return self._method('save_reads_set_v1', params, context)
+
+
+class AsyncReadsUtils(_AsyncFacade):
+    _service = 'ReadsUtils'
+    _jobs = True
+
+    def download_reads(self, params, context=None):
+        return self._method('download_reads', params, context)
+
+    def upload_reads(self, params, context=None):
+        return self._method('upload_reads', params, context)
+
+
+class AsyncKBaseReport(_AsyncFacade):
+    _service = 'KBaseReport'
+    _jobs = True
+
+    def create(self, params, context=None):
+        return self._method('create', params, context)
+
+    def create_extended_report(self, params, context=None):
+        return self._method('create_extended_report', params, context)
@@ -0,0 +1,122 @@
+"""
+A caching auth client for the kb_cutadapt server, kept apart from the
+generated authclient.py as kb-sdk compile regenerates that file.
+ServerExtensions installs a CachingKBaseAuth as the auth client of the
+generated application.
+"""
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+from kb_cutadapt.authclient import KBaseAuth
+from kb_cutadapt.AsyncClients import Future
+
+
+def _hash(token):
+    return hashlib.sha256(token).hexdigest()
+
+
+class TokenCache:
+    """
+    An LRU cache of validated tokens, each kept for at most MAX_TIME_SEC,
+    and of the errors for tokens the auth service rejected, kept for
+    INVALID_TIME_SEC.  Lookups and additions are O(1).
+    """
+
+    MAX_TIME_SEC = 5 * 60
+    INVALID_TIME_SEC = 30
+
+    def __init__(self, maxsize=2000):
+        self._cache = OrderedDict()
+        self._invalid = OrderedDict()
+        self._maxsize = maxsize
+        self._lock = threading.Lock()
+
+    def _get(self, cache, token, max_time):
+        token = _hash(token)
+        with self._lock:
+            value = cache.pop(token, None)
+            if value is None or time.time() - value[1] > max_time:
+                return None
+            # reinsert as the most recently used
+            cache[token] = value
+        return value[0]
+
+    def _add(self, cache, token, value):
+        token = _hash(token)
+        with self._lock:
+            cache.pop(token, None)
+            cache[token] = [value, time.time()]
+            while len(cache) > self._maxsize:
+                cache.popitem(last=False)
+
+    def get_user(self, token):
+        return self._get(self._cache, token, self.MAX_TIME_SEC)
+
+    def get_invalid(self, token):
+        """The error the auth service gave for token, if it rejected it."""
+        return self._get(self._invalid, token, self.INVALID_TIME_SEC)
+
+    def add_valid_token(self, token, user):
+        if not token:
+            raise ValueError('Must supply token')
+        if not user:
+            raise ValueError('Must supply user')
+        self._add(self._cache, token, user)
+
+    def add_invalid_token(self, token, error):
+        if not token:
+            raise ValueError('Must supply token')
+        self._add(self._invalid, token, error)
+
+
+class CachingKBaseAuth(KBaseAuth):
+    """
+    A KBaseAuth whose token cache is a TokenCache, that also remembers
+    tokens the auth service rejected, and whose concurrent checks of one
+    token share a single validation.
+    """
+
+    def __init__(self, auth_url=None, maxsize=2000):
+        KBaseAuth.__init__(self, auth_url)
+        self._cache = TokenCache(maxsize)
+        self._validations = {}
+        self._lock = threading.Lock()
+
+    def get_user(self, token):
+        if not token:
+            raise ValueError('Must supply token')
+        user = self._cache.get_user(token)
+        if user:
+            return user
+        error = self._cache.get_invalid(token)
+        if error:
+            raise ValueError(error)
+
+        key = _hash(token)
+        with self._lock:
+            validation = self._validations.get(key)
+            owner = validation is None
+            if owner:
+                validation = Future()
+                self._validations[key] = validation
+        if not owner:
+            return validation.result()
+        try:
+            user = KBaseAuth.get_user(self, token)
+        except ValueError as e:
+            if str(e).startswith('Error connecting to auth service: 4'):
+                # the token was rejected, rather than the service failing
+                self._cache.add_invalid_token(token, str(e))
+            validation._set(error=e)
+            raise
+        except Exception as e:
+            validation._set(error=e)
+            raise
+        else:
+            validation._set(user)
+            return user
+        finally:
+            with self._lock:
+                del self._validations[key]
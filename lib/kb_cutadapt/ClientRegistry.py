@@ -0,0 +1,46 @@
+import threading
+
+from kb_cutadapt.ClientTransport import pooled
+from Workspace.WorkspaceClient import Workspace
+from ReadsUtils.ReadsUtilsClient import ReadsUtils
+from SetAPI.SetAPIServiceClient import SetAPI
+from KBaseReport.KBaseReportClient import KBaseReport
+
+
+class ClientRegistry:
+    """
+    The service clients of one request, each created the first time it's
+    asked for and then shared by all the per-library code (and threads) of
+    that request.  Their calls go over the keep-alive sessions
+    ClientTransport pools per host.
+    """
+
+    def __init__(self, config, token=None):
+        self.config = config
+        self.token = token
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def _get(self, name, create):
+        with self._lock:
+            if name not in self._clients:
+                self._clients[name] = create()
+            return self._clients[name]
+
+    def workspace(self):
+        return self._get('workspace', lambda: pooled(Workspace(self.config['workspace-url'],
+                                                               token=self.token)))
+
+    def reads_utils(self):
+        return self._get('reads_utils', lambda: pooled(ReadsUtils(self.config['SDK_CALLBACK_URL'],
+                                                                  token=self.token)))
+
+    def set_api(self):
+        # SetAPI is a dynamic service, so it goes through the service wizard
+        return self._get('set_api', lambda: pooled(SetAPI(url=self.config['service-wizard-url'],
+                                                          token=self.token)))
+
+    def report(self, service_ver='release'):
+        return self._get('report_' + service_ver,
+                         lambda: pooled(KBaseReport(self.config['SDK_CALLBACK_URL'],
+                                                    token=self.token, service_ver=service_ver)))
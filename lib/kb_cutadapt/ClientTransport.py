@@ -0,0 +1,489 @@
+"""
+The transport kb_cutadapt's service clients use, layered over the
+generated BaseClient without changing it (kb-sdk regenerates baseclient.py
+on every compile).  pooled() swaps a generated client's BaseClient for a
+PooledClient with the same settings, whose calls go over keep-alive
+sessions shared per host and are counted in call_stats(), whose SDK jobs
+are polled together by one scheduler thread, whose ServiceWizard lookups
+are cached, and which can send many calls in one JSON-RPC batch request
+(see call_batch()).
+"""
+import json
+import time
+import random
+import threading
+
+import requests
+try:
+    from cookielib import DefaultCookiePolicy  # py2
+except ImportError:
+    from http.cookiejar import DefaultCookiePolicy  # py3
+try:
+    from urlparse import urlparse  # py2
+except ImportError:
+    from urllib.parse import urlparse  # py3
+
+from kb_cutadapt.baseclient import BaseClient, ServerError, _JSONObjectEncoder, _CT, _AJ
+from kb_cutadapt.AsyncClients import Future
+
+
+class _ConnectionPool:
+    """
+    One keep-alive requests session per scheme://host:port, shared by every
+    pooled client in the process, so that repeated calls reuse TCP (and TLS)
+    connections.  Sessions idle for longer than idle_timeout seconds are
+    closed and replaced, which keeps us from reusing connections the server
+    has already dropped.  Cookies are never stored, since the sessions are
+    shared between tokens.
+    """
+
+    def __init__(self, pool_size=10, idle_timeout=50):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _host(url):
+        parsed = urlparse(url)
+        return parsed.scheme + '://' + parsed.netloc
+
+    def _new_session(self):
+        session = requests.Session()
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=self.pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def session(self, url):
+        host = self._host(url)
+        now = time.time()
+        with self._lock:
+            entry = self._sessions.get(host)
+            if entry is not None and now - entry[1] > self.idle_timeout:
+                entry[0].close()
+                entry = None
+            if entry is None:
+                entry = [self._new_session(), now]
+                self._sessions[host] = entry
+            entry[1] = now
+            return entry[0]
+
+    def touch(self, url):
+        with self._lock:
+            entry = self._sessions.get(self._host(url))
+            if entry is not None:
+                entry[1] = time.time()
+
+    def configure(self, pool_size=None, idle_timeout=None):
+        with self._lock:
+            if pool_size is not None:
+                self.pool_size = int(pool_size)
+            if idle_timeout is not None:
+                self.idle_timeout = float(idle_timeout)
+            for session, _ in self._sessions.values():
+                session.close()
+            self._sessions = {}
+
+
+class _CallStats:
+    """
+    Per-method totals of the calls made by pooled clients: number of calls,
+    errors, seconds (total and slowest) and bytes sent and received.
+    """
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, method, seconds, bytes_sent, bytes_received, error=False):
+        with self._lock:
+            stats = self._stats.get(method)
+            if stats is None:
+                stats = {'calls': 0, 'errors': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                         'bytes_sent': 0, 'bytes_received': 0}
+                self._stats[method] = stats
+            stats['calls'] += 1
+            stats['errors'] += 1 if error else 0
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            stats['bytes_sent'] += bytes_sent
+            stats['bytes_received'] += bytes_received
+
+    def snapshot(self):
+        with self._lock:
+            return dict((m, dict(s)) for m, s in self._stats.items())
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+
+class _JobPoller:
+    """
+    Polls the state of every outstanding SDK job from one scheduler thread.
+    Each job is checked on its own backoff schedule, starting at its
+    client's async_job_check_time and growing by its scale percent up to
+    min(async_job_check_max_time, max_interval), so that short jobs are
+    noticed soon after they finish.  Across all jobs at most
+    max_checks_per_second checks are made; when more are due, the ones due
+    the longest go first.
+    """
+
+    def __init__(self, max_checks_per_second=20, max_interval=30):
+        self.max_checks_per_second = max_checks_per_second
+        self.max_interval = max_interval
+        self._jobs = []
+        self._cond = threading.Condition()
+        self._thread = None
+        self._last_check = 0
+
+    def configure(self, max_checks_per_second=None, max_interval=None):
+        if max_checks_per_second is not None and float(max_checks_per_second) <= 0:
+            raise ValueError('job checks per second must be more than 0, not ' +
+                             str(max_checks_per_second))
+        with self._cond:
+            if max_checks_per_second is not None:
+                self.max_checks_per_second = float(max_checks_per_second)
+            if max_interval is not None:
+                self.max_interval = float(max_interval)
+            self._cond.notify()
+
+    def add(self, client, service, future):
+        interval = client.async_job_check_time
+        job = {'client': client, 'service': service, 'future': future,
+               'interval': interval, 'due': time.time() + interval}
+        with self._cond:
+            self._jobs.append(job)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='sdk-job-poller')
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+
+    def _next(self):
+        """Waits for, removes and returns the job that is due first."""
+        with self._cond:
+            while True:
+                now = time.time()
+                if self._jobs:
+                    job = min(self._jobs, key=lambda j: j['due'])
+                    start = max(job['due'], self._last_check + 1.0 / self.max_checks_per_second)
+                    if start <= now:
+                        self._jobs.remove(job)
+                        self._last_check = now
+                        return job
+                    self._cond.wait(start - now)
+                else:
+                    self._cond.wait()
+
+    def _run(self):
+        while True:
+            job = self._next()
+            client = job['client']
+            future = job['future']
+            try:
+                job_state = client._check_job(job['service'], future.job_id)
+            except Exception as e:
+                future._set(error=e)
+                continue
+            if job_state['finished']:
+                error = job_state.get('error')
+                if error:
+                    if not isinstance(error, dict):
+                        error = {'message': str(error)}
+                    future._set(error=ServerError(
+                        error.get('name', 'JobError'), error.get('code', 0),
+                        error.get('message', ''), error.get('error')))
+                else:
+                    future._set(result=_unpack_result(job_state['result']))
+                continue
+            job['interval'] = min(job['interval'] * client.async_job_check_time_scale_percent / 100.0,
+                                  client.async_job_check_max_time, self.max_interval)
+            job['due'] = time.time() + job['interval']
+            with self._cond:
+                self._jobs.append(job)
+
+
+class _ServiceUrlCache:
+    """
+    Process-wide cache of the service URLs resolved by the ServiceWizard,
+    keyed by (service wizard url, module, version).  Entries expire after
+    ttl seconds, and are dropped when a call to the URL fails to connect.
+    Concurrent lookups of the same key share one request.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._urls = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def configure(self, ttl=None):
+        with self._lock:
+            if ttl is not None:
+                self.ttl = float(ttl)
+            self._urls = {}
+
+    def get(self, key, lookup):
+        with self._lock:
+            entry = self._urls.get(key)
+            if entry is not None and entry[1] > time.time():
+                return entry[0]
+            future = self._pending.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._pending[key] = future
+        if not owner:
+            return future.result()
+        try:
+            url = lookup()
+        except Exception as e:
+            with self._lock:
+                del self._pending[key]
+            future._set(error=e)
+            raise
+        with self._lock:
+            if self.ttl > 0:
+                self._urls[key] = (url, time.time() + self.ttl)
+            del self._pending[key]
+        future._set(result=url)
+        return url
+
+    def invalidate(self, key, url):
+        with self._lock:
+            entry = self._urls.get(key)
+            if entry is not None and entry[0] == url:
+                del self._urls[key]
+
+
+_connection_pool = _ConnectionPool()
+_call_stats = _CallStats()
+_job_poller = _JobPoller()
+_service_url_cache = _ServiceUrlCache()
+
+
+def configure_connection_pool(pool_size=None, idle_timeout=None):
+    """
+    Sets the number of keep-alive connections kept per host and the seconds
+    after which an idle host's connections are dropped.  Existing
+    connections are closed.
+    """
+    _connection_pool.configure(pool_size, idle_timeout)
+
+
+def configure_job_poller(max_checks_per_second=None, max_interval=None):
+    """
+    Sets the cap on job state checks per second, across all outstanding
+    jobs, and the longest time between two checks of the same job.
+    """
+    _job_poller.configure(max_checks_per_second, max_interval)
+
+
+def configure_service_url_cache(ttl=None):
+    """
+    Sets the seconds a service URL resolved by the ServiceWizard is reused
+    for, 0 to look it up before every call.  Cached URLs are dropped.
+    """
+    _service_url_cache.configure(ttl)
+
+
+def call_stats():
+    """
+    Returns {method: {'calls', 'errors', 'seconds', 'max_seconds',
+    'bytes_sent', 'bytes_received'}} for the calls made so far.
+    """
+    return _call_stats.snapshot()
+
+
+def reset_call_stats():
+    _call_stats.reset()
+
+
+class PooledClient(BaseClient):
+    """
+    A BaseClient whose calls go through the shared connection pool, whose
+    SDK jobs are polled by the shared job poller and whose dynamic service
+    URLs come from the shared URL cache.
+    """
+
+    def _post(self, url, method, request):
+        body = json.dumps(request, cls=_JSONObjectEncoder)
+        start = time.time()
+        try:
+            ret = _connection_pool.session(url).post(
+                url, data=body, headers=self._headers, timeout=self.timeout,
+                verify=not self.trust_all_ssl_certificates)
+        except Exception:
+            _call_stats.record(method, time.time() - start, len(body), 0, error=True)
+            raise
+        finally:
+            _connection_pool.touch(url)
+        _call_stats.record(method, time.time() - start, len(body), len(ret.content),
+                           error=not ret.ok)
+        ret.encoding = 'utf-8'
+        return ret
+
+    def _call(self, url, method, params, context=None):
+        arg_hash = {'method': method,
+                    'params': params,
+                    'version': '1.1',
+                    'id': str(random.random())[2:]
+                    }
+        if context:
+            if type(context) is not dict:
+                raise ValueError('context is not type dict as required.')
+            arg_hash['context'] = context
+
+        ret = self._post(url, method, arg_hash)
+        if ret.status_code == 500:
+            if ret.headers.get(_CT) == _AJ:
+                err = ret.json()
+                if 'error' in err:
+                    raise ServerError(**err['error'])
+                else:
+                    raise ServerError('Unknown', 0, ret.text)
+            else:
+                raise ServerError('Unknown', 0, ret.text)
+        if not ret.ok:
+            ret.raise_for_status()
+        resp = ret.json()
+        if 'result' not in resp:
+            raise ServerError('Unknown', 0, 'An unknown server error occurred')
+        return _unpack_result(resp['result'])
+
+    def _get_service_url(self, service_method, service_version):
+        if not self.lookup_url:
+            return self.url
+        service, _ = service_method.split('.')
+        return _service_url_cache.get(
+            (self.url, service, service_version),
+            lambda: BaseClient._get_service_url(self, service_method, service_version))
+
+    def call_method(self, service_method, args, service_ver=None, context=None):
+        """As BaseClient.call_method, looking the service up again if it can't be reached."""
+        url = self._get_service_url(service_method, service_ver)
+        context = self._set_up_context(service_ver, context)
+        try:
+            return self._call(url, service_method, args, context)
+        except requests.exceptions.ConnectionError:
+            if self.lookup_url:
+                # the service may have moved, so look it up again next time
+                service, _ = service_method.split('.')
+                _service_url_cache.invalidate((self.url, service, service_ver), url)
+            raise
+
+    def call_method_batch(self, calls, service_ver=None, context=None):
+        """
+        Calls many methods of a standard or dynamic service in one JSON-RPC
+        batch request, i.e. one round-trip.  calls is a list of
+        (service_method, args) pairs; for a dynamic service they must all be
+        methods of the same service.  Returns a (result, error) pair for each
+        call, in order: error is None or the ServerError of that call, so one
+        failing call doesn't fail the others.  Errors of the request as a
+        whole, e.g. connection errors, are raised.  Other arguments are as
+        for call_method.
+        """
+        if not calls:
+            return []
+        services = set(service_method.split('.')[0] for service_method, _ in calls)
+        if self.lookup_url and len(services) > 1:
+            raise ValueError('A batch can only call one dynamic service, not ' +
+                             ', '.join(sorted(services)))
+        url = self._get_service_url(calls[0][0], service_ver)
+        context = self._set_up_context(service_ver, context)
+        if context and type(context) is not dict:
+            raise ValueError('context is not type dict as required.')
+        batch = []
+        for i, (service_method, args) in enumerate(calls):
+            arg_hash = {'method': service_method,
+                        'params': args,
+                        'version': '1.1',
+                        'id': str(i) + '-' + str(random.random())[2:]
+                        }
+            if context:
+                arg_hash['context'] = context
+            batch.append(arg_hash)
+        try:
+            ret = self._post(url, 'batch', batch)
+        except requests.exceptions.ConnectionError:
+            if self.lookup_url:
+                _service_url_cache.invalidate((self.url, services.pop(), service_ver), url)
+            raise
+        resp = ret.json() if ret.headers.get(_CT) == _AJ else None
+        if isinstance(resp, dict) and 'error' in resp:
+            # the whole batch was rejected
+            raise ServerError(**resp['error'])
+        if not ret.ok:
+            ret.raise_for_status()
+        if not isinstance(resp, list):
+            raise ServerError('Unknown', 0, 'An unknown server error occurred')
+        by_id = dict((r.get('id'), r) for r in resp if isinstance(r, dict))
+        results = []
+        for arg_hash in batch:
+            r = by_id.get(arg_hash['id'])
+            if r is None:
+                results.append((None, ServerError('Unknown', 0, 'No response to call ' +
+                                                  arg_hash['method'])))
+            elif 'error' in r:
+                results.append((None, ServerError(**r['error'])))
+            elif 'result' not in r:
+                results.append((None, ServerError('Unknown', 0,
+                                                  'An unknown server error occurred')))
+            else:
+                results.append((_unpack_result(r['result']), None))
+        return results
+
+    def run_job(self, service_method, args, service_ver=None, context=None):
+        """As BaseClient.run_job, with the job polled by the shared poller."""
+        future = Future()
+        self._start_job(future, service_method, args, service_ver, context)
+        return future.result()
+
+    def _start_job(self, future, service_method, args, service_ver, context):
+        """Submits a job and has the poller set future when it finishes."""
+        mod, _ = service_method.split('.')
+        try:
+            future.job_id = self._submit_job(service_method, args, service_ver, context)
+        except Exception as e:
+            future._set(error=e)
+            return
+        _job_poller.add(self, mod, future)
+
+
+def _unpack_result(result):
+    if not result:
+        return
+    if len(result) == 1:
+        return result[0]
+    return result
+
+
+def pooled(client):
+    """
+    Makes a generated service client, e.g. Workspace or ReadsUtils, use a
+    PooledClient with the same url, token and settings, and returns it.
+    """
+    if not isinstance(client._client, PooledClient):
+        base = PooledClient.__new__(PooledClient)
+        base.__dict__.update(client._client.__dict__)
+        client._client = base
+    return client
+
+
+def call_batch(client, calls, context=None):
+    """
+    Calls many methods of a generated service client's service in one
+    request, e.g. call_batch(kb_cutadapt(url), [('status', None), ...]).
+    calls is a list of (method, params) pairs, params None for a method
+    without any; returns a (result, error) pair per call as
+    PooledClient.call_method_batch does.
+    """
+    client = pooled(client)
+    service = client.__class__.__name__
+    return client._client.call_method_batch(
+        [(service + '.' + method, [] if params is None else [params]) for method, params in calls],
+        client._service_ver, context)
@@ -1,9 +1,32 @@
 import os
+import re
+import sys
+import atexit
+import fcntl
+import logging
+import shutil
 import subprocess
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+import multiprocessing
+
+try:
+    from StringIO import StringIO  # py2
+except ImportError:
+    from io import StringIO  # py3
 
 from pprint import pprint,pformat
 
-from ReadsUtils.ReadsUtilsClient import ReadsUtils
+from kb_cutadapt.ShockReadsUtil import ShockReadsUtil
+from kb_cutadapt.FastqChunks import fastq_chunk_ranges, copy_range
+from kb_cutadapt.FileCache import FileCache, cache_key
+from kb_cutadapt.ClientRegistry import ClientRegistry
+from kb_cutadapt.AsyncClients import AsyncWorkspace, AsyncReadsUtils, Future
+from kb_cutadapt import OutputCompression
+from kb_cutadapt.AdapterDetect import AdapterDetector, can_sample, detection_report
 #from KBaseReport.KBaseReportClient import KBaseReport
 
 
@@ -13,25 +36,362 @@ def log(message):
     print(message)
 
 
+def _read_first_line(path):
+    try:
+        with open(path, 'r') as f:
+            return f.readline().strip()
+    except (IOError, OSError):
+        return None
+
+
+def _cgroup_cpu_quota():
+    """Returns the CPU limit imposed by the cgroup CFS quota (v2 or v1), or None."""
+    # cgroup v2: "<quota> <period>" or "max <period>"
+    line = _read_first_line('/sys/fs/cgroup/cpu.max')
+    if line:
+        fields = line.split()
+        if len(fields) == 2 and fields[0] != 'max':
+            return float(fields[0]) / float(fields[1])
+        return None
+    # cgroup v1
+    for d in ['/sys/fs/cgroup/cpu', '/sys/fs/cgroup/cpu,cpuacct']:
+        quota = _read_first_line(os.path.join(d, 'cpu.cfs_quota_us'))
+        period = _read_first_line(os.path.join(d, 'cpu.cfs_period_us'))
+        if quota and period and int(quota) > 0 and int(period) > 0:
+            return float(quota) / float(period)
+    return None
+
+
+def _affinity_cpu_count():
+    """Returns the number of CPUs in this process' affinity mask, or None."""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    # python 2 has no sched_getaffinity, so read the mask the kernel reports
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('Cpus_allowed_list:'):
+                    count = 0
+                    for cpu_range in line.split(':', 1)[1].strip().split(','):
+                        bounds = cpu_range.split('-')
+                        count += int(bounds[-1]) - int(bounds[0]) + 1
+                    return count
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+
+def get_available_cores():
+    """
+    Number of cores this container may actually use: the smaller of the cgroup
+    CPU quota and the affinity mask, falling back to the host CPU count.
+    """
+    limits = []
+    quota = _cgroup_cpu_quota()
+    if quota:
+        limits.append(max(1, int(quota)))
+    affinity = _affinity_cpu_count()
+    if affinity:
+        limits.append(affinity)
+    if not limits:
+        try:
+            limits.append(multiprocessing.cpu_count())
+        except NotImplementedError:
+            limits.append(1)
+    return min(limits)
+
+
+# labels of the cutadapt report summary lines, for single-end and paired-end
+# runs, mapped to the CutadaptStats field they fill in
+_REPORT_COUNT_FIELDS = {
+    'Total reads processed': 'reads_in',
+    'Total read pairs processed': 'reads_in',
+    'Reads with adapters': 'reads_with_adapters',
+    'Read 1 with adapter': 'reads_with_adapters',
+    'Read 2 with adapter': 'reads_with_adapters',
+    'Reads that were too short': 'reads_too_short',
+    'Pairs that were too short': 'reads_too_short',
+    'Reads that were too long': 'reads_too_long',
+    'Pairs that were too long': 'reads_too_long',
+    'Reads with too many N': 'reads_too_many_n',
+    'Pairs with too many N': 'reads_too_many_n',
+    'Reads written (passing filters)': 'reads_written',
+    'Pairs written (passing filters)': 'reads_written',
+    'Total basepairs processed': 'bp_in',
+    'Quality-trimmed': 'bp_quality_trimmed',
+    'Total written (filtered)': 'bp_out'
+}
+
+STATS_COUNT_FIELDS = ['reads_in', 'reads_with_adapters', 'reads_too_short',
+                      'reads_too_long', 'reads_too_many_n', 'reads_written',
+                      'bp_in', 'bp_quality_trimmed', 'bp_out']
+
+_REPORT_LINE = re.compile(r'^\s*([^:]+):\s+([\d,]+)(?: bp)?(?:\s|$)')
+_REPORT_ADAPTER = re.compile(r'^Sequence: (\S*); Type: [^;]*; Length: \d+; Trimmed: ([\d,]+) times')
+
+
+def empty_cutadapt_stats():
+    stats = dict((f, 0) for f in STATS_COUNT_FIELDS)
+    stats['adapter_matches'] = {}
+    return stats
+
+
+def parse_cutadapt_report(report_lines):
+    """
+    Parses the counts out of the default cutadapt report into a CutadaptStats
+    dict.  Paired-end read counts are pairs, except reads_with_adapters which
+    adds up read 1 and read 2.  adapter_matches is keyed by adapter sequence,
+    adding up matches on both reads when the same adapter is used for each.
+    """
+    stats = empty_cutadapt_stats()
+    in_summary = True
+    for line in report_lines:
+        if line.startswith('=== ') and 'Summary' not in line:
+            # per-adapter sections follow the summary; their indented
+            # 'Read 1:' style lines are not summary counts
+            in_summary = False
+        if in_summary:
+            m = _REPORT_LINE.match(line)
+            if m and m.group(1) in _REPORT_COUNT_FIELDS:
+                stats[_REPORT_COUNT_FIELDS[m.group(1)]] += int(m.group(2).replace(',', ''))
+            continue
+        m = _REPORT_ADAPTER.match(line)
+        if m:
+            sequence = m.group(1)
+            count = int(m.group(2).replace(',', ''))
+            stats['adapter_matches'][sequence] = stats['adapter_matches'].get(sequence, 0) + count
+    return stats
+
+
+def sum_cutadapt_stats(stats_list):
+    """Adds up CutadaptStats dicts, e.g. over the libraries of a set."""
+    total = empty_cutadapt_stats()
+    for stats in stats_list:
+        if not stats:
+            continue
+        for f in STATS_COUNT_FIELDS:
+            total[f] += stats.get(f, 0)
+        for sequence, count in stats.get('adapter_matches', {}).items():
+            total['adapter_matches'][sequence] = total['adapter_matches'].get(sequence, 0) + count
+    return total
+
+
+def parse_adapter_fasta(text):
+    """
+    The (name, sequence) records of adapters given as FASTA text, with
+    multi-line sequences joined.  cutadapt's ^ and $ anchors may be part of
+    the sequences.
+    """
+    records = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('>'):
+            records.append([line[1:].strip(), ''])
+        elif records:
+            records[-1][1] += line
+        else:
+            raise ValueError('Adapter FASTA must start with a ">" header line')
+    return [(name, seq) for name, seq in records if seq]
+
+
+def _close_inherited_fds(keep):
+    """
+    Closes the descriptors a forked worker inherited that were marked
+    close-on-exec, such as the input pipes of output compressors, which the
+    worker would otherwise hold open for as long as it lives.
+    """
+    try:
+        fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+    except OSError:
+        return
+    for fd in fds:
+        if fd in keep:
+            continue
+        try:
+            if fcntl.fcntl(fd, fcntl.F_GETFD) & fcntl.FD_CLOEXEC:
+                os.close(fd)
+        except (IOError, OSError):
+            pass
+
+
+def _inprocess_worker(conn):
+    """
+    Body of a long-lived engine worker: imports cutadapt once, then runs one
+    cutadapt command line per task received on conn, answering with
+    (return code, captured output).  A return code of None means cutadapt
+    could not be imported here.
+    """
+    _close_inherited_fds([conn.fileno()])
+    try:
+        from cutadapt.__main__ import main as cutadapt_main
+    except Exception:
+        cutadapt_main = None
+        import_error = traceback.format_exc()
+
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+        args, cwd = task
+        if cutadapt_main is None:
+            conn.send((None, import_error))
+            continue
+
+        output = StringIO()
+        old_stdout, old_stderr = sys.stdout, sys.stderr
+        # cutadapt only sets up its log handler if none exist, so drop the one
+        # left over from the previous task, which points at an old buffer
+        logging.root.handlers = []
+        os.chdir(cwd)
+        sys.stdout = sys.stderr = output
+        try:
+            cutadapt_main(args)
+            returncode = 0
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                returncode = e.code or 0
+            else:
+                output.write(str(e.code) + '\n')
+                returncode = 1
+        except Exception:
+            output.write(traceback.format_exc())
+            returncode = 1
+        finally:
+            sys.stdout, sys.stderr = old_stdout, old_stderr
+            logging.root.handlers = []
+        conn.send((returncode, output.getvalue()))
+
+
+class CutadaptWorkerPool:
+    """
+    Pool of long-lived worker processes that run cutadapt through its python
+    pipeline API, so the interpreter start and cutadapt import are paid once
+    per worker instead of once per library.  Workers are started on demand;
+    each runs a single task at a time.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = []
+        self._all = []
+
+    def _acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        parent_conn, child_conn = multiprocessing.Pipe()
+        # not a daemon, so cutadapt may still start its own worker processes
+        proc = multiprocessing.Process(target=_inprocess_worker, args=(child_conn,))
+        proc.start()
+        child_conn.close()
+        worker = (proc, parent_conn)
+        with self._lock:
+            self._all.append(worker)
+        return worker
+
+    def _release(self, worker, healthy):
+        with self._lock:
+            if healthy:
+                self._idle.append(worker)
+                return
+            self._all.remove(worker)
+        worker[0].terminate()
+
+    def run(self, args, cwd):
+        worker = self._acquire()
+        try:
+            worker[1].send((args, cwd))
+            result = worker[1].recv()
+        except (EOFError, IOError, OSError):
+            self._release(worker, False)
+            return (1, 'cutadapt engine worker exited unexpectedly\n')
+        self._release(worker, result[0] is not None)
+        return result
+
+    def shutdown(self):
+        with self._lock:
+            workers = self._all
+            self._all = []
+            self._idle = []
+        for proc, conn in workers:
+            try:
+                conn.send(None)
+            except (IOError, OSError):
+                pass
+            proc.join(5)
+            if proc.is_alive():
+                proc.terminate()
+
+
+_worker_pool = None
+_worker_pool_lock = threading.Lock()
+
+
+def get_worker_pool():
+    global _worker_pool
+    with _worker_pool_lock:
+        if _worker_pool is None:
+            _worker_pool = CutadaptWorkerPool()
+            atexit.register(_worker_pool.shutdown)
+        return _worker_pool
+
 
 class CutadaptRunner:
 
     CUTADAPT = 'cutadapt'
 
-    def __init__(self, scratch):
+    # 'subprocess' forks the cutadapt executable for each run; 'inprocess'
+    # hands the same command line to a long-lived worker that calls
+    # cutadapt's python API.  Both produce identical output files.
+    ENGINES = ['subprocess', 'inprocess']
+
+    # cutadapt refuses --cores > 1 on some installs (e.g. under python 2),
+    # so we probe it once per process
+    _multicore_supported = None
+    _version = None
+
+    def __init__(self, scratch, engine='subprocess'):
         self.scratch = scratch
+        self.set_engine(engine)
         self.clear_options()
 
+    def set_engine(self, engine):
+        if engine not in self.ENGINES:
+            raise ValueError('Unknown cutadapt engine "' + str(engine) +
+                             '", must be one of: ' + ', '.join(self.ENGINES))
+        self.engine = engine
+
     def clear_options(self):
         self.interleaved = False
         self.input_filename = None
         self.output_filename = None
-        self.five_prime = None
-        self.three_prime = None
+        self.paired_input_filename = None
+        self.paired_output_filename = None
+        # adapter sequences of each end, anchors included, in the order given
+        self.five_prime = []
+        self.three_prime = []
+        self.no_indels = None
+        self._adapter_files = {}
         self.err_tolerance = None
         self.overlap = None
         self.min_read_length = None
+        self.max_read_length = None
         self.discard_untrimmed = None
+        self.quality_cutoff = None
+        self.quality_base = None
+        self.nextseq_trim = None
+        self.max_n = None
+        self.poly_a = False
+        self.cores = 1
+        self.chunks = 1
+        self.chunk_min_bytes = None
+        self.compression = 'none'
+        self.compression_level = None
+        self.compression_threads = 1
+        self.stats = None
+        self.compression_stats = None
 
 
     def set_input_file(self, filename):
@@ -40,16 +400,46 @@ class CutadaptRunner:
     def set_output_file(self, filename):
         self.output_filename = filename
 
+    def set_paired_input_file(self, filename):
+        """Reverse reads file, for paired-end libraries that aren't interleaved."""
+        self.paired_input_filename = filename
+
+    def set_paired_output_file(self, filename):
+        self.paired_output_filename = filename
+
+    def is_paired(self):
+        return self.interleaved or self.paired_input_filename is not None
+
 
     def set_three_prime_option(self, sequence, anchored):
-        if anchored == 1:
-            sequence = sequence + '$'
-        self.three_prime = sequence
+        self.three_prime = []
+        self.add_three_prime_option(sequence, anchored)
 
     def set_five_prime_option(self, sequence, anchored):
-        if anchored == 1:
+        self.five_prime = []
+        self.add_five_prime_option(sequence, anchored)
+
+    def add_three_prime_option(self, sequence, anchored):
+        """Adds an adapter to those looked for at the 3' end; the best matching one is trimmed."""
+        if anchored == 1 and not sequence.endswith('$'):
+            sequence = sequence + '$'
+        if sequence not in self.three_prime:
+            self.three_prime.append(sequence)
+
+    def add_five_prime_option(self, sequence, anchored):
+        """Adds an adapter to those looked for at the 5' end; the best matching one is trimmed."""
+        if anchored == 1 and not sequence.startswith('^'):
             sequence = '^' + sequence
-        self.five_prime = sequence
+        if sequence not in self.five_prime:
+            self.five_prime.append(sequence)
+
+    def set_no_indels(self, no_indels):
+        """
+        Allows only mismatches, not insertions or deletions, in adapter
+        matches.  Left unset (None), it's turned on where that lets cutadapt
+        index several anchored adapters instead of aligning each in turn.
+        """
+        self.no_indels = None if no_indels is None else int(no_indels)
 
 
     def set_error_tolerance(self, tolerance):
@@ -61,29 +451,144 @@ class CutadaptRunner:
     def set_min_read_length(self, min_read_length):
         self.min_read_length = int(min_read_length)
 
+    def set_max_read_length(self, max_read_length):
+        self.max_read_length = int(max_read_length)
+
     def set_discard_untrimmed(self, discard_untrimmed):
         self.discard_untrimmed = int(discard_untrimmed)
 
+    def set_quality_cutoff(self, three_prime, five_prime=0):
+        """Trims bases below these qualities from the ends of the reads, before the adapters."""
+        self.quality_cutoff = (int(five_prime or 0), int(three_prime or 0))
+
+    def set_quality_base(self, quality_base):
+        self.quality_base = int(quality_base)
+
+    def set_nextseq_trim(self, cutoff):
+        """
+        Quality trimming of the 3' end for two-colour chemistry (NextSeq,
+        NovaSeq), where a dark cycle reads as a high-quality G.
+        """
+        self.nextseq_trim = int(cutoff)
+
+    def set_max_n(self, max_n):
+        """Discards reads with more N bases than max_n, or a greater fraction of Ns if max_n < 1."""
+        self.max_n = float(max_n)
+
+    def set_poly_a_trim(self, poly_a):
+        """
+        Trims poly-A tails from the 3' end of the reads, and poly-T heads
+        from the 5' end of the second reads of pairs, in the same pass as
+        the adapters.
+        """
+        self.poly_a = bool(poly_a)
+
     def set_interleaved(self, interleaved):
         self.interleaved = interleaved
 
+    def set_cores(self, cores):
+        cores = int(cores)
+        if cores > 1 and not self.supports_multicore():
+            log('cutadapt does not support multi-core mode here, using 1 core')
+            cores = 1
+        self.cores = max(1, cores)
+
+    def set_chunking(self, chunks, min_bytes):
+        """
+        Inputs of at least min_bytes are split into up to `chunks`
+        record-aligned pieces that are trimmed by separate cutadapt processes
+        and merged back in order.  min_bytes of 0 or None turns this off.
+        """
+        self.chunks = max(1, int(chunks))
+        self.chunk_min_bytes = int(min_bytes) if min_bytes else None
+
+    def set_output_compression(self, compression, level=None, threads=1):
+        """
+        Compresses the output files with gzip (pigz, if installed, with
+        `threads` threads) or zstd at `level`, or not at all for 'none'.  The
+        output file names should carry the matching suffix.  cutadapt itself
+        writes plain FASTQ to FIFOs that the compressors read from.
+        """
+        if compression not in OutputCompression.SUFFIXES:
+            raise ValueError('Unknown output compression "' + str(compression) +
+                             '", must be one of: ' +
+                             ', '.join(sorted(OutputCompression.SUFFIXES)))
+        if compression != 'none':
+            # fails early on a bad level or a missing compressor
+            OutputCompression.compressor_command(compression, level, threads)
+        self.compression = compression
+        self.compression_level = level
+        self.compression_threads = max(1, int(threads))
+
+    @classmethod
+    def cutadapt_version(cls):
+        """Version string of the installed cutadapt, probed once per process."""
+        if CutadaptRunner._version is None:
+            version = subprocess.check_output([cls.CUTADAPT, '--version'])
+            CutadaptRunner._version = version.decode('utf-8').strip()
+        return CutadaptRunner._version
+
+    def supports_multicore(self):
+        if CutadaptRunner._multicore_supported is None:
+            probe_dir = tempfile.mkdtemp(prefix='cutadapt_probe_', dir=self.scratch)
+            try:
+                probe_input = os.path.join(probe_dir, 'probe.fq')
+                with open(probe_input, 'w') as f:
+                    f.write('@probe\nACGT\n+\nIIII\n')
+                with open(os.devnull, 'w') as devnull:
+                    rc = subprocess.call([self.CUTADAPT, '--cores=2',
+                                          '-o', os.path.join(probe_dir, 'probe.out.fq'),
+                                          probe_input],
+                                         stdout=devnull, stderr=devnull)
+                CutadaptRunner._multicore_supported = (rc == 0)
+            finally:
+                shutil.rmtree(probe_dir, ignore_errors=True)
+        return CutadaptRunner._multicore_supported
+
     def _build_adapter_removal_options(self, cmd):
         if self.interleaved:
             cmd.append('--interleaved')
 
-        if self.three_prime:
+        for adapters, option, paired_option in [(self.three_prime, '-a', '-A'),
+                                                (self.five_prime, '-g', '-G')]:
+            if not adapters:
+                continue
+            # several adapters go to cutadapt as one FASTA file, so they're
+            # all searched for in the same pass over the reads
+            spec = adapters[0]
+            if len(adapters) > 1:
+                spec = 'file:' + self._adapter_files[option]
+            cmd.append(option)
+            cmd.append(spec)
+            if self.is_paired():
+                cmd.append(paired_option)
+                cmd.append(spec)
+
+        if self.poly_a:
             cmd.append('-a')
-            cmd.append(self.three_prime)
-            if self.interleaved:
-                cmd.append('-A')
-                cmd.append(self.three_prime)
-
-        if self.five_prime:
-            cmd.append('-g')
-            cmd.append(self.five_prime)
-            if self.interleaved:
+            cmd.append('A{100}')
+            if self.is_paired():
                 cmd.append('-G')
-                cmd.append(self.five_prime)
+                cmd.append('T{100}')
+            if self.three_prime:
+                # one round removes the adapter, the next the tail before it
+                cmd.append('--times=2')
+
+        if self.is_paired() and not (self.three_prime or self.five_prime or self.poly_a):
+            # without adapter options cutadapt would only trim read 1
+            cmd.append('--pair-filter=any')
+
+        if self._use_no_indels():
+            cmd.append('--no-indels')
+
+        if self.quality_base:
+            cmd.append('--quality-base=' + str(self.quality_base))
+
+        if self.nextseq_trim:
+            cmd.append('--nextseq-trim=' + str(self.nextseq_trim))
+
+        if self.quality_cutoff and any(self.quality_cutoff):
+            cmd.append('--quality-cutoff=' + ','.join(str(c) for c in self.quality_cutoff))
 
         if self.err_tolerance:
             cmd.append('--error-rate=' + str(self.err_tolerance))
@@ -94,75 +599,452 @@ class CutadaptRunner:
         if self.min_read_length:
             cmd.append('--minimum-length=' + str(self.min_read_length))
 
+        if self.max_read_length:
+            cmd.append('--maximum-length=' + str(self.max_read_length))
+
+        if self.max_n is not None:
+            cmd.append('--max-n=' + ('%g' % self.max_n))
+
         if int(self.discard_untrimmed) == 1:
             cmd.append('--discard-untrimmed')
 
+        if self.cores > 1:
+            cmd.append('--cores=' + str(self.cores))
+
+
+    def _use_no_indels(self):
+        if self.no_indels is not None:
+            return self.no_indels == 1
+        # cutadapt 2.0 and later build an index of anchored 5' adapters
+        # when indels are off, so many barcodes cost about as much as one
+        if len(self.five_prime) < 2 or \
+                not all(a.startswith('^') for a in self.five_prime):
+            return False
+        try:
+            major = int(self.cutadapt_version().split('.')[0])
+        except (ValueError, OSError, subprocess.CalledProcessError):
+            return False
+        return major >= 2
+
+    def _compile_adapters(self, adapter_dir):
+        """
+        Writes the adapters of each end that has more than one to a FASTA
+        file in adapter_dir, once per run, for every cutadapt process of the
+        run to read.
+        """
+        self._adapter_files = {}
+        for adapters, option, name in [(self.three_prime, '-a', '3P'),
+                                       (self.five_prime, '-g', '5P')]:
+            if len(adapters) < 2:
+                continue
+            path = os.path.join(adapter_dir, 'adapters_' + name + '.fasta')
+            with open(path, 'w') as f:
+                for i, sequence in enumerate(adapters):
+                    f.write('>adapter_' + name + '_' + str(i + 1) + '\n' + sequence + '\n')
+            self._adapter_files[option] = path
 
     def run(self):
+        if not self.input_filename:
+            raise ValueError('Input filename must be set to run cutadapt')
+        adapter_dir = None
+        if len(self.three_prime) > 1 or len(self.five_prime) > 1:
+            adapter_dir = tempfile.mkdtemp(prefix='cutadapt_adapters_', dir=self.scratch)
+            self._compile_adapters(adapter_dir)
+        try:
+            return self._run_compressed()
+        finally:
+            if adapter_dir:
+                shutil.rmtree(adapter_dir, ignore_errors=True)
+
+    def _run_compressed(self):
+        self.compression_stats = None
+        if self.compression == 'none' or not self.output_filename:
+            return self._run(self.output_filename, self.paired_output_filename)
+
+        command = OutputCompression.compressor_command(
+            self.compression, self.compression_level, self.compression_threads)
+        fifo_dir = tempfile.mkdtemp(prefix='cutadapt_compress_', dir=self.scratch)
+        # plain names, so cutadapt doesn't compress the output itself
+        compressors = [OutputCompression.OutputCompressor(command, path,
+                                                          os.path.join(fifo_dir, name + '.fq'))
+                       for path, name in [(self.output_filename, 'fwd'),
+                                          (self.paired_output_filename, 'rev')] if path]
+        start = time.time()
+        try:
+            report = self._run(*[c.fifo for c in compressors] + [None] * (2 - len(compressors)))
+        finally:
+            for c in compressors:
+                c.finish()
+            shutil.rmtree(fifo_dir, ignore_errors=True)
+        seconds = time.time() - start
+        for c in compressors:
+            if c.error:
+                raise ValueError('Error compressing ' + c.path + ': ' + str(c.error))
+
+        bytes_in = sum(c.bytes_in for c in compressors)
+        bytes_out = sum(c.bytes_out() for c in compressors)
+        level = self.compression_level or OutputCompression.DEFAULT_LEVELS[self.compression]
+        threads = 1 if command[0] == 'gzip' else self.compression_threads
+        self.compression_stats = {'compression': self.compression,
+                                  'compressor': command[0],
+                                  'level': int(level),
+                                  'threads': threads,
+                                  'bytes_in': bytes_in,
+                                  'bytes_out': bytes_out,
+                                  'seconds': seconds}
+        summary = ('Output compressed with ' + command[0] + ' (level ' + str(level) + ', ' +
+                   str(threads) + (' thread' if threads == 1 else ' threads') + ') while ' +
+                   'trimming: ' + str(bytes_in) + ' -> ' + str(bytes_out) + ' bytes')
+        if bytes_in:
+            summary += ' (' + str(int(round(100.0 * (bytes_in - bytes_out) / bytes_in))) + \
+                       '% less to write to scratch and upload)'
+        summary += ', trimmed and compressed in ' + '%.1f' % seconds + ' s\n'
+        log(summary.strip())
+        return report + summary + '\n'
+
+    def _run(self, output_filename, paired_output_filename):
+        chunk_ranges = self._chunk_ranges()
+        if chunk_ranges:
+            return self._run_chunked(chunk_ranges, output_filename)
+
         cmd = [self.CUTADAPT]
 
         self._build_adapter_removal_options(cmd)
 
-        if self.output_filename:
+        if output_filename:
             cmd.append('-o')
-            cmd.append(self.output_filename)
+            cmd.append(output_filename)
+        if paired_output_filename:
+            cmd.append('-p')
+            cmd.append(paired_output_filename)
 
-        if not self.input_filename:
-            raise ValueError('Input filename must be set to run cutadapt')
         cmd.append(self.input_filename)
+        if self.paired_input_filename:
+            cmd.append(self.paired_input_filename)
 
-        log('running cutadapt:')
+        log('running cutadapt (' + self.engine + ' engine):')
         log('    ' + ' '.join(cmd))
 
+        returncode = None
+        if self.engine == 'inprocess':
+            returncode, output = get_worker_pool().run(cmd[1:], self.scratch)
+            if returncode is None:
+                log(output)
+                log('cutadapt python API unavailable, falling back to subprocess engine')
+            else:
+                output = output.splitlines(True)
+                for line in output:
+                    log(line.replace('\n', ''))
+        if returncode is None:
+            returncode, output = self._run_subprocess(cmd)
+
+        log('process return code: ' + str(returncode))
+        if returncode != 0:
+            raise ValueError('Error running cutadapt, return code: ' +
+                             str(returncode) + '\n')
+        self.stats = parse_cutadapt_report(output)
+        return ('Cutadapt cores used: ' + str(self.cores) + '\n' +
+                ''.join(output) + '\n\n')
+
+    def _chunk_ranges(self):
+        """Byte ranges to trim in parallel, or None to trim the input in one run."""
+        if self.chunks < 2 or not self.chunk_min_bytes:
+            return None
+        # chunks are cut out of a single plain file by offset, so compressed
+        # input, FIFOs and separate R1/R2 files are trimmed in one run
+        if self.paired_input_filename or not os.path.isfile(self.input_filename):
+            return None
+        if os.path.splitext(self.input_filename)[1] in ['.gz', '.bz2', '.xz']:
+            return None
+        if os.path.getsize(self.input_filename) < self.chunk_min_bytes:
+            return None
+        ranges = fastq_chunk_ranges(self.input_filename, self.chunks, self.interleaved)
+        if not ranges or len(ranges) < 2:
+            log('input could not be split into record-aligned chunks, trimming it in one run')
+            return None
+        return ranges
+
+    def _run_chunked(self, chunk_ranges, output_filename):
+        """
+        Trims each byte range of the input with its own single-core cutadapt
+        process reading from stdin, then concatenates the chunk outputs in
+        input order and sums their statistics.  Trimming and filtering act on
+        each read (or pair) alone, so the merged output is the same as that
+        of a single run.
+        """
+        cores = self.cores
+        self.cores = 1
+        cmd = [self.CUTADAPT]
+        self._build_adapter_removal_options(cmd)
+        self.cores = cores
+
+        chunk_dir = tempfile.mkdtemp(prefix='cutadapt_chunks_', dir=self.scratch)
+        results = [None] * len(chunk_ranges)
+
+        def feed(p, start, end):
+            try:
+                copy_range(self.input_filename, start, end, p.stdin)
+            except IOError:
+                # cutadapt exited early; its return code reports why
+                pass
+            finally:
+                try:
+                    p.stdin.close()
+                except IOError:
+                    pass
+
+        def run_chunk(i):
+            start, end = chunk_ranges[i]
+            chunk_output = os.path.join(chunk_dir, 'chunk_' + str(i) + '.fq')
+            p = subprocess.Popen(cmd + ['-o', chunk_output, '-'],
+                                 cwd=self.scratch,
+                                 stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT,
+                                 shell=False)
+            feeder = threading.Thread(target=feed, args=(p, start, end))
+            feeder.start()
+            output = p.stdout.readlines()
+            p.stdout.close()
+            p.wait()
+            feeder.join()
+            results[i] = (p.returncode, output, chunk_output)
+
+        log('running cutadapt on ' + str(len(chunk_ranges)) + ' chunks of ' +
+            self.input_filename + ':')
+        log('    ' + ' '.join(cmd + ['-o', '<chunk output>', '-']))
+        try:
+            threads = [threading.Thread(target=run_chunk, args=(i,))
+                       for i in range(len(chunk_ranges))]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            for i, (returncode, output, _) in enumerate(results):
+                log('chunk ' + str(i) + ' return code: ' + str(returncode))
+                if returncode != 0:
+                    for line in output:
+                        log(line.replace('\n', ''))
+                    raise ValueError('Error running cutadapt on chunk ' + str(i) +
+                                     ', return code: ' + str(returncode) + '\n')
+
+            with open(output_filename, 'wb') as merged:
+                # output_filename may be an output compressor's FIFO
+                OutputCompression.set_cloexec(merged)
+                for _, _, chunk_output in results:
+                    with open(chunk_output, 'rb') as f:
+                        shutil.copyfileobj(f, merged, 1024 * 1024)
+                    os.remove(chunk_output)
+        finally:
+            shutil.rmtree(chunk_dir, ignore_errors=True)
+
+        self.stats = sum_cutadapt_stats([parse_cutadapt_report(output)
+                                         for _, output, _ in results])
+        report = ['Cutadapt cores used: ' + str(len(chunk_ranges)) + '\n',
+                  'Input trimmed as ' + str(len(chunk_ranges)) +
+                  ' record-aligned chunks, in parallel\n\n']
+        for i, (_, output, _) in enumerate(results):
+            start, end = chunk_ranges[i]
+            report.append('=== Chunk ' + str(i + 1) + ' (input bytes ' + str(start) +
+                          '-' + str(end) + ') ===\n')
+            report.extend(output)
+            report.append('\n')
+        for line in report:
+            log(line.replace('\n', ''))
+        return ''.join(report) + '\n'
+
+    def _run_subprocess(self, cmd):
         p = subprocess.Popen(cmd,
                              cwd=self.scratch,
                              stdout=subprocess.PIPE,
                              stderr=subprocess.STDOUT,
                              shell=False)
 
-        report = ''
+        output = []
         while True:
             line = p.stdout.readline()
             if not line:
                 break
-            report += line
+            output.append(line)
             log(line.replace('\n', ''))
 
         p.stdout.close()
         p.wait()
-        report += "\n\n"
-        log('process return code: ' + str(p.returncode))
-        if p.returncode != 0:
-            raise ValueError('Error running cutadapt, return code: ' +
-                             str(p.returncode) + '\n')
-        return report
+        return p.returncode, output
 
 
 class CutadaptUtil:
 
-    def __init__(self, config):
-        pprint(config)
+    def __init__(self, config, token=None, clients=None):
         self.scratch = config['scratch']
         self.callbackURL = config['SDK_CALLBACK_URL']
-
-
-    def remove_adapters(self, params):
+        self.workspaceURL = config.get('workspace-url')
+        self.token = token
+        # shared with the other libraries of the same request
+        self.clients = clients or ClientRegistry(config, token)
+        self.default_stream_input = int(config.get('stream-input') or 0)
+        self.default_compressed_input = int(config.get('compressed-input') or 0)
+        self.default_split_paired_end = int(config.get('split-paired-end') or 0)
+        self.default_cores = int(config.get('cutadapt-cores') or 0)
+        self.chunk_threshold_mb = int(config.get('chunk-threshold-mb') or 0)
+        self.engine = config.get('cutadapt-engine') or 'subprocess'
+        self.default_output_compression = config.get('output-compression') or 'none'
+        self.default_output_compression_level = config.get('output-compression-level') or None
+        self.auto_detect_reads = int(config.get('auto-detect-reads') or 50000)
+        self.result_cache = None
+        if config.get('result-cache-dir'):
+            cache_bytes = int(float(config.get('result-cache-size-gb') or 0) * 1024 ** 3)
+            self.result_cache = FileCache(config['result-cache-dir'], cache_bytes)
+        self.download_cache = None
+        if config.get('download-cache-dir'):
+            cache_bytes = int(float(config.get('download-cache-size-gb') or 0) * 1024 ** 3)
+            self.download_cache = FileCache(config['download-cache-dir'], cache_bytes)
+
+
+    def remove_adapters(self, params, prestaged=None):
         print ("\nPARAMS:\n"+pformat(params)+"\n")  # DEBUG
 
+        job = self.stage_library(params, prestaged=prestaged)
+        self.trim_library(job)
+        return self.save_library(job)
+
+    def stage_library(self, params, prestaged=None):
+        """
+        Validates params and makes the input reads available to cutadapt,
+        downloaded to scratch or streamed, or already downloaded by
+        prestage_libraries() if prestaged is given.  Returns the job dict that
+        trim_library() and save_library() carry on with.  The prestaged
+        files of a library that fails here are removed.
+        """
+        ca = CutadaptRunner(self.scratch, engine=self.engine)
+        job = {'params': params,
+               'runner': ca,
+               'prestaged': prestaged,
+               'input_file_info': None,
+               'streams': [],
+               'output_file': None,
+               'output_rev_file': None,
+               'report': None,
+               'cache_key': None,
+               'cached': None,
+               'detection': None}
+        try:
+            return self._stage_job(job)
+        except Exception:
+            self.cleanup_library(job)
+            raise
+
+    def _stage_job(self, job):
+        params = job['params']
+        prestaged = job['prestaged']
+        ca = job['runner']
         self.validate_remove_adapters_parameters(params)
 
-        ca = CutadaptRunner(self.scratch)
-        input_file_info = self._stage_input_file(ca, params['input_reads'], params['reads_type'])
-        output_file = os.path.join(self.scratch, params['output_object_name'] + '.fq')
-        ca.set_output_file(output_file)
+        if self.result_cache:
+            job['cache_key'], input_ref = self._result_cache_key(params)
+            job['cached'] = self.result_cache.get(job['cache_key'])
+            if job['cached'] and not job['cached']['files'] and \
+                    not self._readable(job['cached']['output_reads_ref']):
+                # nothing left to reuse, so trim it again and replace the entry
+                job['cached'] = None
+            if job['cached']:
+                log('result cache hit for ' + input_ref + ', reusing ' +
+                    str(job['cached']['output_reads_ref']))
+                self.cleanup_library(job, outputs=False)
+                return job
+            log('result cache miss for ' + input_ref)
+
+        streams = []
+        input_file_info = None
+        # detection reads the start of the files before cutadapt does, so
+        # they're staged rather than streamed
+        if prestaged is None and params.get('stream_input', self.default_stream_input) and \
+                not params.get('auto_detect'):
+            input_file_info, streams = self._stream_input_files(ca, params['input_reads'],
+                                                                params['reads_type'])
+        if input_file_info is None:
+            input_file_info = self._stage_input_file(
+                ca, params['input_reads'], params['reads_type'],
+                split_paired_end=params.get('split_paired_end', self.default_split_paired_end),
+                prestaged=prestaged,
+                compressed=params.get('compressed_input', self.default_compressed_input))
         self._build_run(ca, params)
-        report = ca.run()
-
-        return self._package_result(output_file,
-                                    params['output_object_name'],
-                                    params['output_workspace'],
-                                    input_file_info,
-                                    report)
+        if params.get('auto_detect'):
+            job['detection'] = self._detect_adapters(ca)
+        suffix = '.fq' + OutputCompression.SUFFIXES[ca.compression]
+        output_file = os.path.join(self.scratch, params['output_object_name'] + suffix)
+        ca.set_output_file(output_file)
+        output_rev_file = None
+        if input_file_info['files']['type'] == 'paired':
+            output_file = os.path.join(self.scratch, params['output_object_name'] + '.fwd' + suffix)
+            output_rev_file = os.path.join(self.scratch, params['output_object_name'] + '.rev' + suffix)
+            ca.set_output_file(output_file)
+            ca.set_paired_output_file(output_rev_file)
+        job.update({'input_file_info': input_file_info,
+                    'streams': streams,
+                    'output_file': output_file,
+                    'output_rev_file': output_rev_file})
+        return job
+
+    def trim_library(self, job):
+        """Runs cutadapt on a job from stage_library()."""
+        if job['cached']:
+            return job
+        streams = job['streams']
+        try:
+            job['report'] = job['runner'].run()
+            if job['detection']:
+                job['report'] = job['detection'] + job['report']
+        finally:
+            for stream in streams:
+                stream.finish()
+            if streams:
+                shutil.rmtree(os.path.dirname(streams[0].path), ignore_errors=True)
+        for stream in streams:
+            if stream.error:
+                raise ValueError('Error streaming input reads ' + str(job['params']['input_reads']) +
+                                 ': ' + str(stream.error))
+        return job
+
+    def save_library(self, job):
+        """Uploads the trimmed reads of a job from trim_library()."""
+        params = job['params']
+        if job['cached']:
+            result = self._reuse_cached_result(job['cache_key'], job['cached'], params)
+        else:
+            result = self._package_result(job['output_file'],
+                                          params['output_object_name'],
+                                          params['output_workspace'],
+                                          job['input_file_info'],
+                                          job['report'],
+                                          job['output_rev_file'])
+            result['stats'] = job['runner'].stats
+            if job['cache_key']:
+                self._store_result(job, result)
+        result['cache_hits'] = 1 if job['cached'] else 0
+        result['cache_misses'] = 1 if job['cache_key'] and not job['cached'] else 0
+        return result
+
+    def cleanup_library(self, job, inputs=True, outputs=True):
+        """
+        Removes the staged input and/or the trimmed output files of a job
+        from scratch.  A job can also be just {'prestaged': data info}, for
+        a library staged by prestage_libraries() that was never run.
+        """
+        ca = job.get('runner')
+        prestaged = job.get('prestaged')
+        paths = []
+        if inputs and not job.get('streams'):
+            if ca:
+                paths += [ca.input_filename, ca.paired_input_filename]
+            if prestaged:
+                paths += [prestaged['files'].get('fwd'), prestaged['files'].get('rev')]
+        if outputs:
+            paths += [job.get('output_file'), job.get('output_rev_file')]
+        for path in paths:
+            if path and os.path.isfile(path):
+                os.remove(path)
 
     def validate_remove_adapters_parameters(self, params):
         # check for required parameters
@@ -173,41 +1055,106 @@ class CutadaptUtil:
         adapter_found = False
         if 'five_prime' in params and params['five_prime'] != None:
             adapter_found = True
-            if 'adapter_sequence_5P' not in params['five_prime']:
+            if not any(k + '_5P' in params['five_prime'] for k in
+                       ['adapter_sequence', 'adapter_sequences', 'adapter_fasta']):
                 raise ValueError('"five_prime.adapter_sequence_5P" was not defined')
+            # fails early on a malformed adapter_fasta
+            self._adapter_sequences(params['five_prime'], '5P')
             if 'anchored_5P' in params['five_prime']:
                 if params['five_prime']['anchored_5P'] not in [0, 1]:
                     raise ValueError('"five_prime.anchored_5P" must be either 0 or 1')
 
         if 'three_prime' in params and params['three_prime'] != None:
             adapter_found = True
-            if 'adapter_sequence_3P' not in params['three_prime']:
+            if not any(k + '_3P' in params['three_prime'] for k in
+                       ['adapter_sequence', 'adapter_sequences', 'adapter_fasta']):
                 raise ValueError('"three_prime.adapter_sequence_3P" was not defined')
+            # fails early on a malformed adapter_fasta
+            self._adapter_sequences(params['three_prime'], '3P')
             if 'anchored_3P' in params['three_prime']:
                 if params['three_prime']['anchored_3P'] not in [0, 1]:
                     raise ValueError('"three_prime.anchored_3P" must be either 0 or 1')
 
-        if not adapter_found:
+        # with auto_detect the adapters may all come from the reads, and
+        # quality and poly-A trimming can run without any
+        trimming = ['auto_detect', 'trim_poly_a', 'quality_cutoff_3P', 'quality_cutoff_5P',
+                    'nextseq_trim']
+        if not adapter_found and not any(params.get(p) for p in trimming):
             raise ValueError ("Must configure at least one of 5' or 3' adapter")
 
+        for p in ['quality_cutoff_3P', 'quality_cutoff_5P', 'nextseq_trim', 'max_read_length']:
+            if params.get(p) is not None and int(params[p]) < 0:
+                raise ValueError('"' + p + '" must not be negative')
+        if params.get('max_n') is not None and float(params['max_n']) < 0:
+            raise ValueError('"max_n" must not be negative')
+        if params.get('quality_base') not in [None, 33, 64]:
+            raise ValueError('"quality_base" must be either 33 or 64')
+        if params.get('trim_poly_a') not in [None, 0, 1]:
+            raise ValueError('"trim_poly_a" must be either 0 or 1')
+
+        if params.get('cores') is not None and int(params['cores']) < 0:
+            raise ValueError('"cores" must be 0 (auto) or a positive number of cores')
+
+        compression = params.get('output_compression') or self.default_output_compression
+        if compression not in OutputCompression.SUFFIXES:
+            raise ValueError('"output_compression" must be one of: ' +
+                             ', '.join(sorted(OutputCompression.SUFFIXES)))
+        level = params.get('output_compression_level')
+        if level and compression in OutputCompression.LEVEL_RANGES:
+            low, high = OutputCompression.LEVEL_RANGES[compression]
+            if not low <= int(level) <= high:
+                raise ValueError('"output_compression_level" must be between ' + str(low) +
+                                 ' and ' + str(high) + ' for ' + compression)
+
+        if params.get('no_indels') not in [None, 0, 1]:
+            raise ValueError('"no_indels" must be either 0 or 1')
+
+        if params.get('auto_detect') not in [None, 0, 1]:
+            raise ValueError('"auto_detect" must be either 0 or 1')
+
         # TODO: validate values of error_tolerance and min_overlap_length
 
+    def _detect_adapters(self, cutadapt_runner):
+        """
+        Looks for known adapters in the first reads of the staged input and
+        sets the best supported one for each end the params left unset.
+        Returns the detection's report text.
+        """
+        paths = [cutadapt_runner.input_filename, cutadapt_runner.paired_input_filename]
+        paths = [path for path in paths if path]
+        if not all(can_sample(path) for path in paths):
+            raise ValueError('Unable to auto-detect adapters in ' + ', '.join(paths) +
+                             ': only plain, gzip or bzip2 FASTQ files can be sampled')
+        detected = AdapterDetector(self.auto_detect_reads).detect(paths)
+        report = detection_report(detected)
+        log(report)
+        if not cutadapt_runner.three_prime and detected['three_prime']:
+            cutadapt_runner.set_three_prime_option(detected['three_prime'][1], 0)
+        if not cutadapt_runner.five_prime and detected['five_prime']:
+            cutadapt_runner.set_five_prime_option(detected['five_prime'][1], 0)
+        trims = cutadapt_runner.poly_a or cutadapt_runner.nextseq_trim or \
+            (cutadapt_runner.quality_cutoff and any(cutadapt_runner.quality_cutoff))
+        if not cutadapt_runner.three_prime and not cutadapt_runner.five_prime and not trims:
+            raise ValueError('No adapter was given and none of the known adapters was ' +
+                             'found in the reads:\n' + report)
+        return report
 
-    def _stage_input_file(self, cutadapt_runner, ref, reads_type):
 
-        ru = ReadsUtils(self.callbackURL)
-        if reads_type == 'KBaseFile.PairedEndLibrary' or 'KBaseAssembly.PairedEndLibrary':
-            input_file_info = ru.download_reads({
-                    'read_libraries': [ref],
-                    'interleaved': 'true'
-                    })['files'][ref]
-        elif reads_type == 'KBaseFile.SingleEndLibrary' or 'KBaseAssembly.SingleEndLibrary':
-            input_file_info = ru.download_reads({
-                    'read_libraries': [ref]
-                    })['files'][ref]
-        else:
-            raise ValueError ("Can't download_reads() for object type: '"+str(reads_type)+"'")
-        input_file_info['input_ref'] = ref
+    def _stage_input_file(self, cutadapt_runner, ref, reads_type, split_paired_end=False,
+                          prestaged=None, compressed=False):
+
+        use_cache = self.download_cache and self.workspaceURL
+        input_file_info = prestaged or None
+        if input_file_info is None and compressed:
+            if use_cache:
+                input_file_info = self._cached_download_reads(ref, reads_type, compressed=True)
+            else:
+                input_file_info = self._download_compressed_reads(ref, reads_type)
+        if input_file_info is None:
+            if use_cache:
+                input_file_info = self._cached_download_reads(ref, reads_type, split_paired_end)
+            else:
+                input_file_info = self._download_reads(ref, reads_type, split_paired_end)
         file_location = input_file_info['files']['fwd']
 
         # DEBUG
@@ -220,25 +1167,295 @@ class CutadaptUtil:
             interleaved = True
         cutadapt_runner.set_interleaved(interleaved)
         cutadapt_runner.set_input_file(file_location)
+        if input_file_info['files']['type'] == 'paired':
+            cutadapt_runner.set_paired_input_file(input_file_info['files']['rev'])
         return input_file_info
 
 
+    def _reads_utils(self, method, params):
+        """
+        Runs a ReadsUtils method as a callback job with the request's shared
+        ReadsUtils client.  Its state is polled by one loop together with the
+        other libraries' jobs, rather than by a sleep loop in this thread.
+        """
+        reads_utils = AsyncReadsUtils(self.clients.reads_utils())
+        return getattr(reads_utils, method)(params).result()
+
+
+    def _download_reads(self, ref, reads_type, split_paired_end=False):
+
+        if reads_type in ['KBaseFile.PairedEndLibrary', 'KBaseAssembly.PairedEndLibrary']:
+            # split mode skips the interleaving pass in ReadsUtils; cutadapt
+            # then reads and writes separate R1/R2 files
+            input_file_info = self._reads_utils('download_reads', {
+                    'read_libraries': [ref],
+                    'interleaved': 'false' if split_paired_end else 'true'
+                    })['files'][ref]
+        elif reads_type in ['KBaseFile.SingleEndLibrary', 'KBaseAssembly.SingleEndLibrary']:
+            input_file_info = self._reads_utils('download_reads', {
+                    'read_libraries': [ref]
+                    })['files'][ref]
+        else:
+            raise ValueError ("Can't download_reads() for object type: '"+str(reads_type)+"'")
+        input_file_info['input_ref'] = ref
+        return input_file_info
+
+
+    def _download_compressed_reads(self, ref, reads_type):
+        """
+        Copies the stored files of a library from Shock to scratch as they
+        are, so gzip, bzip2 and xz files stay compressed and cutadapt
+        decompresses them as it reads them (gzip in a separate process).  The
+        forward and reverse files are fetched in parallel.  Returns None when
+        the library can't be fetched this way, so the caller stages it with
+        download_reads instead.
+        """
+        if not self.token or not self.workspaceURL:
+            log('no token or workspace url to fetch compressed input with, staging it instead')
+            return None
+        sru = ShockReadsUtil(self.workspaceURL, self.token, ws=self.clients.workspace())
+        input_file_info = sru.get_reads_files(ref, reads_type)
+        if input_file_info is None:
+            log("can't fetch reads of type " + str(reads_type) + ' compressed, staging them instead')
+            return None
+        handles = input_file_info.pop('handles')
+        paths = [os.path.join(self.scratch, 'compressed_' + uuid.uuid4().hex + '_' + name + '_' +
+                              ShockReadsUtil.stored_file_name(handle))
+                 for handle, name in zip(handles, ['fwd', 'rev'])]
+        downloads = [sru.start_download(handle, path) for handle, path in zip(handles, paths)]
+        for download in downloads:
+            download.join()
+        errors = [download.error for download in downloads if download.error]
+        if errors:
+            for path in paths:
+                if os.path.isfile(path):
+                    os.remove(path)
+            raise ValueError('Error fetching the stored reads of ' + str(ref) + ': ' + str(errors[0]))
+        log('fetched ' + str(sum(download.bytes for download in downloads)) +
+            ' bytes of stored reads for ' + str(ref) + ' without decompressing them')
+        input_file_info['files']['fwd'] = paths[0]
+        if len(paths) > 1:
+            input_file_info['files']['rev'] = paths[1]
+        return input_file_info
+
+
+    def _cached_download_reads(self, ref, reads_type, split_paired_end=False, compressed=False):
+        """
+        _download_reads(), or _download_compressed_reads() if compressed,
+        through the download cache, keyed by the absolute ref and file
+        layout.  Concurrent misses on the same library wait for one download.
+        Returns the data info with the files linked into scratch, so the job
+        can remove them like downloaded files, or None if a compressed
+        download isn't possible.
+        """
+        key = self._download_cache_key(ref, split_paired_end, compressed=compressed)
+        key_lock = self.download_cache.key_lock(key)
+        try:
+            input_file_info = self._from_download_cache(key, ref)
+            if input_file_info is None:
+                log('download cache miss for ' + str(ref))
+                if compressed:
+                    input_file_info = self._download_compressed_reads(ref, reads_type)
+                else:
+                    input_file_info = self._download_reads(ref, reads_type, split_paired_end)
+                if input_file_info is not None:
+                    input_file_info = self._add_to_download_cache(key, input_file_info)
+        finally:
+            key_lock.close()
+        return input_file_info
+
+
+    def _download_cache_key(self, ref, split_paired_end, absolute_ref=None, compressed=False):
+        if absolute_ref is None:
+            absolute_ref = self._absolute_ref(ref)
+        if compressed:
+            # the files as stored, in whatever layout the object has
+            return cache_key(absolute_ref, 'stored')
+        return cache_key(absolute_ref, 'split' if split_paired_end else 'interleaved')
+
+
+    def _from_download_cache(self, key, ref):
+        """Data info of a cached download with its files linked into scratch, or None."""
+        entry = self.download_cache.get(key)
+        if not entry or not entry['files']:
+            return None
+        log('download cache hit for ' + str(ref))
+        input_file_info = dict(entry['data_info'])
+        input_file_info['files'] = dict(input_file_info['files'])
+        paths = self._link_cached_files(entry, self.scratch)
+        input_file_info['input_ref'] = ref
+        input_file_info['files']['fwd'] = paths[0]
+        if len(paths) > 1:
+            input_file_info['files']['rev'] = paths[1]
+        return input_file_info
+
+
+    def _add_to_download_cache(self, key, input_file_info):
+        """Moves a download into the cache and returns its data info as a cache hit."""
+        files = [input_file_info['files'][k] for k in ['fwd', 'rev']
+                 if input_file_info['files'].get(k)]
+        data_info = dict(input_file_info)
+        data_info['files'] = {'type': input_file_info['files']['type']}
+        if not self.download_cache.put(key, {'data_info': data_info}, files, move=True):
+            # too big for the cache, so use the download as it is
+            return input_file_info
+        return self._from_download_cache(key, input_file_info['input_ref'])
+
+
+    def prestage_libraries(self, refs, reads_types, split_paired_end=False):
+        """
+        Downloads the libraries in refs with a single download_reads call,
+        skipping those in the download cache, and returns their data info by
+        ref for stage_library().  Libraries of types download_reads doesn't
+        take, or that fail to download here, are left out so that they are
+        staged, and fail, on their own.
+        """
+        stageable = ['KBaseFile.PairedEndLibrary', 'KBaseAssembly.PairedEndLibrary',
+                     'KBaseFile.SingleEndLibrary', 'KBaseAssembly.SingleEndLibrary']
+        staged = {}
+        keys = {}
+        to_download = []
+        use_cache = self.download_cache and self.workspaceURL
+        if use_cache:
+            # look up the object versions of the whole batch at once
+            ws = AsyncWorkspace(self.clients.workspace())
+            infos = dict((ref, ws.get_object_info3({'objects': [{'ref': ref}]}))
+                         for ref, reads_type in zip(refs, reads_types) if reads_type in stageable)
+        for ref, reads_type in zip(refs, reads_types):
+            if reads_type not in stageable or ref in keys:
+                continue
+            keys[ref] = None
+            if use_cache:
+                try:
+                    absolute_ref = self._format_ref(infos[ref].result()['infos'][0])
+                    keys[ref] = self._download_cache_key(ref, split_paired_end, absolute_ref)
+                except Exception as e:
+                    log('unable to resolve ' + str(ref) + ': ' + str(e))
+                    continue
+                key_lock = self.download_cache.key_lock(keys[ref])
+                try:
+                    input_file_info = self._from_download_cache(keys[ref], ref)
+                finally:
+                    key_lock.close()
+                if input_file_info:
+                    staged[ref] = input_file_info
+                    continue
+            to_download.append(ref)
+        if not to_download:
+            return staged
+
+        log('downloading ' + str(len(to_download)) + ' libraries in one call')
+        try:
+            files = self._reads_utils('download_reads', {
+                    'read_libraries': to_download,
+                    'interleaved': 'false' if split_paired_end else 'true'
+                    })['files']
+        except Exception as e:
+            log('bulk download failed, staging the libraries one by one: ' + str(e))
+            return staged
+
+        for ref in to_download:
+            input_file_info = files[ref]
+            input_file_info['input_ref'] = ref
+            if keys[ref]:
+                key_lock = self.download_cache.key_lock(keys[ref])
+                try:
+                    input_file_info = self._add_to_download_cache(keys[ref], input_file_info)
+                finally:
+                    key_lock.close()
+            staged[ref] = input_file_info
+        return staged
+
+
+    def _link_cached_files(self, entry, target_dir):
+        """
+        Links (or copies) the files of a cache entry into target_dir under
+        unique names, and returns the new paths in order.  The links keep the
+        data readable if the entry is evicted while it's being used.
+        """
+        paths = []
+        for f in entry['files']:
+            path = os.path.join(target_dir, 'cached_' + uuid.uuid4().hex + '_' +
+                                os.path.basename(f).split('_', 1)[-1])
+            try:
+                os.link(f, path)
+            except OSError:
+                shutil.copyfile(f, path)
+            paths.append(path)
+        return paths
+
+
+    def _stream_input_files(self, cutadapt_runner, ref, reads_type):
+        """
+        Feeds the stored read files from Shock straight into cutadapt through
+        FIFOs, so trimming starts while the data is still arriving and the
+        input never takes up scratch space.  Returns (None, []) when the
+        library can't be streamed, so the caller stages it with ReadsUtils.
+        """
+        if not self.token or not self.workspaceURL:
+            log('no token or workspace url to stream input with, staging it instead')
+            return None, []
+        sru = ShockReadsUtil(self.workspaceURL, self.token, ws=self.clients.workspace())
+        input_file_info = sru.get_reads_files(ref, reads_type)
+        if input_file_info is None:
+            log("can't stream reads of type " + str(reads_type) + ', staging them instead')
+            return None, []
+        if not all(ShockReadsUtil.can_stream(h) for h in input_file_info['handles']):
+            log("can't stream the compression used by " + str(ref) + ', staging it instead')
+            return None, []
+
+        fifo_dir = tempfile.mkdtemp(prefix='cutadapt_stream_', dir=self.scratch)
+        paths = []
+        for basename in ['fwd', 'rev'][:len(input_file_info['handles'])]:
+            path = os.path.join(fifo_dir, basename + '.fq')
+            os.mkfifo(path)
+            paths.append(path)
+        streams = [sru.start_stream(handle, path)
+                   for handle, path in zip(input_file_info['handles'], paths)]
+
+        cutadapt_runner.set_interleaved(input_file_info['files']['type'] == 'interleaved')
+        cutadapt_runner.set_input_file(paths[0])
+        if len(paths) == 2:
+            cutadapt_runner.set_paired_input_file(paths[1])
+        return input_file_info, streams
+
+
+    @staticmethod
+    def _adapter_sequences(options, end):
+        """
+        The adapters of a FivePrimeOptions or ThreePrimeOptions (end '5P' or
+        '3P'): adapter_sequence_<end>, then adapter_sequences_<end>, then
+        the records of the adapter_fasta_<end> text.
+        """
+        sequences = []
+        if options.get('adapter_sequence_' + end):
+            sequences.append(options['adapter_sequence_' + end])
+        sequences.extend(s for s in options.get('adapter_sequences_' + end) or [] if s)
+        fasta = options.get('adapter_fasta_' + end)
+        if fasta:
+            records = parse_adapter_fasta(fasta)
+            if not records:
+                raise ValueError('"adapter_fasta_' + end + '" holds no FASTA records')
+            sequences.extend(seq for _, seq in records)
+        return [s.strip() for s in sequences]
+
     def _build_run(self, cutadapt_runner, params):
-        if 'five_prime' in params:
-            seq = params['five_prime']['adapter_sequence_5P']
-            if seq:
-                anchored = 1
-                if 'anchored_5P' in params['five_prime'] and params['five_prime'] != None:
-                    anchored = params['five_prime']['anchored_5P']
-                cutadapt_runner.set_five_prime_option(seq, anchored)
+        if 'five_prime' in params and params['five_prime'] != None:
+            anchored = 1
+            if 'anchored_5P' in params['five_prime']:
+                anchored = params['five_prime']['anchored_5P']
+            for seq in self._adapter_sequences(params['five_prime'], '5P'):
+                cutadapt_runner.add_five_prime_option(seq, anchored)
 
         if 'three_prime' in params and params['three_prime'] != None:
-            seq = params['three_prime']['adapter_sequence_3P']
-            if seq:
-                anchored = 0
-                if 'anchored_3P' in params['three_prime']:
-                    anchored = params['three_prime']['anchored_3P']
-                cutadapt_runner.set_three_prime_option(seq, anchored)
+            anchored = 0
+            if 'anchored_3P' in params['three_prime']:
+                anchored = params['three_prime']['anchored_3P']
+            for seq in self._adapter_sequences(params['three_prime'], '3P'):
+                cutadapt_runner.add_three_prime_option(seq, anchored)
+
+        if params.get('no_indels') is not None:
+            cutadapt_runner.set_no_indels(params['no_indels'])
 
         if 'error_tolerance' in params:
             cutadapt_runner.set_error_tolerance(params['error_tolerance'])
@@ -252,12 +1469,151 @@ class CutadaptUtil:
         if 'discard_untrimmed' in params:
             cutadapt_runner.set_discard_untrimmed(params['discard_untrimmed'])
 
-
-    def _package_result(self, output_file, output_name, ws_name_or_id, data_info, report):
+        # quality, N and length filtering run in the same pass as the adapters
+        if params.get('max_read_length'):
+            cutadapt_runner.set_max_read_length(params['max_read_length'])
+
+        if params.get('quality_cutoff_3P') or params.get('quality_cutoff_5P'):
+            cutadapt_runner.set_quality_cutoff(params.get('quality_cutoff_3P'),
+                                               params.get('quality_cutoff_5P'))
+
+        if params.get('quality_base'):
+            cutadapt_runner.set_quality_base(params['quality_base'])
+
+        if params.get('nextseq_trim'):
+            cutadapt_runner.set_nextseq_trim(params['nextseq_trim'])
+
+        if params.get('max_n') is not None:
+            cutadapt_runner.set_max_n(params['max_n'])
+
+        if params.get('trim_poly_a'):
+            cutadapt_runner.set_poly_a_trim(params['trim_poly_a'])
+
+        # 0 or unset means size from the container's cpu allowance
+        cores = params.get('cores') or self.default_cores
+        if not cores:
+            cores = get_available_cores()
+        cutadapt_runner.set_cores(cores)
+        # chunks run as separate processes, so they can use the cores even
+        # where cutadapt's own multi-core mode is unavailable
+        cutadapt_runner.set_chunking(cores, self.chunk_threshold_mb * 1024 * 1024)
+
+        # the compressor runs next to cutadapt, on the same cores
+        cutadapt_runner.set_output_compression(
+            params.get('output_compression') or self.default_output_compression,
+            params.get('output_compression_level') or self.default_output_compression_level,
+            cores)
+
+
+    # params that don't change the trimmed reads, left out of the result cache key
+    _UNCACHED_PARAMS = ['input_reads', 'output_workspace', 'output_object_name',
+                        'reads_type', 'cores', 'stream_input', 'compressed_input',
+                        'max_parallel_libraries',
+                        'pipeline_libraries', 'output_compression', 'output_compression_level']
+
+    def _absolute_ref(self, ref):
+        """ws/obj/ver ref of the object ref currently points to."""
+        ws = self.clients.workspace()
+        return self._format_ref(ws.get_object_info3({'objects': [{'ref': ref}]})['infos'][0])
+
+    @staticmethod
+    def _format_ref(info):
+        return str(info[6]) + '/' + str(info[0]) + '/' + str(info[4])
+
+    def _result_cache_key(self, params):
+        """(cache key, absolute input ref) for params."""
+        input_ref = self._absolute_ref(params['input_reads'])
+
+        def normalize(value):
+            if isinstance(value, dict):
+                return dict((k, normalize(v)) for k, v in value.items() if v is not None)
+            if isinstance(value, bool):
+                return int(value)
+            return value
+
+        trim_params = dict((k, v) for k, v in normalize(params).items()
+                           if k not in self._UNCACHED_PARAMS)
+        return cache_key(input_ref, trim_params, CutadaptRunner.cutadapt_version()), input_ref
+
+    def _readable(self, ref):
+        ws = self.clients.workspace()
+        infos = ws.get_object_info3({'objects': [{'ref': ref}], 'ignoreErrors': 1})['infos']
+        return bool(infos and infos[0])
+
+    def _store_result(self, job, result):
+        files = [f for f in [job['output_file'], job['output_rev_file']] if f]
+        data_info = dict((k, v) for k, v in job['input_file_info'].items()
+                         if k not in ['files', 'handles'])
+        data_info['files'] = {'type': job['input_file_info']['files']['type']}
+        entry = {'output_reads_ref': result['output_reads_ref'],
+                 'report': result['report'],
+                 'stats': result['stats'],
+                 'data_info': data_info}
+        try:
+            self.result_cache.put(job['cache_key'], entry, files)
+        except Exception as e:
+            # a result that can't be cached is still a result
+            log('unable to add ' + str(result['output_reads_ref']) + ' to the result cache: ' + str(e))
+
+    def _reuse_cached_result(self, key, cached, params):
+        """
+        Copies the cached output reads object into the requested workspace,
+        or uploads the cached files again if it can't be copied (e.g. it was
+        deleted or isn't readable with this token).
+        """
+        ws_name_or_id = params['output_workspace']
+        target = {'name': params['output_object_name']}
+        if str(ws_name_or_id).isdigit():
+            target['wsid'] = int(ws_name_or_id)
+        else:
+            target['workspace'] = str(ws_name_or_id)
+        report = 'Result cache hit: reused trimmed reads ' + str(cached['output_reads_ref']) + '\n\n'
+        report += cached['report']
+        try:
+            ws = self.clients.workspace()
+            info = ws.copy_object({'from': {'ref': cached['output_reads_ref']}, 'to': target})
+            output_reads_ref = str(info[6]) + '/' + str(info[0]) + '/' + str(info[4])
+            return {'report': report,
+                    'output_reads_ref': output_reads_ref,
+                    'stats': cached['stats']}
+        except Exception as e:
+            if not cached['files']:
+                raise ValueError('Unable to reuse cached result ' + str(cached['output_reads_ref']) +
+                                 ': ' + str(e))
+            log('unable to copy ' + str(cached['output_reads_ref']) + ', uploading the cached files: ' + str(e))
+
+        # the callback server can only read files from scratch
+        upload_dir = tempfile.mkdtemp(prefix='cutadapt_cached_', dir=self.scratch)
+        try:
+            key_lock = self.result_cache.key_lock(key)
+            try:
+                entry = self.result_cache.get(key)
+                paths = self._link_cached_files(entry, upload_dir) if entry else []
+            finally:
+                key_lock.close()
+            if not paths:
+                raise ValueError('Cached result ' + str(cached['output_reads_ref']) +
+                                 ' was evicted before it could be reused')
+            result = self._package_result(paths[0],
+                                          params['output_object_name'],
+                                          ws_name_or_id,
+                                          cached['data_info'],
+                                          report,
+                                          paths[1] if len(paths) > 1 else None)
+        finally:
+            shutil.rmtree(upload_dir, ignore_errors=True)
+        result['stats'] = cached['stats']
+        return result
+
+
+    def _package_result(self, output_file, output_name, ws_name_or_id, data_info, report,
+                        output_rev_file=None):
         upload_params = {
             'fwd_file': output_file,
             'name': output_name
         }
+        if output_rev_file:
+            upload_params['rev_file'] = output_rev_file
 
         if str(ws_name_or_id).isdigit():
             upload_params['wsid'] = int(ws_name_or_id)
@@ -273,7 +1629,7 @@ class CutadaptUtil:
             'insert_size_std_dev'
         ]
 
-        if 'input_ref' in data_info and data_info['input_ref'] != None and data_info['sequencing_tech']:
+        if 'input_ref' in data_info and data_info['input_ref'] != None and data_info.get('sequencing_tech'):
             upload_params['source_reads_ref'] = data_info['input_ref']
         else:
             for f in fields:
@@ -293,8 +1649,25 @@ class CutadaptUtil:
         if data_info['files']['type'] == 'interleaved':
             upload_params['interleaved'] = 1
 
-        ru = ReadsUtils(self.callbackURL)
-        result = ru.upload_reads(upload_params)
+        # upload_reads takes gzipped files as they are, so gzip output skips
+        # its compression pass; zstd output only has to be recompressed
+        recompressed = []
+        zst = OutputCompression.SUFFIXES['zstd']
+        try:
+            for k in ['fwd_file', 'rev_file']:
+                if upload_params.get(k, '').endswith(zst):
+                    upload_params[k] = OutputCompression.recompress_to_gzip(
+                        upload_params[k], get_available_cores())
+                    recompressed.append(upload_params[k])
+            start = time.time()
+            result = self._reads_utils('upload_reads', upload_params)
+        finally:
+            for path in recompressed:
+                if os.path.isfile(path):
+                    os.remove(path)
+        if not recompressed and upload_params['fwd_file'].endswith(OutputCompression.SUFFIXES['gzip']):
+            report += ('Compressed output uploaded without recompression in ' +
+                       '%.1f' % (time.time() - start) + ' s\n')
 
         # THE REPORT MUST BE CREATED OUTSIDE SO THAT LIBS AND SETS ARE HANDLED
         """
@@ -321,3 +1694,71 @@ class CutadaptUtil:
             'report': report,
             'output_reads_ref': result['obj_ref']
         }
+
+
+class BatchStager:
+    """
+    Hands out the pre-staged input of each library of a set.  The libraries
+    are downloaded in batches of batch_size through
+    CutadaptUtil.prestage_libraries(), a batch at a time the first time one
+    of its libraries is asked for, so only about a batch is on scratch ahead
+    of the runs.  With the slots of a LibraryPipeline, a batch takes a slot
+    for each of its libraries before it's downloaded, so that its files
+    count towards the pipeline's cap.
+    """
+
+    def __init__(self, cutadapt_util, refs, reads_types, split_paired_end=None, batch_size=50):
+        self.cutadapt_util = cutadapt_util
+        self.refs = refs
+        self.reads_types = reads_types
+        if split_paired_end is None:
+            split_paired_end = cutadapt_util.default_split_paired_end
+        self.split_paired_end = split_paired_end
+        self.batch_size = max(1, int(batch_size))
+        self._staged = {}
+        self._batches = {}
+        self._lock = threading.Lock()
+
+    def get(self, i, slots=None):
+        """
+        Data info for the i-th library, or None if it has to be staged on
+        its own.  The first caller for a batch downloads it, outside the
+        lock, and the other callers for it wait for the download.
+        """
+        batch = i // self.batch_size
+        with self._lock:
+            downloaded = self._batches.get(batch)
+            owner = downloaded is None
+            if owner:
+                downloaded = self._batches[batch] = Future()
+        if owner:
+            staged = {}
+            try:
+                staged = self._download(batch, i, slots)
+            finally:
+                with self._lock:
+                    self._staged.update(staged)
+                downloaded._set()
+        else:
+            downloaded.result()
+        with self._lock:
+            return self._staged.pop(self.refs[i], None)
+
+    def _download(self, batch, i, slots):
+        start = batch * self.batch_size
+        end = min(start + self.batch_size, len(self.refs))
+        if slots:
+            # i holds its slot already, and the libraries of the batch before
+            # it may have been run
+            for j in range(i, end):
+                slots.acquire(j)
+        return self.cutadapt_util.prestage_libraries(
+            self.refs[start:end], self.reads_types[start:end], self.split_paired_end)
+
+    def cleanup(self):
+        """Removes the files of the libraries staged but never handed out."""
+        with self._lock:
+            staged = self._staged.values()
+            self._staged = {}
+        for prestaged in staged:
+            self.cutadapt_util.cleanup_library({'prestaged': prestaged})
@@ -0,0 +1,110 @@
+import os
+
+
+# how far past a split point to look for the start of the next record
+_SCAN_SIZE = 4 * 1024 * 1024
+
+
+def _read_name(header):
+    fields = header[1:].split(None, 1)
+    name = fields[0] if fields else ''
+    if name.endswith('/1') or name.endswith('/2'):
+        name = name[:-2]
+    return name
+
+
+def _is_record_start(lines, k):
+    """True if lines[k] starts a 4-line FASTQ record."""
+    if k + 3 >= len(lines):
+        return False
+    header, seq, plus, qual = [l for _, l in lines[k:k + 4]]
+    return (header.startswith(b'@') and plus.startswith(b'+') and
+            len(seq.rstrip()) == len(qual.rstrip()))
+
+
+def _next_record_start(f, offset, size, interleaved):
+    """
+    Offset of the first record at or after offset, or of the first pair for
+    interleaved files.  Returns size if the file ends first, and None if no
+    boundary can be found with confidence.
+    """
+    if offset <= 0:
+        return 0
+    f.seek(offset - 1)
+    buf = f.read(_SCAN_SIZE)
+    at_eof = offset - 1 + len(buf) >= size
+
+    # (offset, line) for each line that starts at or after offset; only
+    # positions right after a newline can start a record
+    lines = []
+    pos = buf.find(b'\n')
+    while pos != -1:
+        end = buf.find(b'\n', pos + 1)
+        if end == -1:
+            if at_eof and pos + 1 < len(buf):
+                lines.append((offset + pos, buf[pos + 1:]))
+            break
+        lines.append((offset + pos, buf[pos + 1:end]))
+        pos = end
+    if at_eof:
+        lines.append((size, b''))
+
+    for k in range(len(lines)):
+        if lines[k][0] >= size:
+            return size
+        if not _is_record_start(lines, k):
+            continue
+        if not interleaved:
+            return lines[k][0]
+        # the record found may be the second read of a pair, in which case
+        # the next record carries a different name
+        if k + 4 >= len(lines):
+            return None
+        if lines[k + 4][0] >= size:
+            # last record of the file, so the end of the last pair
+            return size
+        if not _is_record_start(lines, k + 4):
+            return None
+        if _read_name(lines[k][1]) == _read_name(lines[k + 4][1]):
+            return lines[k][0]
+        if (k + 8 < len(lines) and _is_record_start(lines, k + 8) and
+                _read_name(lines[k + 4][1]) == _read_name(lines[k + 8][1])):
+            return lines[k + 4][0]
+        # names don't identify the pairs, so we can't tell R1 from R2
+        return None
+    return None
+
+
+def fastq_chunk_ranges(path, chunks, interleaved=False):
+    """
+    Splits an uncompressed FASTQ file into up to `chunks` (start, end) byte
+    ranges that each begin at a record, or at a pair for interleaved files.
+    Returns None if the file doesn't look like plain 4-line FASTQ or the
+    boundaries can't be found reliably.
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        if f.read(1) != b'@':
+            return None
+        offsets = [0]
+        for i in range(1, chunks):
+            start = _next_record_start(f, size * i // chunks, size, interleaved)
+            if start is None:
+                return None
+            if start > offsets[-1] and start < size:
+                offsets.append(start)
+    offsets.append(size)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
+def copy_range(path, start, end, out, buffer_size=1024 * 1024):
+    """Writes bytes [start, end) of path to the file object out."""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            data = f.read(min(buffer_size, remaining))
+            if not data:
+                break
+            out.write(data)
+            remaining -= len(data)
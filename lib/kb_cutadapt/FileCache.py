@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import errno
+import fcntl
+import shutil
+import hashlib
+import tempfile
+
+
+def cache_key(*parts):
+    """
+    Hash of parts (e.g. an absolute input ref, trimming parameters and the
+    cutadapt version), serialized canonically so that the same parts always
+    give the same key.
+    """
+    blob = json.dumps(list(parts), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class FileCache:
+    """
+    Persistent cache of files on local disk, keyed by cache_key().  An entry
+    holds a JSON-able dict and, when they fit under the size cap, a set of
+    files.  Once the files go over max_bytes, or there are more than
+    max_entries entries, the least recently used entries are evicted.
+
+    The index is shared by every process using the cache directory through
+    an exclusive lock on a lock file.  Files are staged next to the cache and
+    renamed into place, so an entry's files are either all there or absent.
+    """
+
+    INDEX = 'index.json'
+    LOCK = 'index.lock'
+
+    def __init__(self, cache_dir, max_bytes, max_entries=10000):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        for d in [cache_dir, os.path.join(cache_dir, 'locks'), os.path.join(cache_dir, 'tmp')]:
+            if not os.path.isdir(d):
+                try:
+                    os.makedirs(d)
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _lock(self, path, blocking=True):
+        lock = open(path, 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lock.close()
+            return None
+        return lock
+
+    def _locked(self):
+        return self._lock(os.path.join(self.cache_dir, self.LOCK))
+
+    def key_lock(self, key, blocking=True):
+        """
+        Exclusive lock on key, released by closing the returned file.  Held
+        while filling an entry, so that concurrent misses on the same key
+        fill it once, and while reading an entry's files, which keeps them
+        from being evicted.  Returns None if blocking is False and the lock
+        is taken.
+        """
+        return self._lock(os.path.join(self.cache_dir, 'locks', key + '.lock'), blocking)
+
+    def _load(self):
+        try:
+            with open(os.path.join(self.cache_dir, self.INDEX)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _save(self, index):
+        path = os.path.join(self.cache_dir, self.INDEX)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(index, f)
+        os.rename(path + '.tmp', path)
+
+    def get(self, key):
+        """
+        The entry for key, or None.  'files' in the returned entry are full
+        paths, and only listed if all of them are still present.
+        """
+        lock = self._locked()
+        try:
+            index = self._load()
+            entry = index.get(key)
+            if entry is None:
+                return None
+            entry['last_used'] = time.time()
+            self._save(index)
+        finally:
+            lock.close()
+        entry = dict(entry)
+        files = [os.path.join(self._entry_dir(key), f) for f in entry.get('files', [])]
+        entry['files'] = files if all(os.path.isfile(f) for f in files) else []
+        return entry
+
+    def put(self, key, entry, files, move=False):
+        """
+        Adds entry under key, keeping each of files if they fit in the cache:
+        moved in if move is set, else linked (or copied).  Files that don't
+        fit are left where they are.  Returns the number of bytes kept.
+        """
+        entry = dict(entry)
+        size = sum(os.path.getsize(f) for f in files)
+        entry['files'] = []
+        entry['size'] = 0
+        entry['last_used'] = time.time()
+
+        staging_dir = None
+        if files and size <= self.max_bytes:
+            staging_dir = tempfile.mkdtemp(dir=os.path.join(self.cache_dir, 'tmp'))
+            for i, f in enumerate(files):
+                name = str(i) + '_' + os.path.basename(f)
+                if move:
+                    shutil.move(f, os.path.join(staging_dir, name))
+                else:
+                    _link_or_copy(f, os.path.join(staging_dir, name))
+                entry['files'].append(name)
+            entry['size'] = size
+
+        entry_dir = self._entry_dir(key)
+        lock = self._locked()
+        try:
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            if staging_dir:
+                if not os.path.isdir(os.path.dirname(entry_dir)):
+                    os.makedirs(os.path.dirname(entry_dir))
+                os.rename(staging_dir, entry_dir)
+            index = self._load()
+            index[key] = entry
+            self._evict(index, keep=key)
+            self._save(index)
+        finally:
+            lock.close()
+        return entry['size']
+
+    def _evict(self, index, keep=None):
+        total = sum(e.get('size', 0) for e in index.values())
+        for key in sorted(index, key=lambda k: index[k].get('last_used', 0)):
+            if total <= self.max_bytes and len(index) <= self.max_entries:
+                break
+            if key == keep:
+                continue
+            # skip entries that are being read or filled right now
+            key_lock = self.key_lock(key, blocking=False)
+            if key_lock is None:
+                continue
+            try:
+                total -= index[key].get('size', 0)
+                shutil.rmtree(self._entry_dir(key), ignore_errors=True)
+                del index[key]
+            finally:
+                key_lock.close()
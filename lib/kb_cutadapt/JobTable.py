@@ -0,0 +1,259 @@
+import os
+import json
+import time
+import uuid
+import errno
+import fcntl
+import threading
+import traceback
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+QUEUED = 'queued'
+RUNNING = 'running'
+COMPLETED = 'completed'
+ERROR = 'error'
+CANCELED = 'canceled'
+
+_FINISHED = [COMPLETED, ERROR, CANCELED]
+
+
+class JobTable:
+    """
+    Runs submitted method calls as jobs on a pool of worker threads, so that
+    callers don't have to hold a connection open for a whole trimming run.
+    The state of each job is kept in a JSON file in state_dir, so that it
+    can be checked from any server process sharing the directory and after a
+    restart.  check() returns the state in the form BaseClient.run_job
+    polls for: {'finished': 0 or 1, 'result': [...]} or, for a failed job,
+    {'finished': 1, 'error': {...}}.
+
+    A queued job can be canceled outright.  A running one can't be stopped
+    safely, so canceling it marks it canceled and its result is discarded
+    when it ends.  A job whose server process has exited without finishing
+    it is reported as failed; a server that stops with jobs still to run
+    marks them failed with abandon().  The state files of jobs that finished,
+    or were abandoned, more than keep_hours ago are removed as new jobs are
+    submitted.
+    """
+
+    LOCK = 'jobs.lock'
+    # seconds between two scans of state_dir for state files to remove
+    PRUNE_INTERVAL = 600
+
+    def __init__(self, state_dir, workers=2, keep_hours=24):
+        self.state_dir = state_dir
+        if not os.path.isdir(state_dir):
+            try:
+                os.makedirs(state_dir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        self.workers = max(1, int(workers))
+        self.keep_hours = float(keep_hours)
+        self._queue = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        # ids of the jobs submitted in this process that haven't ended yet
+        self._active = set()
+        self._pruned = 0
+
+    def _start(self):
+        # started on first use in each process, as a forked server worker
+        # doesn't inherit the threads of the process that created the table
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue()
+            self._active = set()
+            for _ in range(self.workers):
+                t = threading.Thread(target=self._work, args=(self._queue,))
+                t.daemon = True
+                t.start()
+            self._pid = os.getpid()
+
+    def _locked(self):
+        """Exclusive lock on the job states, released by closing the returned file."""
+        lock = open(os.path.join(self.state_dir, self.LOCK), 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def _path(self, job_id):
+        return os.path.join(self.state_dir, job_id + '.json')
+
+    def _load(self, job_id):
+        # job ids come from callers, so only accept ones we could have made
+        try:
+            job_id = str(uuid.UUID(job_id))
+        except (ValueError, TypeError, AttributeError):
+            raise ValueError('Unknown job id: ' + str(job_id))
+        try:
+            with open(self._path(job_id)) as f:
+                return json.load(f)
+        except IOError:
+            raise ValueError('Unknown job id: ' + job_id)
+
+    def _save(self, state):
+        path = self._path(state['job_id'])
+        with open(path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.rename(path + '.tmp', path)
+
+    def _update(self, job_id, **changes):
+        """
+        Applies changes to the job's state unless it has already finished,
+        e.g. been canceled, and returns the state.
+        """
+        with self._locked():
+            state = self._load(job_id)
+            if state['status'] not in _FINISHED:
+                state.update(changes)
+                self._save(state)
+            return state
+
+    def submit(self, method, function, ctx, params):
+        """Queues function(ctx, *params) and returns the new job's id."""
+        job_id = str(uuid.uuid4())
+        with self._locked():
+            self._save({'job_id': job_id,
+                        'method': method,
+                        'user_id': ctx.get('user_id'),
+                        'status': QUEUED,
+                        'pid': os.getpid(),
+                        'submitted': time.time()})
+        self._start()
+        with self._start_lock:
+            self._active.add(job_id)
+        self._queue.put((job_id, function, ctx, params))
+        if time.time() - self._pruned > self.PRUNE_INTERVAL:
+            self._pruned = time.time()
+            self.prune()
+        return job_id
+
+    def active(self):
+        """The number of jobs submitted in this process that haven't ended yet."""
+        with self._start_lock:
+            return len(self._active) if self._pid == os.getpid() else 0
+
+    def abandon(self):
+        """
+        Marks the jobs submitted in this process that haven't ended as
+        failed, for a server that is stopping without waiting for them.
+        """
+        with self._start_lock:
+            job_ids = list(self._active) if self._pid == os.getpid() else []
+        for job_id in job_ids:
+            try:
+                state = self._update(job_id, status=ERROR, finished=time.time(),
+                                     error={'name': 'Server error', 'code': -32000,
+                                            'message': 'the server stopped before job ' +
+                                                       job_id + ' finished',
+                                            'error': ''})
+            except Exception:
+                traceback.print_exc()
+        return len(job_ids)
+
+    def prune(self):
+        """
+        Removes the state files of jobs that finished more than keep_hours
+        ago, and of unfinished ones submitted that long ago by a server
+        process that has since exited.  Returns the number removed.
+        """
+        cutoff = time.time() - self.keep_hours * 3600
+        removed = 0
+        with self._locked():
+            for name in os.listdir(self.state_dir):
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(self.state_dir, name)
+                try:
+                    with open(path) as f:
+                        state = json.load(f)
+                    if state['status'] in _FINISHED:
+                        expired = state.get('finished', 0) < cutoff
+                    else:
+                        expired = (state['submitted'] < cutoff and
+                                   self._process_exited(state['pid']))
+                    if expired:
+                        os.remove(path)
+                        removed += 1
+                except (IOError, OSError, ValueError, KeyError):
+                    # a file being written, or not one of ours
+                    continue
+        return removed
+
+    def _work(self, jobs):
+        while True:
+            job_id, function, ctx, params = jobs.get()
+            try:
+                state = self._update(job_id, status=RUNNING, started=time.time())
+                if state['status'] != RUNNING:
+                    # canceled, or abandoned, while queued
+                    continue
+                try:
+                    result = function(ctx, *params)
+                except Exception as e:
+                    self._update(job_id, status=ERROR, finished=time.time(),
+                                 error={'name': 'Server error',
+                                        'code': -32000,
+                                        'message': str(e),
+                                        'error': traceback.format_exc()})
+                else:
+                    self._update(job_id, status=COMPLETED, finished=time.time(),
+                                 result=result)
+            except Exception:
+                # losing the state file mustn't take the worker down
+                traceback.print_exc()
+            finally:
+                with self._start_lock:
+                    self._active.discard(job_id)
+
+    def _owned(self, job_id, ctx):
+        state = self._load(job_id)
+        if state.get('user_id') != ctx.get('user_id'):
+            raise ValueError('Job ' + job_id + ' was not submitted by ' +
+                             str(ctx.get('user_id')))
+        return state
+
+    @staticmethod
+    def _process_exited(pid):
+        try:
+            os.kill(pid, 0)
+        except OSError as e:
+            return e.errno == errno.ESRCH
+        return False
+
+    def check(self, job_id, ctx):
+        state = self._owned(job_id, ctx)
+        if state['status'] not in _FINISHED and self._process_exited(state['pid']):
+            state = self._update(job_id, status=ERROR, finished=time.time(),
+                                 error={'name': 'Server error', 'code': -32000,
+                                        'message': 'the server process running job ' +
+                                                   job_id + ' exited',
+                                        'error': ''})
+        job_state = {'job_id': state['job_id'],
+                     'status': state['status'],
+                     'finished': 1 if state['status'] in _FINISHED else 0}
+        if state['status'] == COMPLETED:
+            job_state['result'] = state['result']
+        elif state['status'] == ERROR:
+            job_state['error'] = state['error']
+        elif state['status'] == CANCELED:
+            job_state['error'] = {'name': 'Job canceled', 'code': -32000,
+                                  'message': 'job ' + job_id + ' was canceled',
+                                  'error': ''}
+        return job_state
+
+    def cancel(self, job_id, ctx):
+        self._owned(job_id, ctx)
+        with self._locked():
+            state = self._load(job_id)
+            if state['status'] not in _FINISHED:
+                state['status'] = CANCELED
+                state['finished'] = time.time()
+                self._save(state)
+        return self.check(job_id, ctx)
@@ -0,0 +1,115 @@
+import threading
+import traceback
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+# marks the end of the items on a stage's queue
+_DONE = object()
+
+
+class InFlightSlots:
+    """
+    At most max_in_flight slots, each held by one item index.  Taking the
+    slot of an index that already holds one doesn't take another, so an item
+    whose files were staged ahead of it, e.g. by a BatchStager, keeps the
+    slot it was staged with when it enters the pipeline.
+    """
+
+    def __init__(self, max_in_flight):
+        self.max_in_flight = max(1, int(max_in_flight))
+        self._held = set()
+        self._cond = threading.Condition()
+
+    def acquire(self, i):
+        with self._cond:
+            while i not in self._held and len(self._held) >= self.max_in_flight:
+                self._cond.wait()
+            self._held.add(i)
+
+    def release(self, i):
+        with self._cond:
+            if i in self._held:
+                self._held.discard(i)
+                self._cond.notify_all()
+
+    def held(self):
+        with self._cond:
+            return len(self._held)
+
+
+class LibraryPipeline:
+    """
+    Passes items through a sequence of stages, e.g. download, trim and
+    upload, so that different items can be in different stages at the same
+    time.  Each stage has its own worker threads and a bounded queue in front
+    of it, and at most max_in_flight items are between the first stage and
+    the end of the last one, which bounds the files staged on scratch.
+    Stages can take the slots of items further on through self.slots, to
+    count files they stage ahead of those items.
+
+    An item that fails in a stage skips the remaining stages; run() returns
+    a (result, error) pair for every item, in input order, with error being
+    the traceback of the failure.
+    """
+
+    def __init__(self, stages, max_in_flight, queue_size=1):
+        """
+        stages - list of (name, function, workers); each function takes the
+            value returned by the previous stage, the first one takes the item
+        """
+        self.stages = stages
+        self.max_in_flight = max(1, int(max_in_flight))
+        self.queue_size = max(1, int(queue_size))
+        self.slots = InFlightSlots(self.max_in_flight)
+
+    def run(self, items):
+        items = list(items)
+        results = [None] * len(items)
+        queues = [queue.Queue(self.queue_size) for _ in self.stages]
+
+        def finish(i, value, error):
+            results[i] = (value, error)
+            self.slots.release(i)
+
+        def work(stage_i):
+            name, function, _ = self.stages[stage_i]
+            while True:
+                task = queues[stage_i].get()
+                if task is _DONE:
+                    return
+                i, value = task
+                try:
+                    value = function(value)
+                except Exception:
+                    finish(i, None, name + ' failed:\n' + traceback.format_exc())
+                    continue
+                if stage_i + 1 < len(self.stages):
+                    queues[stage_i + 1].put((i, value))
+                else:
+                    finish(i, value, None)
+
+        stage_threads = []
+        for stage_i, (_, _, workers) in enumerate(self.stages):
+            threads = [threading.Thread(target=work, args=(stage_i,))
+                       for _ in range(max(1, int(workers)))]
+            for t in threads:
+                t.daemon = True
+                t.start()
+            stage_threads.append(threads)
+
+        for i, item in enumerate(items):
+            self.slots.acquire(i)
+            queues[0].put((i, item))
+
+        # a stage is done once all its workers have stopped, so nothing more
+        # can reach the next stage's queue
+        for stage_i, threads in enumerate(stage_threads):
+            for _ in threads:
+                queues[stage_i].put(_DONE)
+            for t in threads:
+                t.join()
+        return results
@@ -0,0 +1,265 @@
+"""
+A standalone server for kb_cutadapt that serves requests from several
+forked worker processes, each running several threads, instead of one
+request at a time as the server in kb_cutadaptServer.py does.  It serves
+the application of ServerExtensions, which wraps the one of
+kb_cutadaptServer.py; kb-sdk compile regenerates that file, so the server
+is kept apart from it.
+
+Usage: python -m kb_cutadapt.MultiWorkerServer [--host HOST] [--port PORT]
+           [--workers N] [--threads N] [--backlog N] [--max-requests N]
+           [--shutdown-timeout SECONDS]
+"""
+import os
+import sys
+import time
+import errno
+import select
+import signal
+import socket
+import threading
+import traceback
+from getopt import getopt, GetoptError
+from multiprocessing import Process
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+
+class MultiWorkerServer:
+    """
+    Serves a WSGI application from `workers` forked processes that share
+    one listening socket, with up to `threads` requests in progress in each,
+    so that a long call doesn't hold up status or other callers.
+    Connections beyond those wait in an accept queue of `backlog`.
+
+    A worker stops accepting after max_requests requests (0 for no limit)
+    and a new one takes its place.  An application can count requests itself
+    with a requests_served() method, e.g. to leave out status polls, and
+    can report the jobs it runs in the background with active_jobs(): a
+    worker that stops accepting lives on until those jobs have ended.
+
+    On SIGTERM or SIGINT the workers stop accepting, finish the requests
+    they have and wait up to shutdown_timeout seconds for their jobs, after
+    which the application's abandon_jobs() is called for the ones left.
+    Workers still running a little after that are killed.
+    serve_forever() must run in the main thread of its process.
+    """
+
+    def __init__(self, host, port, app, workers=4, threads=10, backlog=64,
+                 max_requests=0, shutdown_timeout=60):
+        self.httpd = WSGIServer((host, port), WSGIRequestHandler, bind_and_activate=False)
+        self.httpd.request_queue_size = backlog
+        self.httpd.server_bind()
+        self.httpd.server_activate()
+        self.httpd.set_app(app)
+        # several processes wait on the socket, and all but one of them find
+        # nothing to accept
+        self.httpd.socket.setblocking(0)
+        self.server_address = self.httpd.server_address
+        self.app = app
+        self.workers = max(1, int(workers))
+        self.threads = max(1, int(threads))
+        self.max_requests = int(max_requests)
+        self.shutdown_timeout = shutdown_timeout
+        self._children = set()
+        # workers that have stopped accepting, and are waiting for their jobs
+        self._draining = set()
+        # workers write their pid here when they stop accepting
+        self._drain_read, self._drain_write = os.pipe()
+        self._stopping = False
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+
+    def serve_forever(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        try:
+            while not self._stopping:
+                while len(self._children - self._draining) < self.workers:
+                    self._spawn()
+                try:
+                    if select.select([self._drain_read], [], [], 1)[0]:
+                        self._draining.update(
+                            int(pid) for pid in os.read(self._drain_read, 4096).split())
+                except (select.error, OSError) as e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+                self._reap()
+        finally:
+            self._shutdown()
+
+    def _reap(self):
+        for pid in list(self._children):
+            try:
+                exited = os.waitpid(pid, os.WNOHANG)[0]
+            except OSError:
+                exited = True
+            if exited:
+                self._children.discard(pid)
+                self._draining.discard(pid)
+
+    def _shutdown(self):
+        for pid in self._children:
+            self._kill(pid, signal.SIGTERM)
+        # the workers get shutdown_timeout for their jobs, and a little more
+        # to record the ones they abandon
+        deadline = time.time() + self.shutdown_timeout + 10
+        while self._children and time.time() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        for pid in self._children:
+            self._kill(pid, signal.SIGKILL)
+        self._children = set()
+        self._draining = set()
+        self.httpd.server_close()
+
+    @staticmethod
+    def _kill(pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError:
+            pass
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid:
+            self._children.add(pid)
+            return
+        code = 0
+        try:
+            self._work()
+        except Exception:
+            traceback.print_exc()
+            code = 1
+        finally:
+            os._exit(code)
+
+    def _work(self):
+        stop = threading.Event()
+        terminating = threading.Event()
+
+        def terminate(signum, frame):
+            terminating.set()
+            stop.set()
+        signal.signal(signal.SIGTERM, terminate)
+        signal.signal(signal.SIGINT, terminate)
+        lock = threading.Lock()
+        served = [0]
+        counted = getattr(self.app, 'requests_served', None)
+        listener = self.httpd.socket
+
+        def recycle():
+            """Stops accepting if max_requests have been served."""
+            if self.max_requests and (counted() if counted else served[0]) >= self.max_requests:
+                stop.set()
+
+        def serve():
+            while not stop.is_set():
+                try:
+                    if not select.select([listener], [], [], 0.5)[0]:
+                        continue
+                    # accepts under the lock, so that no thread takes a
+                    # connection after another one has served the last
+                    with lock:
+                        if stop.is_set():
+                            break
+                        conn, addr = listener.accept()
+                        served[0] += 1
+                        recycle()
+                except (select.error, socket.error) as e:
+                    if e.args[0] in (errno.EINTR, errno.EAGAIN, errno.EWOULDBLOCK):
+                        continue
+                    raise
+                conn.setblocking(1)
+                try:
+                    self.httpd.finish_request(conn, addr)
+                except Exception:
+                    self.httpd.handle_error(conn, addr)
+                finally:
+                    self.httpd.shutdown_request(conn)
+                with lock:
+                    recycle()
+
+        workers = [threading.Thread(target=serve) for _ in range(self.threads)]
+        for t in workers:
+            t.start()
+        # joins with a timeout, so that the signal handlers get to run
+        while any(t.is_alive() for t in workers):
+            for t in workers:
+                t.join(0.5)
+        self._drain(terminating)
+
+    def _drain(self, terminating):
+        """Waits for the application's jobs in this worker to end."""
+        if not terminating.is_set():
+            # a new worker takes this one's place straight away
+            os.write(self._drain_write, str(os.getpid()) + '\n')
+        active_jobs = getattr(self.app, 'active_jobs', None)
+        deadline = None
+        while active_jobs and active_jobs():
+            if terminating.is_set():
+                deadline = deadline or time.time() + self.shutdown_timeout
+                if time.time() >= deadline:
+                    self.app.abandon_jobs()
+                    return
+            time.sleep(0.5)
+
+
+_proc = None
+
+
+def _application():
+    from kb_cutadapt.ServerExtensions import application
+    return application
+
+
+def start_server(host='localhost', port=0, newprocess=False, workers=4, threads=10,
+                 backlog=64, max_requests=0, shutdown_timeout=60, app=None):
+    """
+    Starts a MultiWorkerServer for app, by default the kb_cutadapt
+    application, as kb_cutadaptServer.start_server does the single-threaded
+    server: in this process until it's interrupted, or with newprocess in a
+    separate one that stop_server() stops.  Returns the port.
+    """
+    global _proc
+    if _proc:
+        raise RuntimeError('server is already running')
+    httpd = MultiWorkerServer(host, port, app or _application(), workers, threads, backlog,
+                              max_requests, shutdown_timeout)
+    port = httpd.server_address[1]
+    print('Listening on port %s' % port)
+    if newprocess:
+        _proc = Process(target=httpd.serve_forever)
+        _proc.daemon = True
+        _proc.start()
+    else:
+        httpd.serve_forever()
+    return port
+
+
+def stop_server():
+    global _proc
+    _proc.terminate()
+    _proc.join()
+    _proc = None
+
+
+def main(argv):
+    try:
+        opts, _ = getopt(argv, '', ['port=', 'host=', 'workers=', 'threads=', 'backlog=',
+                                    'max-requests=', 'shutdown-timeout='])
+    except GetoptError as err:
+        print(str(err))
+        return 2
+    server_opts = {'port': 9999}
+    for o, a in opts:
+        if o == '--host':
+            server_opts['host'] = a
+        else:
+            server_opts[o[2:].replace('-', '_')] = int(a)
+    start_server(**server_opts)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
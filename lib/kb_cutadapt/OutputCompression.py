@@ -0,0 +1,142 @@
+import os
+import errno
+import fcntl
+import subprocess
+import threading
+
+from distutils.spawn import find_executable
+
+
+# output compressions, with the suffix of the files they write
+SUFFIXES = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}
+
+# default and allowed compression levels of each format
+DEFAULT_LEVELS = {'gzip': 6, 'zstd': 3}
+LEVEL_RANGES = {'gzip': (1, 9), 'zstd': (1, 19)}
+
+
+def set_cloexec(f):
+    """
+    Marks a file close-on-exec, so that processes started while it's open
+    don't keep it open (cutadapt engine workers close these too).  Writers
+    to a FIFO or pipe must do this for the reader to see the end of the data.
+    """
+    flags = fcntl.fcntl(f.fileno(), fcntl.F_GETFD)
+    fcntl.fcntl(f.fileno(), fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+
+def compressor_command(compression, level=None, threads=1):
+    """
+    Command line compressing stdin to stdout: pigz when it's installed, as it
+    uses several threads, or else single-threaded gzip; zstd with its own
+    worker threads.
+    """
+    if level is None:
+        level = DEFAULT_LEVELS[compression]
+    low, high = LEVEL_RANGES[compression]
+    if not low <= int(level) <= high:
+        raise ValueError(compression + ' compression level must be between ' +
+                         str(low) + ' and ' + str(high))
+    threads = max(1, int(threads))
+    if compression == 'gzip':
+        if find_executable('pigz'):
+            return ['pigz', '-c', '-' + str(level), '-p', str(threads)]
+        return ['gzip', '-c', '-' + str(level)]
+    if compression == 'zstd':
+        if not find_executable('zstd'):
+            raise ValueError('zstd output compression needs the zstd executable')
+        return ['zstd', '-c', '-q', '-' + str(level), '-T' + str(threads)]
+    raise ValueError('Unknown output compression "' + str(compression) +
+                     '", must be one of: ' + ', '.join(sorted(SUFFIXES)))
+
+
+class OutputCompressor(threading.Thread):
+    """
+    Compresses whatever is written to a FIFO into path with a compressor
+    process, so cutadapt writes plain FASTQ and the compression runs on
+    other cores alongside it.  The uncompressed bytes are counted on the way
+    for the report.  Errors are kept in self.error, as with ShockStream.
+    """
+
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, command, path, fifo):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.command = command
+        self.path = path
+        self.fifo = fifo
+        self.bytes_in = 0
+        self.error = None
+        os.mkfifo(fifo)
+        self.start()
+
+    def run(self):
+        try:
+            # opening a FIFO blocks until the writer opens the other end
+            with open(self.fifo, 'rb') as f, open(self.path, 'wb') as out:
+                # close_fds, as a compressor holding a FIFO's write end open
+                # would wait for its own input forever
+                p = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=out,
+                                     close_fds=True, shell=False)
+                set_cloexec(p.stdin)
+                try:
+                    while True:
+                        chunk = f.read(self.CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        self.bytes_in += len(chunk)
+                        p.stdin.write(chunk)
+                finally:
+                    try:
+                        p.stdin.close()
+                    except IOError:
+                        pass
+                    p.wait()
+            if p.returncode != 0:
+                raise ValueError(self.command[0] + ' exited with return code ' +
+                                 str(p.returncode) + ' compressing ' + self.path)
+        except IOError as e:
+            if e.errno == errno.EPIPE:
+                self.error = ValueError(self.command[0] + ' exited before the end of ' +
+                                        self.path)
+            else:
+                self.error = e
+        except Exception as e:
+            self.error = e
+
+    def finish(self):
+        """Waits for the compressed file, unblocking the copy if the writer never opened the FIFO."""
+        if self.is_alive():
+            try:
+                fd = os.open(self.fifo, os.O_WRONLY | os.O_NONBLOCK)
+                os.close(fd)
+            except OSError:
+                pass
+        self.join()
+        if os.path.exists(self.fifo):
+            os.remove(self.fifo)
+
+    def bytes_out(self):
+        return os.path.getsize(self.path) if os.path.isfile(self.path) else 0
+
+
+def recompress_to_gzip(path, threads=1):
+    """
+    Recompresses a zstd file into a gzip one next to it, without writing the
+    plain data out, and returns the new path.
+    """
+    gz_path = path[:-len(SUFFIXES['zstd'])] + SUFFIXES['gzip']
+    with open(gz_path, 'wb') as out:
+        decompress = subprocess.Popen(['zstd', '-d', '-c', '-q', path],
+                                      stdout=subprocess.PIPE, close_fds=True, shell=False)
+        compress = subprocess.Popen(compressor_command('gzip', threads=threads),
+                                    stdin=decompress.stdout, stdout=out, close_fds=True,
+                                    shell=False)
+        decompress.stdout.close()
+        compress.wait()
+        decompress.wait()
+    if decompress.returncode != 0 or compress.returncode != 0:
+        os.remove(gz_path)
+        raise ValueError('Unable to recompress ' + path + ' with gzip')
+    return gz_path
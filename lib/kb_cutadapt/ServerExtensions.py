@@ -0,0 +1,169 @@
+"""
+Extensions of the kb_cutadapt server that the generated kb_cutadaptServer.py
+doesn't have, kept here as kb-sdk compile regenerates that file.
+`application` wraps the generated application and is what the servers run:
+uwsgi loads this file instead of kb_cutadaptServer.py, and MultiWorkerServer
+serves it.
+
+Jobs: the trimming methods can also be submitted as jobs, following the
+SDK _<method>_submit / _check_job convention that BaseClient.run_job uses,
+and run by a JobTable.
+
+Auth: tokens are checked by an AuthCache.CachingKBaseAuth, which
+remembers rejected tokens for a while and shares one validation between
+concurrent requests with the same token.
+
+JSON-RPC batches: a request body that is an array of calls is answered
+with the array of their responses, in order.  Each call is passed to the
+generated application on its own, so it is authenticated and fails on its
+own.
+"""
+import os
+import json
+import threading
+from StringIO import StringIO
+
+from kb_cutadapt import kb_cutadaptServer
+from kb_cutadapt.kb_cutadaptServer import MethodContext, getIPAddress
+from kb_cutadapt.JobTable import JobTable
+from kb_cutadapt.AuthCache import CachingKBaseAuth
+
+# calls made to poll the server, which MultiWorkerServer doesn't count
+# towards a worker's max_requests
+POLL_METHODS = frozenset(['kb_cutadapt.status', 'kb_cutadapt._check_job'])
+
+
+class ExtendedApplication:
+    """
+    A WSGI application that adds the extensions above to app, a generated
+    Application whose methods are those of impl.  It counts the requests
+    other than polls in requests_served(), and the jobs its process still
+    has to run in active_jobs().
+    """
+
+    def __init__(self, app, impl=None, config=None):
+        self.app = app
+        self.job_table = None
+        self._served = 0
+        self._lock = threading.Lock()
+        if config:
+            self.app.auth_client = CachingKBaseAuth(config.get(kb_cutadaptServer.AUTH))
+            self.job_table = JobTable(
+                config.get('job-state-dir') or os.path.join(config['scratch'], 'jobs'),
+                int(config.get('job-workers') or 2),
+                float(config.get('job-keep-hours') or 24))
+            for method in [impl.remove_adapters,
+                           impl.exec_remove_adapters,
+                           impl.exec_remove_adapters_OneLibrary]:
+                self._add_method('_' + method.__name__ + '_submit', self._job_submitter(method),
+                                 dict)
+            self._add_method('_check_job', self._check_job, basestring)
+            self._add_method('_cancel_job', self._cancel_job, basestring)
+
+    def _add_method(self, name, function, param_type):
+        name = 'kb_cutadapt.' + name
+        self.app.rpc_service.add(function, name=name, types=[param_type])
+        self.app.method_authentication[name] = 'required'
+
+    def _job_submitter(self, method):
+        def submit(ctx, params):
+            # the job runs, and records its provenance, as the method itself
+            ctx['method'] = method.__name__
+            ctx['provenance'] = [{'service': ctx['module'],
+                                  'method': method.__name__,
+                                  'method_params': [params]}]
+            return [self.job_table.submit(method.__name__, method, ctx, [params])]
+        return submit
+
+    def _check_job(self, ctx, job_id):
+        return [self.job_table.check(job_id, ctx)]
+
+    def _cancel_job(self, ctx, job_id):
+        return [self.job_table.cancel(job_id, ctx)]
+
+    def requests_served(self):
+        with self._lock:
+            return self._served
+
+    def active_jobs(self):
+        return self.job_table.active() if self.job_table else 0
+
+    def abandon_jobs(self):
+        return self.job_table.abandon() if self.job_table else 0
+
+    def _count(self, req):
+        calls = req if isinstance(req, list) else [req]
+        if not calls or any(not isinstance(c, dict) or c.get('method') not in POLL_METHODS
+                            for c in calls):
+            with self._lock:
+                self._served += 1
+
+    def __call__(self, environ, start_response):
+        if environ['REQUEST_METHOD'] == 'OPTIONS':
+            return self.app(environ, start_response)
+        try:
+            body_size = int(environ.get('CONTENT_LENGTH', 0))
+        except ValueError:
+            body_size = 0
+        request_body = environ['wsgi.input'].read(body_size)
+        try:
+            req = json.loads(request_body)
+        except ValueError:
+            # the generated application reports the parse error
+            req = None
+        self._count(req)
+        if not isinstance(req, list):
+            environ['wsgi.input'] = StringIO(request_body)
+            return self.app(environ, start_response)
+
+        status = '200 OK'
+        if req:
+            response_body = '[' + ','.join(self._call(environ, r) for r in req) + ']'
+        else:
+            status = '500 Internal Server Error'
+            response_body = self._error(environ, {'version': '1.1'}, 'empty batch')
+        response_headers = [
+            ('Access-Control-Allow-Origin', '*'),
+            ('Access-Control-Allow-Headers', environ.get(
+                'HTTP_ACCESS_CONTROL_REQUEST_HEADERS', 'authorization')),
+            ('content-type', 'application/json'),
+            ('content-length', str(len(response_body)))]
+        start_response(status, response_headers)
+        return [response_body]
+
+    def _error(self, environ, request, message):
+        """An Invalid Request error response to request."""
+        ctx = MethodContext(self.app.userlog)
+        ctx['client_ip'] = getIPAddress(environ)
+        err = {'error': {'code': -32600,
+                         'name': 'Invalid Request',
+                         'message': message}}
+        return self.app.process_error(err, ctx, request)
+
+    def _call(self, environ, req):
+        """Runs one call of a batch through the generated application and returns its response."""
+        if (not isinstance(req, dict) or not isinstance(req.get('method'), basestring) or
+                req['method'].count('.') != 1 or 'params' not in req):
+            request = {'version': '1.1'}
+            if isinstance(req, dict) and 'id' in req:
+                request['id'] = req['id']
+            return self._error(environ, request, 'batch element is not a method call')
+        req.setdefault('id', None)
+        body = json.dumps(req)
+        call_environ = dict(environ)
+        call_environ['wsgi.input'] = StringIO(body)
+        call_environ['CONTENT_LENGTH'] = str(len(body))
+        return ''.join(self.app(call_environ, lambda status, headers, exc_info=None: None)) or 'null'
+
+
+application = ExtendedApplication(kb_cutadaptServer.application,
+                                  kb_cutadaptServer.impl_kb_cutadapt,
+                                  kb_cutadaptServer.config)
+
+# as in kb_cutadaptServer.py, which sets the generated application here
+# when it's imported
+try:
+    import uwsgi
+    uwsgi.applications = {'': application}
+except ImportError:
+    pass
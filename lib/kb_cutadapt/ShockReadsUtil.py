@@ -0,0 +1,186 @@
+import os
+import bz2
+import zlib
+import errno
+import threading
+
+import requests
+
+from Workspace.WorkspaceClient import Workspace
+
+
+class _Decompressor:
+    """Streaming decompressor for gzip or bzip2 data that may have several members."""
+
+    def __init__(self, compression):
+        self.compression = compression
+        self._new()
+
+    def _new(self):
+        if self.compression == 'gz':
+            self._d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self._d = bz2.BZ2Decompressor()
+
+    def decompress(self, data):
+        out = []
+        while data:
+            out.append(self._d.decompress(data))
+            data = self._d.unused_data
+            if data:
+                # start of the next member of a concatenated file
+                self._new()
+        return b''.join(out)
+
+
+class ShockStream(threading.Thread):
+    """
+    Copies a Shock node into a local path (normally a FIFO read by cutadapt)
+    as the bytes arrive, decompressing gzip or bzip2 data on the way since
+    cutadapt can't decompress from a FIFO.  Errors are kept in self.error for
+    the caller to check once the reader is done, since a failed download just
+    looks like a short file to the reader.
+    """
+
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, shock_url, node_id, token, path, compression=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.url = shock_url + '/node/' + node_id + '?download_raw'
+        self.headers = {'Authorization': 'OAuth ' + token}
+        self.path = path
+        self.compression = compression
+        self.bytes = 0
+        self.error = None
+
+    def run(self):
+        out = None
+        try:
+            # opening a FIFO blocks until the reader opens the other end
+            out = open(self.path, 'wb')
+            resp = requests.get(self.url, headers=self.headers, stream=True)
+            if not resp.ok:
+                raise ValueError('Error downloading ' + self.url + ': ' +
+                                 str(resp.status_code) + ' ' + resp.text[:500])
+            decompressor = _Decompressor(self.compression) if self.compression else None
+            for chunk in resp.iter_content(self.CHUNK_SIZE):
+                self.bytes += len(chunk)
+                if decompressor:
+                    chunk = decompressor.decompress(chunk)
+                out.write(chunk)
+        except IOError as e:
+            if e.errno != errno.EPIPE:
+                self.error = e
+            else:
+                self.error = ValueError('reader closed ' + self.path + ' before the end of the data')
+        except Exception as e:
+            self.error = e
+        finally:
+            if out is not None:
+                try:
+                    out.close()
+                except IOError:
+                    pass
+
+    def finish(self):
+        """Waits for the copy to end, unblocking it if the reader never opened the FIFO."""
+        if self.is_alive():
+            try:
+                fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+                self.join(1)
+                os.close(fd)
+            except OSError:
+                pass
+        self.join()
+
+
+class ShockReadsUtil:
+    """
+    Reads the Shock handles of a reads library straight from its workspace
+    object, so the stored files can be streamed without going through
+    ReadsUtils.download_reads.
+    """
+
+    # fields copied into the data info that CutadaptUtil._package_result uses
+    METADATA_FIELDS = ['sequencing_tech', 'strain', 'source', 'single_genome',
+                       'read_orientation_outward', 'insert_size_mean',
+                       'insert_size_std_dev']
+
+    def __init__(self, workspace_url, token, ws=None):
+        self.token = token
+        self.ws = ws or Workspace(workspace_url, token=token)
+
+    def get_reads_files(self, ref, reads_type):
+        """
+        Returns the data info for a library in the layout download_reads uses
+        ('files': {'type': ...}, plus metadata), with the Shock handles of the
+        stored files under 'handles' as a list of one (single end or
+        interleaved) or two (forward, reverse) dicts with 'id', 'url' and
+        'file_name'.  Returns None for types that can't be streamed.
+        """
+        obj = self.ws.get_objects2({'objects': [{'ref': ref}]})['data'][0]
+        data = obj['data']
+
+        if reads_type == 'KBaseFile.SingleEndLibrary':
+            handles = [data['lib']['file']]
+            file_type = 'single'
+        elif reads_type == 'KBaseFile.PairedEndLibrary':
+            handles = [data['lib1']['file']]
+            if 'lib2' in data and data['lib2']:
+                handles.append(data['lib2']['file'])
+        elif reads_type == 'KBaseAssembly.SingleEndLibrary':
+            handles = [data['handle']]
+            file_type = 'single'
+        elif reads_type == 'KBaseAssembly.PairedEndLibrary':
+            handles = [data['handle_1']]
+            if 'handle_2' in data and data['handle_2']:
+                handles.append(data['handle_2'])
+        else:
+            return None
+
+        if reads_type.endswith('PairedEndLibrary'):
+            file_type = 'paired' if len(handles) == 2 else 'interleaved'
+
+        data_info = {'input_ref': ref,
+                     'files': {'type': file_type},
+                     'handles': handles}
+        for f in self.METADATA_FIELDS:
+            if f in data:
+                data_info[f] = data[f]
+        if 'single_genome' in data_info:
+            data_info['single_genome'] = 'true' if data_info['single_genome'] else 'false'
+        return data_info
+
+    @staticmethod
+    def compression(handle):
+        """Compression of a handle's file going by its name: None, 'gz', 'bz2' or 'xz'."""
+        file_name = handle.get('file_name') or ''
+        for ext in ['gz', 'bz2', 'xz']:
+            if file_name.endswith('.' + ext):
+                return ext
+        return None
+
+    @classmethod
+    def can_stream(cls, handle):
+        # there is no lzma module in python 2 to decompress xz on the fly
+        return cls.compression(handle) != 'xz'
+
+    @staticmethod
+    def stored_file_name(handle, default='reads.fq'):
+        """Base name of a handle's file as stored, which keeps its format and compression suffixes."""
+        file_name = os.path.basename(handle.get('file_name') or '')
+        return file_name or default
+
+    def start_download(self, handle, path):
+        """Starts copying a handle's file into path as it is stored, compressed or not."""
+        stream = ShockStream(handle['url'], handle['id'], self.token, path)
+        stream.start()
+        return stream
+
+    def start_stream(self, handle, path):
+        """Starts streaming a handle's file, uncompressed, into path."""
+        stream = ShockStream(handle['url'], handle['id'], self.token, path,
+                             compression=self.compression(handle))
+        stream.start()
+        return stream
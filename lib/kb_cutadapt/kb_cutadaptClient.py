@@ -35,20 +35,84 @@ class kb_cutadapt(object):
 
     def remove_adapters(self, params, context=None):
         """
-        :param params: instance of type "RemoveAdaptersParams" -> structure:
-           parameter "output_workspace" of String, parameter
-           "output_object_name" of String, parameter "input_reads" of type
-           "ws_ref" (@ref ws), parameter "five_prime" of type
-           "FivePrimeOptions" (unfortunately, we have to name the fields
+        :param params: instance of type "RemoveAdaptersParams" (cores - number
+           of cores cutadapt may use per library. 0 or unset uses the
+           deploy.cfg default, which in turn defaults to the container's
+           cgroup CPU quota / affinity mask. stream_input - stream the stored
+           reads from Shock into cutadapt instead of downloading them to
+           scratch first. Libraries that can't be streamed are downloaded as
+           usual. compressed_input - copy the stored read files from Shock to
+           scratch as they are, gzip, bzip2 or xz compressed, for cutadapt to
+           decompress as it reads them, instead of having ReadsUtils download
+           them uncompressed. Paired-end files stored separately are trimmed
+           separately. Unset uses the deploy.cfg default. split_paired_end -
+           download paired-end libraries as separate forward and reverse files
+           and trim them as such, instead of having ReadsUtils interleave them
+           first. max_parallel_libraries - number of ReadsSet or
+           RNASeqSampleSet members trimmed at once. 0 or unset uses the
+           deploy.cfg default. Unless cores is set, the available cores are
+           shared out between the libraries running at once.
+           pipeline_libraries - for sets, download the next libraries and
+           upload the previous ones while the current ones are trimmed,
+           keeping at most the deploy.cfg max-staged-libraries on scratch.
+           Unset uses the deploy.cfg default. output_compression - none, gzip
+           or zstd: compress the trimmed reads as cutadapt writes them, on the
+           cores given to the library. gzip output is uploaded without being
+           compressed again. Unset uses the deploy.cfg default.
+           output_compression_level - 1-9 for gzip, 1-19 for zstd. Unset uses
+           the deploy.cfg default, or else 6 for gzip and 3 for zstd.
+           auto_detect - look for known adapters (Illumina TruSeq, Nextera and
+           small RNA, poly-A, poly-G) in the first reads of the library and
+           trim the best supported one of each end that five_prime or
+           three_prime leave unset. The report lists the reads supporting each
+           adapter. The reads are downloaded to scratch even if stream_input
+           is set. no_indels - allow mismatches but no insertions or deletions
+           in adapter matches. Unset turns it on only where cutadapt can then
+           index several anchored 5' adapters (cutadapt 2.0 and later).
+           quality_cutoff_3P / quality_cutoff_5P - trim bases of lower quality
+           from the 3' / 5' end of the reads before removing the adapters.
+           quality_base - 33 (the default) or 64, the quality encoding.
+           nextseq_trim - 3' quality cutoff for two-colour chemistry (NextSeq,
+           NovaSeq), which also trims the poly-G of dark cycles. max_n -
+           discard reads with more N bases than this, or with a greater
+           fraction of Ns if below 1. max_read_length - discard reads longer
+           than this after trimming. trim_poly_a - trim poly-A tails from the
+           3' end of the reads (and poly-T heads from the 5' end of second
+           reads of pairs). All of these run in the same cutadapt pass as
+           adapter removal.) -> structure: parameter "output_workspace" of
+           String, parameter "output_object_name" of String, parameter
+           "input_reads" of type "ws_ref" (@ref ws), parameter "five_prime" of
+           type "FivePrimeOptions" (unfortunately, we have to name the fields
            uniquely between 3' and 5' options due to the current
-           implementation of grouped parameters) -> structure: parameter
-           "adapter_sequence_5P" of String, parameter "anchored_5P" of type
+           implementation of grouped parameters. adapter_sequences_5P /
+           adapter_sequences_3P - more adapters of the same end, e.g. for
+           pooled libraries. adapter_fasta_5P / adapter_fasta_3P - more
+           adapters as FASTA text. All the adapters of an end are searched for
+           in the same cutadapt pass, and the best matching one is trimmed
+           from each read. anchored_5P / anchored_3P apply to each of them.)
+           -> structure: parameter "adapter_sequence_5P" of String, parameter
+           "adapter_sequences_5P" of list of String, parameter
+           "adapter_fasta_5P" of String, parameter "anchored_5P" of type
            "boolean" (@range (0, 1)), parameter "three_prime" of type
            "ThreePrimeOptions" -> structure: parameter "adapter_sequence_3P"
-           of String, parameter "anchored_3P" of type "boolean" (@range (0,
-           1)), parameter "error_tolerance" of Double, parameter
-           "min_overlap_length" of Long, parameter "min_read_length" of Long,
-           parameter "discard_untrimmed" of type "boolean" (@range (0, 1))
+           of String, parameter "adapter_sequences_3P" of list of String,
+           parameter "adapter_fasta_3P" of String, parameter "anchored_3P" of
+           type "boolean" (@range (0, 1)), parameter "error_tolerance" of
+           Double, parameter "min_overlap_length" of Long, parameter
+           "min_read_length" of Long, parameter "discard_untrimmed" of type
+           "boolean" (@range (0, 1)), parameter "cores" of Long, parameter
+           "stream_input" of type "boolean" (@range (0, 1)), parameter
+           "compressed_input" of type "boolean" (@range (0, 1)), parameter
+           "split_paired_end" of type "boolean" (@range (0, 1)), parameter
+           "max_parallel_libraries" of Long, parameter "pipeline_libraries" of
+           type "boolean" (@range (0, 1)), parameter "output_compression" of
+           String, parameter "output_compression_level" of Long, parameter
+           "auto_detect" of type "boolean" (@range (0, 1)), parameter
+           "no_indels" of type "boolean" (@range (0, 1)), parameter
+           "quality_cutoff_3P" of Long, parameter "quality_cutoff_5P" of Long,
+           parameter "quality_base" of Long, parameter "nextseq_trim" of Long,
+           parameter "max_n" of Double, parameter "max_read_length" of Long,
+           parameter "trim_poly_a" of type "boolean" (@range (0, 1))
         :returns: instance of type "RemoveAdaptersResult" -> structure:
            parameter "report_ref" of String, parameter "output_reads_ref" of
            String
@@ -59,23 +123,102 @@ class kb_cutadapt(object):
 
     def exec_remove_adapters(self, params, context=None):
         """
-        :param params: instance of type "RemoveAdaptersParams" -> structure:
-           parameter "output_workspace" of String, parameter
-           "output_object_name" of String, parameter "input_reads" of type
-           "ws_ref" (@ref ws), parameter "five_prime" of type
-           "FivePrimeOptions" (unfortunately, we have to name the fields
+        :param params: instance of type "RemoveAdaptersParams" (cores - number
+           of cores cutadapt may use per library. 0 or unset uses the
+           deploy.cfg default, which in turn defaults to the container's
+           cgroup CPU quota / affinity mask. stream_input - stream the stored
+           reads from Shock into cutadapt instead of downloading them to
+           scratch first. Libraries that can't be streamed are downloaded as
+           usual. compressed_input - copy the stored read files from Shock to
+           scratch as they are, gzip, bzip2 or xz compressed, for cutadapt to
+           decompress as it reads them, instead of having ReadsUtils download
+           them uncompressed. Paired-end files stored separately are trimmed
+           separately. Unset uses the deploy.cfg default. split_paired_end -
+           download paired-end libraries as separate forward and reverse files
+           and trim them as such, instead of having ReadsUtils interleave them
+           first. max_parallel_libraries - number of ReadsSet or
+           RNASeqSampleSet members trimmed at once. 0 or unset uses the
+           deploy.cfg default. Unless cores is set, the available cores are
+           shared out between the libraries running at once.
+           pipeline_libraries - for sets, download the next libraries and
+           upload the previous ones while the current ones are trimmed,
+           keeping at most the deploy.cfg max-staged-libraries on scratch.
+           Unset uses the deploy.cfg default. output_compression - none, gzip
+           or zstd: compress the trimmed reads as cutadapt writes them, on the
+           cores given to the library. gzip output is uploaded without being
+           compressed again. Unset uses the deploy.cfg default.
+           output_compression_level - 1-9 for gzip, 1-19 for zstd. Unset uses
+           the deploy.cfg default, or else 6 for gzip and 3 for zstd.
+           auto_detect - look for known adapters (Illumina TruSeq, Nextera and
+           small RNA, poly-A, poly-G) in the first reads of the library and
+           trim the best supported one of each end that five_prime or
+           three_prime leave unset. The report lists the reads supporting each
+           adapter. The reads are downloaded to scratch even if stream_input
+           is set. no_indels - allow mismatches but no insertions or deletions
+           in adapter matches. Unset turns it on only where cutadapt can then
+           index several anchored 5' adapters (cutadapt 2.0 and later).
+           quality_cutoff_3P / quality_cutoff_5P - trim bases of lower quality
+           from the 3' / 5' end of the reads before removing the adapters.
+           quality_base - 33 (the default) or 64, the quality encoding.
+           nextseq_trim - 3' quality cutoff for two-colour chemistry (NextSeq,
+           NovaSeq), which also trims the poly-G of dark cycles. max_n -
+           discard reads with more N bases than this, or with a greater
+           fraction of Ns if below 1. max_read_length - discard reads longer
+           than this after trimming. trim_poly_a - trim poly-A tails from the
+           3' end of the reads (and poly-T heads from the 5' end of second
+           reads of pairs). All of these run in the same cutadapt pass as
+           adapter removal.) -> structure: parameter "output_workspace" of
+           String, parameter "output_object_name" of String, parameter
+           "input_reads" of type "ws_ref" (@ref ws), parameter "five_prime" of
+           type "FivePrimeOptions" (unfortunately, we have to name the fields
            uniquely between 3' and 5' options due to the current
-           implementation of grouped parameters) -> structure: parameter
-           "adapter_sequence_5P" of String, parameter "anchored_5P" of type
+           implementation of grouped parameters. adapter_sequences_5P /
+           adapter_sequences_3P - more adapters of the same end, e.g. for
+           pooled libraries. adapter_fasta_5P / adapter_fasta_3P - more
+           adapters as FASTA text. All the adapters of an end are searched for
+           in the same cutadapt pass, and the best matching one is trimmed
+           from each read. anchored_5P / anchored_3P apply to each of them.)
+           -> structure: parameter "adapter_sequence_5P" of String, parameter
+           "adapter_sequences_5P" of list of String, parameter
+           "adapter_fasta_5P" of String, parameter "anchored_5P" of type
            "boolean" (@range (0, 1)), parameter "three_prime" of type
            "ThreePrimeOptions" -> structure: parameter "adapter_sequence_3P"
-           of String, parameter "anchored_3P" of type "boolean" (@range (0,
-           1)), parameter "error_tolerance" of Double, parameter
-           "min_overlap_length" of Long, parameter "min_read_length" of Long,
-           parameter "discard_untrimmed" of type "boolean" (@range (0, 1))
-        :returns: instance of type "exec_RemoveAdaptersResult" -> structure:
-           parameter "report" of String, parameter "output_reads_ref" of
-           String
+           of String, parameter "adapter_sequences_3P" of list of String,
+           parameter "adapter_fasta_3P" of String, parameter "anchored_3P" of
+           type "boolean" (@range (0, 1)), parameter "error_tolerance" of
+           Double, parameter "min_overlap_length" of Long, parameter
+           "min_read_length" of Long, parameter "discard_untrimmed" of type
+           "boolean" (@range (0, 1)), parameter "cores" of Long, parameter
+           "stream_input" of type "boolean" (@range (0, 1)), parameter
+           "compressed_input" of type "boolean" (@range (0, 1)), parameter
+           "split_paired_end" of type "boolean" (@range (0, 1)), parameter
+           "max_parallel_libraries" of Long, parameter "pipeline_libraries" of
+           type "boolean" (@range (0, 1)), parameter "output_compression" of
+           String, parameter "output_compression_level" of Long, parameter
+           "auto_detect" of type "boolean" (@range (0, 1)), parameter
+           "no_indels" of type "boolean" (@range (0, 1)), parameter
+           "quality_cutoff_3P" of Long, parameter "quality_cutoff_5P" of Long,
+           parameter "quality_base" of Long, parameter "nextseq_trim" of Long,
+           parameter "max_n" of Double, parameter "max_read_length" of Long,
+           parameter "trim_poly_a" of type "boolean" (@range (0, 1))
+        :returns: instance of type "exec_RemoveAdaptersResult" (stats - summed
+           over all libraries when the input is a set cache_hits, cache_misses
+           - number of libraries whose trimmed reads were / were not reused
+           from the result cache. Both are 0 when the cache is turned off.) ->
+           structure: parameter "report" of String, parameter
+           "output_reads_ref" of String, parameter "stats" of type
+           "CutadaptStats" (Counts parsed from the cutadapt report. For
+           paired-end libraries the read counts are read pairs, except
+           reads_with_adapters which adds up read 1 and read 2.
+           adapter_matches maps each adapter sequence to the number of reads
+           it was trimmed from.) -> structure: parameter "reads_in" of Long,
+           parameter "reads_with_adapters" of Long, parameter
+           "reads_too_short" of Long, parameter "reads_too_long" of Long,
+           parameter "reads_too_many_n" of Long, parameter "reads_written" of
+           Long, parameter "bp_in" of Long, parameter "bp_quality_trimmed" of
+           Long, parameter "bp_out" of Long, parameter "adapter_matches" of
+           mapping from String to Long, parameter "cache_hits" of Long,
+           parameter "cache_misses" of Long
         """
         return self._client.call_method(
             'kb_cutadapt.exec_remove_adapters',
@@ -89,16 +232,50 @@ class kb_cutadapt(object):
            parameter "input_reads" of type "ws_ref" (@ref ws), parameter
            "five_prime" of type "FivePrimeOptions" (unfortunately, we have to
            name the fields uniquely between 3' and 5' options due to the
-           current implementation of grouped parameters) -> structure:
-           parameter "adapter_sequence_5P" of String, parameter "anchored_5P"
-           of type "boolean" (@range (0, 1)), parameter "three_prime" of type
+           current implementation of grouped parameters. adapter_sequences_5P
+           / adapter_sequences_3P - more adapters of the same end, e.g. for
+           pooled libraries. adapter_fasta_5P / adapter_fasta_3P - more
+           adapters as FASTA text. All the adapters of an end are searched for
+           in the same cutadapt pass, and the best matching one is trimmed
+           from each read. anchored_5P / anchored_3P apply to each of them.)
+           -> structure: parameter "adapter_sequence_5P" of String, parameter
+           "adapter_sequences_5P" of list of String, parameter
+           "adapter_fasta_5P" of String, parameter "anchored_5P" of type
+           "boolean" (@range (0, 1)), parameter "three_prime" of type
            "ThreePrimeOptions" -> structure: parameter "adapter_sequence_3P"
-           of String, parameter "anchored_3P" of type "boolean" (@range (0,
-           1)), parameter "error_tolerance" of Double, parameter
-           "min_overlap_length" of Long
-        :returns: instance of type "exec_RemoveAdaptersResult" -> structure:
-           parameter "report" of String, parameter "output_reads_ref" of
-           String
+           of String, parameter "adapter_sequences_3P" of list of String,
+           parameter "adapter_fasta_3P" of String, parameter "anchored_3P" of
+           type "boolean" (@range (0, 1)), parameter "error_tolerance" of
+           Double, parameter "min_overlap_length" of Long, parameter "cores"
+           of Long, parameter "stream_input" of type "boolean" (@range (0,
+           1)), parameter "compressed_input" of type "boolean" (@range (0,
+           1)), parameter "split_paired_end" of type "boolean" (@range (0,
+           1)), parameter "output_compression" of String, parameter
+           "output_compression_level" of Long, parameter "auto_detect" of type
+           "boolean" (@range (0, 1)), parameter "no_indels" of type "boolean"
+           (@range (0, 1)), parameter "quality_cutoff_3P" of Long, parameter
+           "quality_cutoff_5P" of Long, parameter "quality_base" of Long,
+           parameter "nextseq_trim" of Long, parameter "max_n" of Double,
+           parameter "max_read_length" of Long, parameter "trim_poly_a" of
+           type "boolean" (@range (0, 1))
+        :returns: instance of type "exec_RemoveAdaptersResult" (stats - summed
+           over all libraries when the input is a set cache_hits, cache_misses
+           - number of libraries whose trimmed reads were / were not reused
+           from the result cache. Both are 0 when the cache is turned off.) ->
+           structure: parameter "report" of String, parameter
+           "output_reads_ref" of String, parameter "stats" of type
+           "CutadaptStats" (Counts parsed from the cutadapt report. For
+           paired-end libraries the read counts are read pairs, except
+           reads_with_adapters which adds up read 1 and read 2.
+           adapter_matches maps each adapter sequence to the number of reads
+           it was trimmed from.) -> structure: parameter "reads_in" of Long,
+           parameter "reads_with_adapters" of Long, parameter
+           "reads_too_short" of Long, parameter "reads_too_long" of Long,
+           parameter "reads_too_many_n" of Long, parameter "reads_written" of
+           Long, parameter "bp_in" of Long, parameter "bp_quality_trimmed" of
+           Long, parameter "bp_out" of Long, parameter "adapter_matches" of
+           mapping from String to Long, parameter "cache_hits" of Long,
+           parameter "cache_misses" of Long
         """
         return self._client.call_method(
             'kb_cutadapt.exec_remove_adapters_OneLibrary',
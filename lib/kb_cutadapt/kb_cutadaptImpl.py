@@ -4,14 +4,16 @@
 import sys
 import os
 import re
+import traceback
+from multiprocessing.pool import ThreadPool
 
 from pprint import pprint, pformat
 
-from biokbase.workspace.client import Workspace as workspaceService
-from Workspace.WorkspaceClient import Workspace as Workspace
-from kb_cutadapt.CutadaptUtil import CutadaptUtil
-from SetAPI.SetAPIServiceClient import SetAPI
-from KBaseReport.KBaseReportClient import KBaseReport
+from kb_cutadapt.CutadaptUtil import CutadaptUtil, BatchStager, sum_cutadapt_stats, get_available_cores
+from kb_cutadapt.LibraryPipeline import LibraryPipeline
+from kb_cutadapt.ClientRegistry import ClientRegistry
+from kb_cutadapt.AsyncClients import AsyncWorkspace, configure_async_calls
+from kb_cutadapt import ClientTransport
 
 #END_HEADER
 
@@ -43,6 +45,85 @@ class kb_cutadapt:
         print(message)
         sys.stdout.flush()
 
+    def run_libraries(self, cutadapt, console, params_list, names_list, max_parallel,
+                      pipeline=False, stager=None):
+        """
+        Runs CutadaptUtil.remove_adapters() on each params in params_list, up
+        to max_parallel at once, with the input from stager if given.  The
+        CutadaptUtil, and with it the service clients, is shared by all the
+        libraries.  Returns a (result, error) pair for each library in input
+        order, error being the traceback of a failed library.
+        """
+        if pipeline and len(params_list) > 1:
+            return self.run_libraries_pipelined(cutadapt, console, params_list, names_list,
+                                                max_parallel, stager)
+
+        def run_one(i):
+            msg = "\n\nRUNNING exec_remove_adapters_OneLibrary() ON LIBRARY: "+str(params_list[i]['input_reads'])+" "+str(names_list[i])+"\n"
+            msg += "----------------------------------------------------------------------------\n"
+            self.log (console, msg)
+            try:
+                prestaged = stager.get(i) if stager else None
+                return (cutadapt.remove_adapters(params_list[i], prestaged=prestaged), None)
+            except Exception:
+                error = traceback.format_exc()
+                self.log (console, "FAILED LIBRARY: "+str(params_list[i]['input_reads'])+"\n"+error)
+                return (None, error)
+
+        max_parallel = max(1, min(max_parallel, len(params_list)))
+        if max_parallel == 1:
+            return [run_one(i) for i in range(len(params_list))]
+        pool = ThreadPool(max_parallel)
+        try:
+            return pool.map(run_one, range(len(params_list)))
+        finally:
+            pool.close()
+            pool.join()
+
+    def run_libraries_pipelined(self, cutadapt, console, params_list, names_list, max_parallel,
+                                stager=None):
+        """
+        Same as run_libraries(), but downloads the next libraries and uploads
+        the previous ones while the current ones are trimmed.  At most
+        max-staged-libraries libraries have files on scratch at a time,
+        counting those a stager has downloaded ahead, and each one's files
+        are removed once they have been used.
+        """
+
+        def stage(i):
+            msg = "\n\nSTAGING LIBRARY: "+str(params_list[i]['input_reads'])+" "+str(names_list[i])+"\n"
+            self.log (console, msg)
+            prestaged = stager.get(i, pipeline.slots) if stager else None
+            return cutadapt.stage_library(params_list[i], prestaged=prestaged)
+
+        def trim(job):
+            msg = "\n\nRUNNING cutadapt ON LIBRARY: "+str(job['params']['input_reads'])+"\n"
+            msg += "----------------------------------------------------------------------------\n"
+            self.log (console, msg)
+            try:
+                cutadapt.trim_library(job)
+            except Exception:
+                cutadapt.cleanup_library(job)
+                raise
+            cutadapt.cleanup_library(job, outputs=False)
+            return job
+
+        def save(job):
+            try:
+                return cutadapt.save_library(job)
+            finally:
+                cutadapt.cleanup_library(job, inputs=False)
+
+        pipeline = LibraryPipeline([('download', stage, 1),
+                                    ('trim', trim, max_parallel),
+                                    ('upload', save, 1)],
+                                   self.max_staged_libraries)
+        results = pipeline.run(range(len(params_list)))
+        for i, (_, error) in enumerate(results):
+            if error is not None:
+                self.log (console, "FAILED LIBRARY: "+str(params_list[i]['input_reads'])+"\n"+error)
+        return results
+
     #END_CLASS_HEADER
 
     # config contains contents of config file in a hash or None if it couldn't
@@ -54,26 +135,100 @@ class kb_cutadapt:
         self.config['SDK_CALLBACK_URL'] = os.environ['SDK_CALLBACK_URL']
         if self.config['SDK_CALLBACK_URL'] == None:
             raise ValueError ("SDK_CALLBACK_URL not set in environment")
+        self.max_parallel_libraries = int(config.get('max-parallel-libraries') or 1)
+        self.pipeline_libraries = int(config.get('pipeline-libraries') or 0)
+        self.max_staged_libraries = int(config.get('max-staged-libraries') or 3)
+        self.download_batch_size = int(config.get('download-batch-size') or 1)
+        ClientTransport.configure_connection_pool(config.get('http-pool-size'),
+                                                  config.get('http-pool-idle-timeout'))
+        ClientTransport.configure_job_poller(config.get('job-checks-per-second'),
+                                             config.get('job-max-check-interval'))
+        configure_async_calls(config.get('async-call-workers'))
+        ClientTransport.configure_service_url_cache(config.get('service-url-ttl'))
         #END_CONSTRUCTOR
         pass
 
 
     def remove_adapters(self, ctx, params):
         """
-        :param params: instance of type "RemoveAdaptersParams" -> structure:
-           parameter "output_workspace" of String, parameter
-           "output_object_name" of String, parameter "input_reads" of type
-           "ws_ref" (@ref ws), parameter "five_prime" of type
-           "FivePrimeOptions" (unfortunately, we have to name the fields
+        :param params: instance of type "RemoveAdaptersParams" (cores - number
+           of cores cutadapt may use per library. 0 or unset uses the
+           deploy.cfg default, which in turn defaults to the container's
+           cgroup CPU quota / affinity mask. stream_input - stream the stored
+           reads from Shock into cutadapt instead of downloading them to
+           scratch first. Libraries that can't be streamed are downloaded as
+           usual. compressed_input - copy the stored read files from Shock to
+           scratch as they are, gzip, bzip2 or xz compressed, for cutadapt to
+           decompress as it reads them, instead of having ReadsUtils download
+           them uncompressed. Paired-end files stored separately are trimmed
+           separately. Unset uses the deploy.cfg default. split_paired_end -
+           download paired-end libraries as separate forward and reverse files
+           and trim them as such, instead of having ReadsUtils interleave them
+           first. max_parallel_libraries - number of ReadsSet or
+           RNASeqSampleSet members trimmed at once. 0 or unset uses the
+           deploy.cfg default. Unless cores is set, the available cores are
+           shared out between the libraries running at once.
+           pipeline_libraries - for sets, download the next libraries and
+           upload the previous ones while the current ones are trimmed,
+           keeping at most the deploy.cfg max-staged-libraries on scratch.
+           Unset uses the deploy.cfg default. output_compression - none, gzip
+           or zstd: compress the trimmed reads as cutadapt writes them, on the
+           cores given to the library. gzip output is uploaded without being
+           compressed again. Unset uses the deploy.cfg default.
+           output_compression_level - 1-9 for gzip, 1-19 for zstd. Unset uses
+           the deploy.cfg default, or else 6 for gzip and 3 for zstd.
+           auto_detect - look for known adapters (Illumina TruSeq, Nextera and
+           small RNA, poly-A, poly-G) in the first reads of the library and
+           trim the best supported one of each end that five_prime or
+           three_prime leave unset. The report lists the reads supporting each
+           adapter. The reads are downloaded to scratch even if stream_input
+           is set. no_indels - allow mismatches but no insertions or deletions
+           in adapter matches. Unset turns it on only where cutadapt can then
+           index several anchored 5' adapters (cutadapt 2.0 and later).
+           quality_cutoff_3P / quality_cutoff_5P - trim bases of lower quality
+           from the 3' / 5' end of the reads before removing the adapters.
+           quality_base - 33 (the default) or 64, the quality encoding.
+           nextseq_trim - 3' quality cutoff for two-colour chemistry (NextSeq,
+           NovaSeq), which also trims the poly-G of dark cycles. max_n -
+           discard reads with more N bases than this, or with a greater
+           fraction of Ns if below 1. max_read_length - discard reads longer
+           than this after trimming. trim_poly_a - trim poly-A tails from the
+           3' end of the reads (and poly-T heads from the 5' end of second
+           reads of pairs). All of these run in the same cutadapt pass as
+           adapter removal.) -> structure: parameter "output_workspace" of
+           String, parameter "output_object_name" of String, parameter
+           "input_reads" of type "ws_ref" (@ref ws), parameter "five_prime" of
+           type "FivePrimeOptions" (unfortunately, we have to name the fields
            uniquely between 3' and 5' options due to the current
-           implementation of grouped parameters) -> structure: parameter
-           "adapter_sequence_5P" of String, parameter "anchored_5P" of type
+           implementation of grouped parameters. adapter_sequences_5P /
+           adapter_sequences_3P - more adapters of the same end, e.g. for
+           pooled libraries. adapter_fasta_5P / adapter_fasta_3P - more
+           adapters as FASTA text. All the adapters of an end are searched for
+           in the same cutadapt pass, and the best matching one is trimmed
+           from each read. anchored_5P / anchored_3P apply to each of them.)
+           -> structure: parameter "adapter_sequence_5P" of String, parameter
+           "adapter_sequences_5P" of list of String, parameter
+           "adapter_fasta_5P" of String, parameter "anchored_5P" of type
            "boolean" (@range (0, 1)), parameter "three_prime" of type
            "ThreePrimeOptions" -> structure: parameter "adapter_sequence_3P"
-           of String, parameter "anchored_3P" of type "boolean" (@range (0,
-           1)), parameter "error_tolerance" of Double, parameter
-           "min_overlap_length" of Long, parameter "min_read_length" of Long,
-           parameter "discard_untrimmed" of type "boolean" (@range (0, 1))
+           of String, parameter "adapter_sequences_3P" of list of String,
+           parameter "adapter_fasta_3P" of String, parameter "anchored_3P" of
+           type "boolean" (@range (0, 1)), parameter "error_tolerance" of
+           Double, parameter "min_overlap_length" of Long, parameter
+           "min_read_length" of Long, parameter "discard_untrimmed" of type
+           "boolean" (@range (0, 1)), parameter "cores" of Long, parameter
+           "stream_input" of type "boolean" (@range (0, 1)), parameter
+           "compressed_input" of type "boolean" (@range (0, 1)), parameter
+           "split_paired_end" of type "boolean" (@range (0, 1)), parameter
+           "max_parallel_libraries" of Long, parameter "pipeline_libraries" of
+           type "boolean" (@range (0, 1)), parameter "output_compression" of
+           String, parameter "output_compression_level" of Long, parameter
+           "auto_detect" of type "boolean" (@range (0, 1)), parameter
+           "no_indels" of type "boolean" (@range (0, 1)), parameter
+           "quality_cutoff_3P" of Long, parameter "quality_cutoff_5P" of Long,
+           parameter "quality_base" of Long, parameter "nextseq_trim" of Long,
+           parameter "max_n" of Double, parameter "max_read_length" of Long,
+           parameter "trim_poly_a" of type "boolean" (@range (0, 1))
         :returns: instance of type "RemoveAdaptersResult" -> structure:
            parameter "report_ref" of String, parameter "output_reads_ref" of
            String
@@ -87,7 +242,7 @@ class kb_cutadapt:
         self.log(console, "-------------------------------------------\n")
 
         token = ctx['token']
-        wsClient = workspaceService(self.config['workspace-url'], token=token)
+        clients = ClientRegistry(self.config, token=token)
         headers = {'Authorization': 'OAuth '+token}
         env = os.environ.copy()
         env['KB_AUTH_TOKEN'] = token
@@ -135,7 +290,7 @@ class kb_cutadapt:
             raise ValueError ("no output generated by exec_remove_adapters()")
 
         # save report object
-        report = KBaseReport(self.config['SDK_CALLBACK_URL'], token=ctx['token'], service_ver=SERVICE_VER)
+        report = clients.report(SERVICE_VER)
         report_info = report.create({'report':reportObj, 'workspace_name':params['output_workspace']})
 
         result = {'output_reads_ref': exec_remove_adapters_retVal['output_reads_ref'],
@@ -153,23 +308,102 @@ class kb_cutadapt:
 
     def exec_remove_adapters(self, ctx, params):
         """
-        :param params: instance of type "RemoveAdaptersParams" -> structure:
-           parameter "output_workspace" of String, parameter
-           "output_object_name" of String, parameter "input_reads" of type
-           "ws_ref" (@ref ws), parameter "five_prime" of type
-           "FivePrimeOptions" (unfortunately, we have to name the fields
+        :param params: instance of type "RemoveAdaptersParams" (cores - number
+           of cores cutadapt may use per library. 0 or unset uses the
+           deploy.cfg default, which in turn defaults to the container's
+           cgroup CPU quota / affinity mask. stream_input - stream the stored
+           reads from Shock into cutadapt instead of downloading them to
+           scratch first. Libraries that can't be streamed are downloaded as
+           usual. compressed_input - copy the stored read files from Shock to
+           scratch as they are, gzip, bzip2 or xz compressed, for cutadapt to
+           decompress as it reads them, instead of having ReadsUtils download
+           them uncompressed. Paired-end files stored separately are trimmed
+           separately. Unset uses the deploy.cfg default. split_paired_end -
+           download paired-end libraries as separate forward and reverse files
+           and trim them as such, instead of having ReadsUtils interleave them
+           first. max_parallel_libraries - number of ReadsSet or
+           RNASeqSampleSet members trimmed at once. 0 or unset uses the
+           deploy.cfg default. Unless cores is set, the available cores are
+           shared out between the libraries running at once.
+           pipeline_libraries - for sets, download the next libraries and
+           upload the previous ones while the current ones are trimmed,
+           keeping at most the deploy.cfg max-staged-libraries on scratch.
+           Unset uses the deploy.cfg default. output_compression - none, gzip
+           or zstd: compress the trimmed reads as cutadapt writes them, on the
+           cores given to the library. gzip output is uploaded without being
+           compressed again. Unset uses the deploy.cfg default.
+           output_compression_level - 1-9 for gzip, 1-19 for zstd. Unset uses
+           the deploy.cfg default, or else 6 for gzip and 3 for zstd.
+           auto_detect - look for known adapters (Illumina TruSeq, Nextera and
+           small RNA, poly-A, poly-G) in the first reads of the library and
+           trim the best supported one of each end that five_prime or
+           three_prime leave unset. The report lists the reads supporting each
+           adapter. The reads are downloaded to scratch even if stream_input
+           is set. no_indels - allow mismatches but no insertions or deletions
+           in adapter matches. Unset turns it on only where cutadapt can then
+           index several anchored 5' adapters (cutadapt 2.0 and later).
+           quality_cutoff_3P / quality_cutoff_5P - trim bases of lower quality
+           from the 3' / 5' end of the reads before removing the adapters.
+           quality_base - 33 (the default) or 64, the quality encoding.
+           nextseq_trim - 3' quality cutoff for two-colour chemistry (NextSeq,
+           NovaSeq), which also trims the poly-G of dark cycles. max_n -
+           discard reads with more N bases than this, or with a greater
+           fraction of Ns if below 1. max_read_length - discard reads longer
+           than this after trimming. trim_poly_a - trim poly-A tails from the
+           3' end of the reads (and poly-T heads from the 5' end of second
+           reads of pairs). All of these run in the same cutadapt pass as
+           adapter removal.) -> structure: parameter "output_workspace" of
+           String, parameter "output_object_name" of String, parameter
+           "input_reads" of type "ws_ref" (@ref ws), parameter "five_prime" of
+           type "FivePrimeOptions" (unfortunately, we have to name the fields
            uniquely between 3' and 5' options due to the current
-           implementation of grouped parameters) -> structure: parameter
-           "adapter_sequence_5P" of String, parameter "anchored_5P" of type
+           implementation of grouped parameters. adapter_sequences_5P /
+           adapter_sequences_3P - more adapters of the same end, e.g. for
+           pooled libraries. adapter_fasta_5P / adapter_fasta_3P - more
+           adapters as FASTA text. All the adapters of an end are searched for
+           in the same cutadapt pass, and the best matching one is trimmed
+           from each read. anchored_5P / anchored_3P apply to each of them.)
+           -> structure: parameter "adapter_sequence_5P" of String, parameter
+           "adapter_sequences_5P" of list of String, parameter
+           "adapter_fasta_5P" of String, parameter "anchored_5P" of type
            "boolean" (@range (0, 1)), parameter "three_prime" of type
            "ThreePrimeOptions" -> structure: parameter "adapter_sequence_3P"
-           of String, parameter "anchored_3P" of type "boolean" (@range (0,
-           1)), parameter "error_tolerance" of Double, parameter
-           "min_overlap_length" of Long, parameter "min_read_length" of Long,
-           parameter "discard_untrimmed" of type "boolean" (@range (0, 1))
-        :returns: instance of type "exec_RemoveAdaptersResult" -> structure:
-           parameter "report" of String, parameter "output_reads_ref" of
-           String
+           of String, parameter "adapter_sequences_3P" of list of String,
+           parameter "adapter_fasta_3P" of String, parameter "anchored_3P" of
+           type "boolean" (@range (0, 1)), parameter "error_tolerance" of
+           Double, parameter "min_overlap_length" of Long, parameter
+           "min_read_length" of Long, parameter "discard_untrimmed" of type
+           "boolean" (@range (0, 1)), parameter "cores" of Long, parameter
+           "stream_input" of type "boolean" (@range (0, 1)), parameter
+           "compressed_input" of type "boolean" (@range (0, 1)), parameter
+           "split_paired_end" of type "boolean" (@range (0, 1)), parameter
+           "max_parallel_libraries" of Long, parameter "pipeline_libraries" of
+           type "boolean" (@range (0, 1)), parameter "output_compression" of
+           String, parameter "output_compression_level" of Long, parameter
+           "auto_detect" of type "boolean" (@range (0, 1)), parameter
+           "no_indels" of type "boolean" (@range (0, 1)), parameter
+           "quality_cutoff_3P" of Long, parameter "quality_cutoff_5P" of Long,
+           parameter "quality_base" of Long, parameter "nextseq_trim" of Long,
+           parameter "max_n" of Double, parameter "max_read_length" of Long,
+           parameter "trim_poly_a" of type "boolean" (@range (0, 1))
+        :returns: instance of type "exec_RemoveAdaptersResult" (stats - summed
+           over all libraries when the input is a set cache_hits, cache_misses
+           - number of libraries whose trimmed reads were / were not reused
+           from the result cache. Both are 0 when the cache is turned off.) ->
+           structure: parameter "report" of String, parameter
+           "output_reads_ref" of String, parameter "stats" of type
+           "CutadaptStats" (Counts parsed from the cutadapt report. For
+           paired-end libraries the read counts are read pairs, except
+           reads_with_adapters which adds up read 1 and read 2.
+           adapter_matches maps each adapter sequence to the number of reads
+           it was trimmed from.) -> structure: parameter "reads_in" of Long,
+           parameter "reads_with_adapters" of Long, parameter
+           "reads_too_short" of Long, parameter "reads_too_long" of Long,
+           parameter "reads_too_many_n" of Long, parameter "reads_written" of
+           Long, parameter "bp_in" of Long, parameter "bp_quality_trimmed" of
+           Long, parameter "bp_out" of Long, parameter "adapter_matches" of
+           mapping from String to Long, parameter "cache_hits" of Long,
+           parameter "cache_misses" of Long
         """
         # ctx is the context object
         # return variables are: result
@@ -183,10 +417,12 @@ class kb_cutadapt:
         returnVal['output_reads_ref'] = None
 
         token = ctx['token']
-        wsClient = workspaceService(self.config['workspace-url'], token=token)
-        ws = Workspace(self.config['workspace-url'], token=token)
+        # one set of clients, and one CutadaptUtil, for all the libraries
+        clients = ClientRegistry(self.config, token=token)
+        cutadapt = CutadaptUtil(self.config, token=token, clients=clients)
+        ws = clients.workspace()
         #setAPI_Client = SetAPI (url=self.config['SDK_CALLBACK_URL'], token=token) # for SDK local, doesn't work for SetAPI
-        setAPI_Client = SetAPI (url=self.config['service-wizard-url'], token=token)  # for dynamic service
+        setAPI_Client = clients.set_api()  # for dynamic service
         headers = {'Authorization': 'OAuth '+token}
         env = os.environ.copy()
         env['KB_AUTH_TOKEN'] = token
@@ -213,7 +449,7 @@ class kb_cutadapt:
             # object_info tuple
             [OBJID_I, NAME_I, TYPE_I, SAVE_DATE_I, VERSION_I, SAVED_BY_I, WSID_I, WORKSPACE_I, CHSUM_I, SIZE_I, META_I] = range(11)
 
-            input_reads_obj_info = wsClient.get_object_info_new ({'objects':[{'ref':params['input_reads']}]})[0]
+            input_reads_obj_info = ws.get_object_info_new ({'objects':[{'ref':params['input_reads']}]})[0]
             input_reads_obj_type = input_reads_obj_info[TYPE_I]
             input_reads_obj_type = re.sub ('-[0-9]+\.[0-9]+$', "", input_reads_obj_type)  # remove trailing version
             #input_reads_obj_version = input_reads_obj_info[VERSION_I]  # this is object version, not type version
@@ -270,6 +506,11 @@ class kb_cutadapt:
         report = ''
         cutadapt_readsSet_ref  = None
         cutadapt_readsLib_refs = []
+        cutadapt_readsLib_stats = []
+        cutadapt_readsLib_failures = []
+        cache_hits = 0
+        cache_misses = 0
+        exec_remove_adapters_OneLibrary_params_list = []
 
         for reads_item_i,input_reads_library_ref in enumerate(readsSet_ref_list):
             exec_remove_adapters_OneLibrary_params = { 'output_workspace': params['output_workspace'],
@@ -285,12 +526,31 @@ class kb_cutadapt:
             optional_params = [ 'float error_tolerance',
                                 'min_overlap_length',
                                 'min_read_length',
-                                'discard_untrimmed'
+                                'discard_untrimmed',
+                                'cores',
+                                'stream_input',
+                                'compressed_input',
+                                'split_paired_end',
+                                'output_compression',
+                                'output_compression_level',
+                                'auto_detect',
+                                'no_indels',
+                                'quality_cutoff_3P',
+                                'quality_cutoff_5P',
+                                'quality_base',
+                                'nextseq_trim',
+                                'max_n',
+                                'max_read_length',
+                                'trim_poly_a'
                                 ]
             optional_g_params = { 'five_prime': [ 'adapter_sequence_5P',
+                                                  'adapter_sequences_5P',
+                                                  'adapter_fasta_5P',
                                                   'anchored_5P'
                                                   ],
                                   'three_prime': [ 'adapter_sequence_3P',
+                                                   'adapter_sequences_3P',
+                                                   'adapter_fasta_3P',
                                                    'anchored_3P'
                                                    ]
                                   }
@@ -305,31 +565,92 @@ class kb_cutadapt:
                         if arg in params[group] and params[group][arg] != None:
                             exec_remove_adapters_OneLibrary_params[group][arg] = params[group][arg]
 
-            msg = "\n\nRUNNING exec_remove_adapters_OneLibrary() ON LIBRARY: "+str(input_reads_library_ref)+" "+str(readsSet_names_list[reads_item_i])+"\n"
+            exec_remove_adapters_OneLibrary_params_list.append(exec_remove_adapters_OneLibrary_params)
+
+        # libraries run side by side share the cores, unless cores were set explicitly
+        max_parallel = int(params.get('max_parallel_libraries') or self.max_parallel_libraries)
+        max_parallel = max(1, min(max_parallel, len(readsSet_ref_list)))
+        if max_parallel > 1 and not params.get('cores'):
+            total_cores = int(self.config.get('cutadapt-cores') or 0) or get_available_cores()
+            for lib_params in exec_remove_adapters_OneLibrary_params_list:
+                lib_params['cores'] = max(1, total_cores // max_parallel)
+
+        pipeline = params.get('pipeline_libraries')
+        if pipeline is None:
+            pipeline = self.pipeline_libraries
+
+        # set members are downloaded a batch at a time instead of one call
+        # each; a pipelined batch takes its libraries' places under the cap
+        # on staged libraries, so it can't be bigger than the cap
+        stager = None
+        batch_size = self.download_batch_size
+        if int(pipeline) == 1:
+            batch_size = min(batch_size, self.max_staged_libraries)
+        if len(readsSet_ref_list) > 1 and batch_size > 1:
+            # streamed and compressed inputs are fetched from Shock per library
+            if not (params.get('stream_input', cutadapt.default_stream_input) or
+                    params.get('compressed_input', cutadapt.default_compressed_input)):
+                stager = BatchStager(cutadapt, readsSet_ref_list, readsSet_types_list,
+                                     params.get('split_paired_end'),
+                                     batch_size)
+
+        # RUN
+        try:
+            lib_results = self.run_libraries(cutadapt, console,
+                                             exec_remove_adapters_OneLibrary_params_list,
+                                             readsSet_names_list,
+                                             max_parallel,
+                                             pipeline=int(pipeline) == 1,
+                                             stager=stager)
+        finally:
+            if stager:
+                stager.cleanup()
+
+        for reads_item_i,(exec_remove_adapters_OneLibrary_retVal, error) in enumerate(lib_results):
+            msg = "\n\nRUNNING exec_remove_adapters_OneLibrary() ON LIBRARY: "+str(readsSet_ref_list[reads_item_i])+" "+str(readsSet_names_list[reads_item_i])+"\n"
             msg += "----------------------------------------------------------------------------\n"
             report += msg
-            self.log (console, msg)
-
-            # RUN
-            exec_remove_adapters_OneLibrary_retVal = self.exec_remove_adapters_OneLibrary (ctx, exec_remove_adapters_OneLibrary_params)[0]
+            if error is not None:
+                report += "FAILED:\n"+error+"\n\n"
+                cutadapt_readsLib_refs.append (None)
+                cutadapt_readsLib_stats.append (None)
+                cutadapt_readsLib_failures.append (str(readsSet_ref_list[reads_item_i])+" "+str(readsSet_names_list[reads_item_i]))
+                continue
 
             report += exec_remove_adapters_OneLibrary_retVal['report']+"\n\n"
             cutadapt_readsLib_refs.append (exec_remove_adapters_OneLibrary_retVal['output_reads_ref'])
+            cutadapt_readsLib_stats.append (exec_remove_adapters_OneLibrary_retVal.get('stats'))
+            cache_hits += exec_remove_adapters_OneLibrary_retVal.get('cache_hits', 0)
+            cache_misses += exec_remove_adapters_OneLibrary_retVal.get('cache_misses', 0)
+
+        if cache_hits or cache_misses:
+            msg = "Result cache: "+str(cache_hits)+" hits, "+str(cache_misses)+" misses\n"
+            report = msg+"\n"+report
+            self.log (console, msg)
 
         # 5. Conclude
         # Just one Library
         if (input_reads_obj_type != "KBaseSets.ReadsSet" and
                             input_reads_obj_type != "KBaseRNASeq.RNASeqSampleSet"):
 
+            if cutadapt_readsLib_failures:
+                raise ValueError ("cutadapt failed on library "+cutadapt_readsLib_failures[0]+"\n"+lib_results[0][1])
+
             # create return output object
             result = { 'report': report,
                        'output_reads_ref': cutadapt_readsLib_refs[0],
+                       'stats': cutadapt_readsLib_stats[0],
+                       'cache_hits': cache_hits,
+                       'cache_misses': cache_misses
                        }
         # ReadsSet or SampleSet
         else:
             # save cutadapt readsSet
             some_cutadapt_output_created = False
             items = []
+            # labels the input set doesn't have are looked up all at once
+            async_ws = AsyncWorkspace(ws)
+            label_lookups = []
             for i,lib_ref in enumerate(cutadapt_readsLib_refs):
 
                 if lib_ref == None:
@@ -338,17 +659,19 @@ class kb_cutadapt:
                 else:
                     some_cutadapt_output_created = True
                     try:
-                        label = input_readsSet_obj['data']['items'][i]['label']
+                        label = input_readsSet_obj['data']['items'][i]['label'] + "_cutadapt"
                     except:
-                        NAME_I = 1
-                        label = ws.get_object_info3({'objects':[{'ref':lib_ref}]})['infos'][0][NAME_I]
-                    label = label + "_cutadapt"
+                        label = None
+                        label_lookups.append((len(items), async_ws.get_object_info3({'objects':[{'ref':lib_ref}]})))
 
                     items.append({'ref': lib_ref,
                                   'label': label
                                   #'data_attachment': ,
                                   #'info':
                                       })
+            NAME_I = 1
+            for item_i, info in label_lookups:
+                items[item_i]['label'] = info.result()['infos'][0][NAME_I] + "_cutadapt"
             if some_cutadapt_output_created:
                 reads_desc_ext = " + Cutadapt"
                 #reads_name_ext = "_cutadapt"
@@ -371,12 +694,21 @@ class kb_cutadapt:
                                                                           'data': output_readsSet_obj
                                                                           })['set_ref']
             else:
-                raise ValueError ("No cutadapt output created")
+                raise ValueError ("No cutadapt output created\n"+report)
+
+            if cutadapt_readsLib_failures:
+                msg = "cutadapt failed on "+str(len(cutadapt_readsLib_failures))+" of "+str(len(readsSet_ref_list))+" libraries, which were left out of the output set:\n"
+                msg += "\n".join(cutadapt_readsLib_failures)+"\n"
+                report = msg+"\n"+report
+                self.log (console, msg)
 
 
             # create return output object
             result = { 'report': report,
-                       'output_reads_ref': cutadapt_readsSet_ref
+                       'output_reads_ref': cutadapt_readsSet_ref,
+                       'stats': sum_cutadapt_stats(cutadapt_readsLib_stats),
+                       'cache_hits': cache_hits,
+                       'cache_misses': cache_misses
                        }
         #END exec_remove_adapters
 
@@ -395,16 +727,50 @@ class kb_cutadapt:
            parameter "input_reads" of type "ws_ref" (@ref ws), parameter
            "five_prime" of type "FivePrimeOptions" (unfortunately, we have to
            name the fields uniquely between 3' and 5' options due to the
-           current implementation of grouped parameters) -> structure:
-           parameter "adapter_sequence_5P" of String, parameter "anchored_5P"
-           of type "boolean" (@range (0, 1)), parameter "three_prime" of type
+           current implementation of grouped parameters. adapter_sequences_5P
+           / adapter_sequences_3P - more adapters of the same end, e.g. for
+           pooled libraries. adapter_fasta_5P / adapter_fasta_3P - more
+           adapters as FASTA text. All the adapters of an end are searched for
+           in the same cutadapt pass, and the best matching one is trimmed
+           from each read. anchored_5P / anchored_3P apply to each of them.)
+           -> structure: parameter "adapter_sequence_5P" of String, parameter
+           "adapter_sequences_5P" of list of String, parameter
+           "adapter_fasta_5P" of String, parameter "anchored_5P" of type
+           "boolean" (@range (0, 1)), parameter "three_prime" of type
            "ThreePrimeOptions" -> structure: parameter "adapter_sequence_3P"
-           of String, parameter "anchored_3P" of type "boolean" (@range (0,
-           1)), parameter "error_tolerance" of Double, parameter
-           "min_overlap_length" of Long
-        :returns: instance of type "exec_RemoveAdaptersResult" -> structure:
-           parameter "report" of String, parameter "output_reads_ref" of
-           String
+           of String, parameter "adapter_sequences_3P" of list of String,
+           parameter "adapter_fasta_3P" of String, parameter "anchored_3P" of
+           type "boolean" (@range (0, 1)), parameter "error_tolerance" of
+           Double, parameter "min_overlap_length" of Long, parameter "cores"
+           of Long, parameter "stream_input" of type "boolean" (@range (0,
+           1)), parameter "compressed_input" of type "boolean" (@range (0,
+           1)), parameter "split_paired_end" of type "boolean" (@range (0,
+           1)), parameter "output_compression" of String, parameter
+           "output_compression_level" of Long, parameter "auto_detect" of type
+           "boolean" (@range (0, 1)), parameter "no_indels" of type "boolean"
+           (@range (0, 1)), parameter "quality_cutoff_3P" of Long, parameter
+           "quality_cutoff_5P" of Long, parameter "quality_base" of Long,
+           parameter "nextseq_trim" of Long, parameter "max_n" of Double,
+           parameter "max_read_length" of Long, parameter "trim_poly_a" of
+           type "boolean" (@range (0, 1))
+        :returns: instance of type "exec_RemoveAdaptersResult" (stats - summed
+           over all libraries when the input is a set cache_hits, cache_misses
+           - number of libraries whose trimmed reads were / were not reused
+           from the result cache. Both are 0 when the cache is turned off.) ->
+           structure: parameter "report" of String, parameter
+           "output_reads_ref" of String, parameter "stats" of type
+           "CutadaptStats" (Counts parsed from the cutadapt report. For
+           paired-end libraries the read counts are read pairs, except
+           reads_with_adapters which adds up read 1 and read 2.
+           adapter_matches maps each adapter sequence to the number of reads
+           it was trimmed from.) -> structure: parameter "reads_in" of Long,
+           parameter "reads_with_adapters" of Long, parameter
+           "reads_too_short" of Long, parameter "reads_too_long" of Long,
+           parameter "reads_too_many_n" of Long, parameter "reads_written" of
+           Long, parameter "bp_in" of Long, parameter "bp_quality_trimmed" of
+           Long, parameter "bp_out" of Long, parameter "adapter_matches" of
+           mapping from String to Long, parameter "cache_hits" of Long,
+           parameter "cache_misses" of Long
         """
         # ctx is the context object
         # return variables are: result
@@ -414,7 +780,7 @@ class kb_cutadapt:
         self.log (console, "\n"+pformat(params)+"\n")
         self.log (console, "---------------------------------------------------\n")
 
-        cutadapt = CutadaptUtil(self.config)
+        cutadapt = CutadaptUtil(self.config, token=ctx['token'])
         result = cutadapt.remove_adapters(params)
         #END exec_remove_adapters_OneLibrary
 
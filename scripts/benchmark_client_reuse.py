@@ -0,0 +1,128 @@
+"""
+Measures the per-library overhead of setting up service clients, with and
+without sharing them across the libraries of a request.
+
+A local JSON-RPC server stands in for the Workspace and ReadsUtils, and each
+library makes the Workspace calls the module makes before trimming and
+creates its ReadsUtils client.  "before" builds a new CutadaptUtil and
+clients for every library, with fresh connections as each client used to
+open its own; "after" shares one ClientRegistry and CutadaptUtil.  The
+optional latency is added to every new connection, as a stand-in for the
+TLS handshake with a remote service.
+
+Usage: python scripts/benchmark_client_reuse.py [libraries] [latency_ms]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler  # py2
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler  # py3
+    from socketserver import ThreadingMixIn
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+from kb_cutadapt.CutadaptUtil import CutadaptUtil
+from kb_cutadapt.ClientRegistry import ClientRegistry
+from kb_cutadapt import ClientTransport
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # send each response in one write, so Nagle's algorithm doesn't stall
+    # keep-alive connections
+    wbufsize = -1
+    # extra time per connection, e.g. for the TLS handshake with a remote host
+    connect_latency = 0.0
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        time.sleep(self.connect_latency)
+        self.server.connections += 1
+
+    def do_POST(self):
+        method = json.loads(self.rfile.read(int(self.headers['content-length'])))['method']
+        if method.endswith('_submit'):
+            result = 'job_id'
+        elif method.endswith('_check_job'):
+            # SDK callback jobs finish straight away here
+            result = {'finished': 1, 'result': [{}]}
+        else:
+            result = {}
+        body = json.dumps({'version': '1.1', 'result': [result]}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('content-type', 'application/json')
+        self.send_header('content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    connections = 0
+
+
+def _library(cutadapt):
+    # only the synchronous calls, as the SDK job polling would swamp the rest
+    ws = cutadapt.clients.workspace()
+    ws.get_object_info3({'objects': [{'ref': '1/2/3'}]})
+    ws.get_objects2({'objects': [{'ref': '1/2/3'}]})
+    cutadapt.clients.reads_utils()
+
+
+def _reset_connections():
+    ClientTransport.configure_connection_pool()
+
+
+def _run(config, libraries, share):
+    _reset_connections()
+    start = time.time()
+    shared = CutadaptUtil(config, token='token', clients=ClientRegistry(config, 'token'))
+    for _ in range(libraries):
+        if share:
+            cutadapt = shared
+        else:
+            _reset_connections()
+            cutadapt = CutadaptUtil(config, token='token')
+        _library(cutadapt)
+    return (time.time() - start) * 1000.0 / libraries
+
+
+def main():
+    libraries = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    _Handler.connect_latency = float(sys.argv[2]) / 1000.0 if len(sys.argv) > 2 else 0.0
+
+    server = _Server(('127.0.0.1', 0), _Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = 'http://127.0.0.1:%d' % server.server_address[1]
+
+    scratch = tempfile.mkdtemp()
+    config = {'scratch': scratch, 'SDK_CALLBACK_URL': url, 'workspace-url': url,
+              'service-wizard-url': url}
+    try:
+        for name, share in [('before', False), ('after', True)]:
+            connections = server.connections
+            ms = _run(config, libraries, share)
+            print('%-6s %8.2f ms/library  %5d connections for %d libraries' %
+                  (name, ms, server.connections - connections, libraries))
+    finally:
+        # drop the keep-alive connections so the handler threads exit
+        _reset_connections()
+        server.shutdown()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
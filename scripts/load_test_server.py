@@ -0,0 +1,127 @@
+"""
+Load test of the server modes: the latency of kb_cutadapt.status, idle and
+while trimming calls are running, for the single-threaded server of
+kb_cutadaptServer and for MultiWorkerServer.
+
+A stand-in method, kb_cutadapt.load_test_trim, runs cutadapt through
+CutadaptRunner on a generated FASTQ file, so the test needs cutadapt but
+no KBase services.  KB_DEPLOYMENT_CONFIG and SDK_CALLBACK_URL are set to
+local placeholders when they're not set already.
+
+Usage: python scripts/load_test_server.py [trims] [reads per trim] [workers]
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+import threading
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+ADAPTER = 'AGATCGGAAGAGC'
+
+
+def _write_fastq(path, reads):
+    rnd = random.Random(1)
+    with open(path, 'w') as f:
+        for i in range(reads):
+            seq = ''.join(rnd.choice('ACGT') for _ in range(60)) + ADAPTER + 'ACGTACGT'
+            f.write('@read%d\n%s\n+\n%s\n' % (i, seq, 'I' * len(seq)))
+
+
+def _status_latencies(url, stop=None, count=20):
+    body = json.dumps({'version': '1.1', 'id': '1', 'method': 'kb_cutadapt.status',
+                       'params': []})
+    latencies = []
+    while (stop is None and len(latencies) < count) or (stop is not None and not stop.is_set()):
+        start = time.time()
+        requests.post(url, data=body, timeout=600).raise_for_status()
+        latencies.append(time.time() - start)
+        time.sleep(0.1)
+    return latencies
+
+
+def _summary(latencies):
+    latencies = sorted(latencies)
+    if not latencies:
+        return 'no calls'
+    return '%4d calls  median %7.1f ms  p95 %7.1f ms  max %7.1f ms' % (
+        len(latencies), 1000 * latencies[len(latencies) // 2],
+        1000 * latencies[int(len(latencies) * 0.95)], 1000 * latencies[-1])
+
+
+def main():
+    trims = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    reads = int(sys.argv[2]) if len(sys.argv) > 2 else 200000
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+
+    scratch = tempfile.mkdtemp()
+    if not os.environ.get('KB_DEPLOYMENT_CONFIG'):
+        cfg = os.path.join(scratch, 'deploy.cfg')
+        with open(cfg, 'w') as f:
+            f.write('[kb_cutadapt]\nscratch = ' + scratch + '\n')
+        os.environ['KB_DEPLOYMENT_CONFIG'] = cfg
+    os.environ.setdefault('SDK_CALLBACK_URL', 'http://localhost:1')
+
+    from kb_cutadapt import kb_cutadaptServer as server
+    from kb_cutadapt import MultiWorkerServer
+    from kb_cutadapt.CutadaptUtil import CutadaptRunner
+
+    fastq = os.path.join(scratch, 'load_test.fq')
+    _write_fastq(fastq, reads)
+
+    def load_test_trim(ctx, params):
+        runner = CutadaptRunner(scratch)
+        runner.set_input_file(fastq)
+        runner.set_output_file(os.path.join(scratch, 'trimmed_' + str(params['i']) + '.fq'))
+        runner.set_three_prime_option(ADAPTER, 0)
+        runner.set_discard_untrimmed(0)
+        runner.run()
+        return [{}]
+    server.application.rpc_service.add(load_test_trim, name='kb_cutadapt.load_test_trim',
+                                       types=[dict])
+
+    try:
+        for name, launcher, opts in [('single-threaded', server, {}),
+                                     ('multi-worker', MultiWorkerServer,
+                                      {'workers': workers, 'threads': 4})]:
+            port = launcher.start_server(newprocess=True, **opts)
+            url = 'http://localhost:' + str(port)
+            try:
+                idle = _status_latencies(url)
+
+                def trim(i):
+                    body = json.dumps({'version': '1.1', 'id': str(i),
+                                       'method': 'kb_cutadapt.load_test_trim',
+                                       'params': [{'i': i}]})
+                    requests.post(url, data=body, timeout=3600).raise_for_status()
+                start = time.time()
+                trim_threads = [threading.Thread(target=trim, args=(i,)) for i in range(trims)]
+                for t in trim_threads:
+                    t.start()
+                stop = threading.Event()
+                loaded = []
+                poller = threading.Thread(
+                    target=lambda: loaded.extend(_status_latencies(url, stop)))
+                poller.start()
+                for t in trim_threads:
+                    t.join()
+                trim_seconds = time.time() - start
+                stop.set()
+                poller.join()
+            finally:
+                launcher.stop_server()
+            print(name + ' server, ' + str(trims) + ' trims in ' + '%.1f' % trim_seconds + ' s')
+            print('  status idle:           ' + _summary(idle))
+            print('  status while trimming: ' + _summary(loaded))
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
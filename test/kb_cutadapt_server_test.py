@@ -2,9 +2,13 @@
 import unittest
 import os  # noqa: F401
 import json  # noqa: F401
+import gzip
 import time
+import random
 import requests
 import shutil
+import threading
+import subprocess
 requests.packages.urllib3.disable_warnings()
 
 from os import environ
@@ -12,8 +16,19 @@ try:
     from ConfigParser import ConfigParser  # py2
 except:
     from configparser import ConfigParser  # py3
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler  # py2
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs
+    from StringIO import StringIO
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler  # py3
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs
+    from io import StringIO
 
 from pprint import pprint  # noqa: F401
+from distutils.spawn import find_executable
 
 from biokbase.workspace.client import Workspace as workspaceService
 from biokbase.AbstractHandle.Client import AbstractHandle as HandleService
@@ -21,9 +36,210 @@ from requests_toolbelt import MultipartEncoder
 
 from kb_cutadapt.kb_cutadaptImpl import kb_cutadapt
 from kb_cutadapt.kb_cutadaptServer import MethodContext
+from kb_cutadapt import kb_cutadaptServer
+from kb_cutadapt.kb_cutadaptClient import kb_cutadapt as kb_cutadaptClient
+from kb_cutadapt import MultiWorkerServer
+from kb_cutadapt import ServerExtensions
+from kb_cutadapt.CutadaptUtil import CutadaptRunner, CutadaptUtil, BatchStager
+from kb_cutadapt.LibraryPipeline import LibraryPipeline
+from kb_cutadapt.ClientRegistry import ClientRegistry
+from kb_cutadapt.FileCache import FileCache, cache_key
+from kb_cutadapt.JobTable import JobTable
+from kb_cutadapt import OutputCompression
+from kb_cutadapt.AdapterDetect import AdapterDetector
 
 from ReadsUtils.ReadsUtilsClient import ReadsUtils
 from kb_cutadapt.authclient import KBaseAuth as _KBaseAuth
+from kb_cutadapt.AuthCache import CachingKBaseAuth, TokenCache
+from kb_cutadapt import ClientTransport
+from kb_cutadapt.AsyncClients import AsyncWorkspace, AsyncReadsUtils, AsyncSetAPI, submit_jobs
+from Workspace.WorkspaceClient import Workspace
+from SetAPI.SetAPIServiceClient import SetAPI
+
+
+class StubCallbackServer(ThreadingMixIn, HTTPServer):
+    """
+    Stand-in for the SDK callback server: a job submitted with params
+    [{'seconds': s}] finishes s seconds later with result [{'seconds': s}].
+    Other methods wait s seconds and return their params.  Counts the
+    _check_job calls made.  Also the ServiceWizard, resolving every module
+    to lookup_url, after lookup_seconds.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubCallbackHandler)
+        self.jobs = {}
+        self.checks = 0
+        self.lookups = 0
+        self.lookup_seconds = 0
+        self.lock = threading.Lock()
+        self.url = 'http://127.0.0.1:' + str(self.server_address[1])
+        self.lookup_url = self.url
+
+    def handle_error(self, request, client_address):
+        # clients drop their pooled keep-alive connections without notice
+        pass
+
+
+class StubCallbackHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+
+    def do_POST(self):
+        req = json.loads(self.rfile.read(int(self.headers['content-length'])))
+        method = req['method']
+        params = req['params']
+        server = self.server
+        if method == 'ServiceWizard.get_service_status':
+            time.sleep(server.lookup_seconds)
+            with server.lock:
+                server.lookups += 1
+            result = {'url': server.lookup_url}
+        elif method.endswith('_submit'):
+            with server.lock:
+                job_id = str(len(server.jobs))
+                server.jobs[job_id] = (time.time() + params[0]['seconds'], params)
+            result = job_id
+        elif method.endswith('._check_job'):
+            with server.lock:
+                server.checks += 1
+                finish_time, job_params = server.jobs[params[0]]
+            if time.time() >= finish_time:
+                result = {'finished': 1, 'result': job_params}
+            else:
+                result = {'finished': 0}
+        else:
+            time.sleep(params[0]['seconds'])
+            result = params[0]
+        body = json.dumps({'version': '1.1', 'id': req['id'], 'result': [result]})
+        self.send_response(200)
+        self.send_header('content-type', 'application/json')
+        self.send_header('content-length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body.encode('utf-8'))
+
+    def log_message(self, *args):
+        pass
+
+
+class StubAuthServer(ThreadingMixIn, HTTPServer):
+    """
+    Stand-in for the auth service: after `seconds`, token 'bad' is rejected
+    and any other token belongs to user 'user_<token>'.  Counts the
+    validations made.
+    """
+    daemon_threads = True
+
+    def __init__(self, seconds=0.2):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubAuthHandler)
+        self.seconds = seconds
+        self.validations = 0
+        self.lock = threading.Lock()
+        self.url = 'http://127.0.0.1:' + str(self.server_address[1])
+
+    def handle_error(self, request, client_address):
+        pass
+
+
+class StubAuthHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        form = parse_qs(self.rfile.read(int(self.headers['content-length'])).decode('utf-8'))
+        token = form['token'][0]
+        with self.server.lock:
+            self.server.validations += 1
+        time.sleep(self.server.seconds)
+        if token == 'bad':
+            self.send_response(401)
+            body = json.dumps({'error_msg': 'invalid token'})
+        else:
+            self.send_response(200)
+            body = json.dumps({'user_id': 'user_' + token})
+        self.send_header('content-type', 'application/json')
+        self.end_headers()
+        self.wfile.write(body.encode('utf-8'))
+
+    def log_message(self, *args):
+        pass
+
+
+def pid_app(environ, start_response):
+    """WSGI app that answers with the id of the process serving it."""
+    start_response('200 OK', [('content-type', 'text/plain')])
+    return [str(os.getpid()).encode('ascii')]
+
+
+class JobsApp(object):
+    """
+    WSGI app that answers with the id of the process serving it, and runs
+    background jobs as ServerExtensions.application does: /job?<seconds>
+    starts one, and /poll isn't counted as a request served.  Abandoning
+    jobs writes their number to the file abandoned_path.
+    """
+
+    def __init__(self, abandoned_path):
+        self.abandoned_path = abandoned_path
+        self.served = 0
+        self.jobs = []
+
+    def __call__(self, environ, start_response):
+        if environ['PATH_INFO'] != '/poll':
+            self.served += 1
+        if environ['PATH_INFO'] == '/job':
+            job = threading.Thread(target=time.sleep, args=(float(environ['QUERY_STRING']),))
+            job.daemon = True
+            job.start()
+            self.jobs.append(job)
+        return pid_app(environ, start_response)
+
+    def requests_served(self):
+        return self.served
+
+    def active_jobs(self):
+        return len([job for job in self.jobs if job.is_alive()])
+
+    def abandon_jobs(self):
+        with open(self.abandoned_path, 'w') as f:
+            f.write(str(self.active_jobs()))
+
+
+class StagingCutadaptUtil(CutadaptUtil):
+    """
+    CutadaptUtil whose prestage_libraries() writes a file for each library
+    to staging_dir instead of downloading it, and records the most files
+    there at once in peak.
+    """
+
+    def __init__(self, config, staging_dir):
+        CutadaptUtil.__init__(self, config)
+        self.staging_dir = staging_dir
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def on_scratch(self):
+        with self.lock:
+            staged = len(os.listdir(self.staging_dir))
+            self.peak = max(self.peak, staged)
+            return staged
+
+    def prestage_libraries(self, refs, reads_types, split_paired_end=False):
+        staged = {}
+        for ref in refs:
+            path = os.path.join(self.staging_dir, ref.replace('/', '_') + '.fq')
+            with open(path, 'w') as f:
+                f.write('@r\nACGT\n+\nIIII\n')
+            staged[ref] = {'input_ref': ref, 'files': {'type': 'single', 'fwd': path}}
+        self.on_scratch()
+        return staged
+
+
+def process_exited(pid):
+    try:
+        os.kill(int(pid), 0)
+    except OSError:
+        return True
+    return False
 
 
 class kb_cutadaptTest(unittest.TestCase):
@@ -776,3 +992,1147 @@ class kb_cutadaptTest(unittest.TestCase):
         self.assertEqual(output_reads_info[1],paired_output_name)
         self.assertEqual(output_reads_info[2].split('-')[0],'KBaseFile.PairedEndLibrary')
 
+
+
+    ### TEST 9: run Cutadapt against just one paired end library with an explicit core count
+    #
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_cores_option_PE_Lib")
+    def test_cores_option_PE_Lib(self):
+
+        print ("\n\nRUNNING: test_cores_option_PE_Lib()")
+        print ("===================================\n\n")
+
+        input_libs = ['cutadapt_1']
+        output_name = 'trim5p_cores.PELib'
+
+        pe_lib_info = self.getPairedEndLibInfo(input_libs[0])
+        pe_lib_ref = str(pe_lib_info[6])+'/'+str(pe_lib_info[0])
+
+        p2 = {
+            'input_reads': pe_lib_ref,
+            'output_workspace': self.getWsName(),
+            'output_object_name': output_name,
+            'min_read_length': 50,
+            'discard_untrimmed': 0,
+            'cores': 2,
+            'five_prime': {
+                'adapter_sequence_5P': 'TGCCCTGCAAAAACGTCTGGAAA',
+                'anchored_5P': 1
+            },
+            'three_prime': None
+        }
+
+        ret = self.getImpl().exec_remove_adapters(self.getContext(), p2)
+        pprint(ret)
+
+        # check the output
+        self.assertIn('Cutadapt cores used:', ret[0]['report'])
+        paired_output_name = output_name
+        info_list = self.wsClient.get_object_info([{'ref':pe_lib_info[7] + '/' + paired_output_name}], 1)
+        self.assertEqual(len(info_list),1)
+        output_reads_info = info_list[0]
+        self.assertEqual(output_reads_info[1],paired_output_name)
+        self.assertEqual(output_reads_info[2].split('-')[0],'KBaseFile.PairedEndLibrary')
+
+
+    ### TEST 10: the inprocess and subprocess engines write identical output
+    #
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_engines_identical_output")
+    def test_engines_identical_output(self):
+
+        print ("\n\nRUNNING: test_engines_identical_output()")
+        print ("========================================\n\n")
+
+        scratch = self.cfg['scratch']
+        input_file = os.path.join(scratch, 'engines.interleaved.fastq')
+        shutil.copy(os.path.join('data', 'interleaved.fastq'), input_file)
+
+        outputs = []
+        stats = []
+        for engine in CutadaptRunner.ENGINES:
+            ca = CutadaptRunner(scratch, engine=engine)
+            ca.set_input_file(input_file)
+            output_file = os.path.join(scratch, 'engines.' + engine + '.fq')
+            ca.set_output_file(output_file)
+            ca.set_interleaved(True)
+            ca.set_three_prime_option('ACGTACGTACGT', 0)
+            ca.set_min_read_length(50)
+            ca.set_discard_untrimmed(0)
+            ca.run()
+            stats.append(ca.stats)
+            with open(output_file, 'rb') as f:
+                outputs.append(f.read())
+
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(stats[0], stats[1])
+        self.assertEqual(stats[0]['reads_in'], 2)
+        self.assertIn('ACGTACGTACGT', stats[0]['adapter_matches'])
+
+
+    ### TEST 11: run Cutadapt against just one paired end library streamed from Shock
+    #
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_stream_input_PE_Lib")
+    def test_stream_input_PE_Lib(self):
+
+        print ("\n\nRUNNING: test_stream_input_PE_Lib()")
+        print ("===================================\n\n")
+
+        input_libs = ['cutadapt_1']
+        output_name = 'trim5p_streamed.PELib'
+
+        pe_lib_info = self.getPairedEndLibInfo(input_libs[0])
+        pe_lib_ref = str(pe_lib_info[6])+'/'+str(pe_lib_info[0])
+
+        p2 = {
+            'input_reads': pe_lib_ref,
+            'output_workspace': self.getWsName(),
+            'output_object_name': output_name,
+            'min_read_length': 50,
+            'discard_untrimmed': 0,
+            'stream_input': 1,
+            'five_prime': {
+                'adapter_sequence_5P': 'TGCCCTGCAAAAACGTCTGGAAA',
+                'anchored_5P': 1
+            },
+            'three_prime': None
+        }
+
+        ret = self.getImpl().exec_remove_adapters(self.getContext(), p2)
+        pprint(ret)
+
+        # check the output
+        self.assertEqual(ret[0]['stats']['reads_in'], 2)
+        paired_output_name = output_name
+        info_list = self.wsClient.get_object_info([{'ref':pe_lib_info[7] + '/' + paired_output_name}], 1)
+        self.assertEqual(len(info_list),1)
+        output_reads_info = info_list[0]
+        self.assertEqual(output_reads_info[1],paired_output_name)
+        self.assertEqual(output_reads_info[2].split('-')[0],'KBaseFile.PairedEndLibrary')
+
+
+    ### TEST 12: run Cutadapt against just one paired end library as separate R1/R2 files
+    #
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_split_paired_end_PE_Lib")
+    def test_split_paired_end_PE_Lib(self):
+
+        print ("\n\nRUNNING: test_split_paired_end_PE_Lib()")
+        print ("=======================================\n\n")
+
+        input_libs = ['cutadapt_1']
+        output_name = 'trim5p_split.PELib'
+
+        pe_lib_info = self.getPairedEndLibInfo(input_libs[0])
+        pe_lib_ref = str(pe_lib_info[6])+'/'+str(pe_lib_info[0])
+
+        p2 = {
+            'input_reads': pe_lib_ref,
+            'output_workspace': self.getWsName(),
+            'output_object_name': output_name,
+            'min_read_length': 50,
+            'discard_untrimmed': 0,
+            'split_paired_end': 1,
+            'five_prime': {
+                'adapter_sequence_5P': 'TGCCCTGCAAAAACGTCTGGAAA',
+                'anchored_5P': 1
+            },
+            'three_prime': None
+        }
+
+        ret = self.getImpl().remove_adapters(self.getContext(), p2)
+        pprint(ret)
+
+        # check the output
+        paired_output_name = output_name
+        info_list = self.wsClient.get_object_info([{'ref':pe_lib_info[7] + '/' + paired_output_name}], 1)
+        self.assertEqual(len(info_list),1)
+        output_reads_info = info_list[0]
+        self.assertEqual(output_reads_info[1],paired_output_name)
+        self.assertEqual(output_reads_info[2].split('-')[0],'KBaseFile.PairedEndLibrary')
+
+
+    ### TEST 13: chunked parallel trimming writes the same output as a single run
+    #
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_chunked_identical_output")
+    def test_chunked_identical_output(self):
+
+        print ("\n\nRUNNING: test_chunked_identical_output()")
+        print ("========================================\n\n")
+
+        scratch = self.cfg['scratch']
+        input_file = os.path.join(scratch, 'chunks.interleaved.fastq')
+        with open(os.path.join('data', 'interleaved.fastq'), 'rb') as f:
+            pairs = f.read().rstrip(b'\n') + b'\n'
+        with open(input_file, 'wb') as f:
+            for i in range(50):
+                f.write(pairs)
+
+        outputs = []
+        stats = []
+        for chunks in [1, 4]:
+            ca = CutadaptRunner(scratch)
+            ca.set_input_file(input_file)
+            output_file = os.path.join(scratch, 'chunks.' + str(chunks) + '.fq')
+            ca.set_output_file(output_file)
+            ca.set_interleaved(True)
+            ca.set_three_prime_option('ACGTACGTACGT', 0)
+            ca.set_min_read_length(50)
+            ca.set_discard_untrimmed(0)
+            ca.set_chunking(chunks, 1)
+            report = ca.run()
+            stats.append(ca.stats)
+            with open(output_file, 'rb') as f:
+                outputs.append(f.read())
+
+        self.assertIn('record-aligned chunks', report)
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(stats[0], stats[1])
+        self.assertEqual(stats[0]['reads_in'], 100)
+
+
+    ### TEST 14: run Cutadapt against paired end reads set, libraries in parallel
+    #
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_max_parallel_libraries_PE_ReadsSet")
+    def test_max_parallel_libraries_PE_ReadsSet(self):
+
+        print ("\n\nRUNNING: test_max_parallel_libraries_PE_ReadsSet()")
+        print ("==================================================\n\n")
+
+        input_libs = ['cutadapt_1','cutadapt_2']
+        output_name = 'trim5p_parallel.PERS'
+
+        pe_lib_set_info = self.getPairedEndLib_SetInfo(input_libs)
+        pe_lib_set_ref = str(pe_lib_set_info[6])+'/'+str(pe_lib_set_info[0])
+
+        p14 = {
+            'input_reads': pe_lib_set_ref,
+            'output_workspace': self.getWsName(),
+            'output_object_name': output_name,
+            'min_read_length': 50,
+            'discard_untrimmed': 0,
+            'max_parallel_libraries': 2,
+            'five_prime': {
+                'adapter_sequence_5P': 'TGCCCTGCAAAAACGTCTGGAAA',
+                'anchored_5P': 1
+            },
+            'three_prime': None
+        }
+
+        ret = self.getImpl().exec_remove_adapters(self.getContext(), p14)[0]
+        pprint(ret)
+
+        # members come back in input order
+        self.assertLess(ret['report'].find('test-0.pe.reads'), ret['report'].find('test-1.pe.reads'))
+        self.assertNotIn('FAILED', ret['report'])
+
+        set_obj = self.wsClient.get_objects2({'objects': [{'ref': ret['output_reads_ref']}]})['data'][0]
+        labels = [item['label'] for item in set_obj['data']['items']]
+        self.assertEqual(len(labels), len(input_libs))
+        for label, lib in zip(labels, input_libs):
+            self.assertTrue(label.startswith(lib))
+
+
+    ### TEST 15: run Cutadapt against paired end reads set, download/trim/upload pipelined
+    #
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_pipeline_libraries_PE_ReadsSet")
+    def test_pipeline_libraries_PE_ReadsSet(self):
+
+        print ("\n\nRUNNING: test_pipeline_libraries_PE_ReadsSet()")
+        print ("==============================================\n\n")
+
+        input_libs = ['cutadapt_1','cutadapt_2']
+        output_name = 'trim5p_pipelined.PERS'
+
+        pe_lib_set_info = self.getPairedEndLib_SetInfo(input_libs)
+        pe_lib_set_ref = str(pe_lib_set_info[6])+'/'+str(pe_lib_set_info[0])
+
+        p15 = {
+            'input_reads': pe_lib_set_ref,
+            'output_workspace': self.getWsName(),
+            'output_object_name': output_name,
+            'min_read_length': 50,
+            'discard_untrimmed': 0,
+            'max_parallel_libraries': 1,
+            'pipeline_libraries': 1,
+            'five_prime': {
+                'adapter_sequence_5P': 'TGCCCTGCAAAAACGTCTGGAAA',
+                'anchored_5P': 1
+            },
+            'three_prime': None
+        }
+
+        ret = self.getImpl().exec_remove_adapters(self.getContext(), p15)[0]
+        pprint(ret)
+
+        self.assertNotIn('FAILED', ret['report'])
+        self.assertEqual(ret['stats']['reads_in'], 4)
+
+        set_obj = self.wsClient.get_objects2({'objects': [{'ref': ret['output_reads_ref']}]})['data'][0]
+        labels = [item['label'] for item in set_obj['data']['items']]
+        self.assertEqual(len(labels), len(input_libs))
+        for label, lib in zip(labels, input_libs):
+            self.assertTrue(label.startswith(lib))
+
+        # trimmed files are removed once uploaded
+        for i in range(len(input_libs)):
+            output_file = os.path.join(self.cfg['scratch'], 'test-'+str(i)+'.pe.reads_cutadapt.fq')
+            self.assertFalse(os.path.exists(output_file))
+
+
+    ### TEST 16: a second identical run reuses the result cache
+    #
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_result_cache_PE_Lib")
+    def test_result_cache_PE_Lib(self):
+
+        print ("\n\nRUNNING: test_result_cache_PE_Lib()")
+        print ("===================================\n\n")
+
+        if not self.cfg.get('result-cache-dir'):
+            self.skipTest('result-cache-dir not set in deploy.cfg')
+
+        input_libs = ['cutadapt_1']
+        pe_lib_info = self.getPairedEndLibInfo(input_libs[0])
+        pe_lib_ref = str(pe_lib_info[6])+'/'+str(pe_lib_info[0])
+
+        rets = []
+        for output_name in ['trim_cache_1.PELib', 'trim_cache_2.PELib']:
+            p16 = {
+                'input_reads': pe_lib_ref,
+                'output_workspace': self.getWsName(),
+                'output_object_name': output_name,
+                'min_read_length': 50,
+                'discard_untrimmed': 0,
+                'five_prime': {
+                    'adapter_sequence_5P': 'TGCCCTGCAAAAACGTCTGGAAAGTGTTGG',
+                    'anchored_5P': 1
+                },
+                'three_prime': None
+            }
+            ret = self.getImpl().exec_remove_adapters(self.getContext(), p16)[0]
+            pprint(ret)
+            rets.append(ret)
+
+        self.assertEqual(rets[0]['cache_misses'], 1)
+        self.assertEqual(rets[1]['cache_hits'], 1)
+        self.assertIn('Result cache hit', rets[1]['report'])
+        self.assertEqual(rets[0]['stats'], rets[1]['stats'])
+        self.assertNotEqual(rets[0]['output_reads_ref'], rets[1]['output_reads_ref'])
+
+        info_list = self.wsClient.get_object_info([{'ref':pe_lib_info[7] + '/trim_cache_2.PELib'}], 1)
+        self.assertEqual(info_list[0][2].split('-')[0],'KBaseFile.PairedEndLibrary')
+
+
+    ### TEST 17: the file cache used for downloads and results evicts least recently used entries
+    #
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_file_cache_lru")
+    def test_file_cache_lru(self):
+
+        print ("\n\nRUNNING: test_file_cache_lru()")
+        print ("==============================\n\n")
+
+        scratch = self.cfg['scratch']
+        cache_dir = os.path.join(scratch, 'test_file_cache')
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        cache = FileCache(cache_dir, 250)
+
+        keys = [cache_key('1/2/' + str(i)) for i in range(3)]
+        for i, key in enumerate(keys):
+            path = os.path.join(scratch, 'file_cache_' + str(i) + '.fq')
+            with open(path, 'w') as f:
+                f.write('@' * 100)
+            cache.put(key, {'n': i}, [path], move=True)
+            self.assertFalse(os.path.exists(path))
+            if i == 1:
+                # keeps the first entry more recently used than the second
+                self.assertEqual(cache.get(keys[0])['n'], 0)
+
+        self.assertIsNone(cache.get(keys[1]))
+        for key in [keys[0], keys[2]]:
+            entry = cache.get(key)
+            self.assertEqual(len(entry['files']), 1)
+            with open(entry['files'][0]) as f:
+                self.assertEqual(f.read(), '@' * 100)
+
+
+    ### TEST 18: the libraries of a set are staged with one download_reads call
+    #
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_prestage_libraries_PE_ReadsSet")
+    def test_prestage_libraries_PE_ReadsSet(self):
+
+        print ("\n\nRUNNING: test_prestage_libraries_PE_ReadsSet()")
+        print ("===============================================\n\n")
+
+        input_libs = ['cutadapt_1','cutadapt_2']
+        refs = []
+        for lib_i, lib in enumerate(input_libs):
+            lib_info = self.getPairedEndLibInfo(lib, lib_i)
+            refs.append(str(lib_info[6])+'/'+str(lib_info[0]))
+
+        cutadapt = CutadaptUtil(self.cfg, token=self.getContext()['token'])
+        staged = cutadapt.prestage_libraries(refs, ['KBaseFile.PairedEndLibrary'] * len(refs))
+        pprint(staged)
+
+        self.assertEqual(sorted(staged.keys()), sorted(refs))
+        for ref in refs:
+            self.assertEqual(staged[ref]['files']['type'], 'interleaved')
+            self.assertTrue(os.path.isfile(staged[ref]['files']['fwd']))
+            os.remove(staged[ref]['files']['fwd'])
+
+
+    ### TEST 19: callback jobs are polled together, noticing short jobs quickly at a bounded rate
+    #
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_job_poller_stub_callback")
+    def test_job_poller_stub_callback(self):
+
+        print ("\n\nRUNNING: test_job_poller_stub_callback()")
+        print ("=========================================\n\n")
+
+        server = StubCallbackServer()
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        ClientTransport.configure_job_poller(max_checks_per_second=40, max_interval=0.5)
+        try:
+            client = ClientTransport.PooledClient(server.url, token='token',
+                                                  async_job_check_time_ms=50)
+            seconds = [0.1, 2.0] * 10
+            start = time.time()
+            futures = submit_jobs(client, [('ReadsUtils.download_reads', [{'seconds': s}])
+                                           for s in seconds])
+
+            # the short jobs are noticed soon after they finish, despite the long ones
+            for future in futures[0::2]:
+                self.assertEqual(future.result(timeout=30), {'seconds': 0.1})
+            self.assertLess(time.time() - start, 1.5)
+
+            for future, s in zip(futures, seconds):
+                self.assertEqual(future.result(timeout=30), {'seconds': s})
+            elapsed = time.time() - start
+            self.assertLess(elapsed, 4)
+            # one scheduler loop keeps all the jobs under the rate cap
+            self.assertLessEqual(server.checks, 40 * elapsed + 1)
+
+            self.assertEqual(client.run_job('ReadsUtils.download_reads', [{'seconds': 0}]),
+                             {'seconds': 0})
+            # a rate the poller can't keep is refused, and the old one kept
+            for rate in [0, -1]:
+                with self.assertRaises(ValueError):
+                    ClientTransport.configure_job_poller(max_checks_per_second=rate)
+            self.assertEqual(client.run_job('ReadsUtils.download_reads', [{'seconds': 0}]),
+                             {'seconds': 0})
+        finally:
+            ClientTransport.configure_job_poller(max_checks_per_second=20, max_interval=30)
+            server.shutdown()
+
+
+    ### TEST 20: the async client facades fan out many calls from one thread
+    #
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_async_clients_stub_callback")
+    def test_async_clients_stub_callback(self):
+
+        print ("\n\nRUNNING: test_async_clients_stub_callback()")
+        print ("===========================================\n\n")
+
+        server = StubCallbackServer()
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            ws = Workspace(server.url, token='token')
+            async_ws = AsyncWorkspace(ws)
+            start = time.time()
+            futures = [async_ws.get_object_info3({'seconds': 0.2, 'i': i}) for i in range(100)]
+            for i, future in enumerate(futures):
+                self.assertEqual(future.result(timeout=60), {'seconds': 0.2, 'i': i})
+            # one at a time this would take 20 s
+            self.assertLess(time.time() - start, 10)
+
+            # the sync client goes through the same code
+            self.assertEqual(ws.get_object_info3({'seconds': 0, 'i': 0}), {'seconds': 0, 'i': 0})
+
+            ru = AsyncReadsUtils(ClientTransport.pooled(
+                ReadsUtils(server.url, token='token', async_job_check_time_ms=50)))
+            futures = [ru.download_reads({'seconds': 0.1}) for _ in range(10)]
+            for future in futures:
+                self.assertEqual(future.result(timeout=30), {'seconds': 0.1})
+                self.assertIsNotNone(future.job_id)
+        finally:
+            server.shutdown()
+
+
+    ### TEST 21: dynamic service urls are looked up once per ttl, and again after a connection error
+    #
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_service_url_cache_stub_wizard")
+    def test_service_url_cache_stub_wizard(self):
+
+        print ("\n\nRUNNING: test_service_url_cache_stub_wizard()")
+        print ("=============================================\n\n")
+
+        server = StubCallbackServer()
+        server.lookup_seconds = 0.2
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        ClientTransport.configure_service_url_cache(ttl=60)
+        try:
+            setAPI = ClientTransport.pooled(SetAPI(url=server.url, token='token'))
+            # concurrent calls share the one lookup
+            futures = [AsyncSetAPI(setAPI).get_reads_set_v1({'seconds': 0, 'i': i})
+                       for i in range(20)]
+            for i, future in enumerate(futures):
+                self.assertEqual(future.result(timeout=30), {'seconds': 0, 'i': i})
+            self.assertEqual(setAPI.get_reads_set_v1({'seconds': 0}), {'seconds': 0})
+            self.assertEqual(server.lookups, 1)
+
+            # a url that can't be connected to is looked up again
+            ClientTransport.configure_service_url_cache(ttl=60)
+            server.lookup_url = 'http://127.0.0.1:1'
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                setAPI.get_reads_set_v1({'seconds': 0})
+            server.lookup_url = server.url
+            self.assertEqual(setAPI.get_reads_set_v1({'seconds': 0}), {'seconds': 0})
+            self.assertEqual(server.lookups, 3)
+
+            # and so is one past its ttl
+            ClientTransport.configure_service_url_cache(ttl=0.5)
+            setAPI.get_reads_set_v1({'seconds': 0})
+            time.sleep(1)
+            setAPI.get_reads_set_v1({'seconds': 0})
+            self.assertEqual(server.lookups, 5)
+        finally:
+            ClientTransport.configure_service_url_cache(ttl=300)
+            server.shutdown()
+
+
+    ### TEST 22: concurrent checks of a token share one validation, and rejected tokens are cached briefly
+    #
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_auth_token_cache_stub_auth")
+    def test_auth_token_cache_stub_auth(self):
+
+        print ("\n\nRUNNING: test_auth_token_cache_stub_auth()")
+        print ("==========================================\n\n")
+
+        server = StubAuthServer()
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            auth = CachingKBaseAuth(server.url)
+            users = []
+            threads = [threading.Thread(target=lambda: users.append(auth.get_user('good')))
+                       for _ in range(20)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(users, ['user_good'] * 20)
+            self.assertEqual(auth.get_user('good'), 'user_good')
+            self.assertEqual(server.validations, 1)
+
+            for _ in range(3):
+                with self.assertRaisesRegexp(ValueError, 'invalid token'):
+                    auth.get_user('bad')
+            self.assertEqual(server.validations, 2)
+        finally:
+            server.shutdown()
+
+        cache = TokenCache(maxsize=2)
+        cache.add_valid_token('a', 'user_a')
+        cache.add_valid_token('b', 'user_b')
+        self.assertEqual(cache.get_user('a'), 'user_a')
+        # b is now the least recently used
+        cache.add_valid_token('c', 'user_c')
+        self.assertIsNone(cache.get_user('b'))
+        self.assertEqual(cache.get_user('a'), 'user_a')
+        self.assertEqual(cache.get_user('c'), 'user_c')
+
+
+    ### TEST 23: trimming calls run as jobs that can be checked and canceled
+    #
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_job_table")
+    def test_job_table(self):
+
+        print ("\n\nRUNNING: test_job_table()")
+        print ("=========================\n\n")
+
+        state_dir = os.path.join(self.cfg['scratch'], 'test_job_table')
+        shutil.rmtree(state_dir, ignore_errors=True)
+        jobs = JobTable(state_dir, workers=2)
+        ctx = {'user_id': 'user_a'}
+
+        def trim(ctx, params):
+            time.sleep(params['seconds'])
+            if params.get('fail'):
+                raise ValueError('trimming failed')
+            return [{'i': params['i']}]
+
+        job_ids = [jobs.submit('trim', trim, ctx, [{'seconds': 0.05, 'i': i}]) for i in range(20)]
+        failed = jobs.submit('trim', trim, ctx, [{'seconds': 0, 'i': 20, 'fail': 1}])
+        # both workers are busy with the long jobs when the last one is canceled
+        slow = [jobs.submit('trim', trim, ctx, [{'seconds': 1, 'i': i}]) for i in range(2)]
+        canceled = jobs.submit('trim', trim, ctx, [{'seconds': 0, 'i': 23}])
+        self.assertEqual(jobs.check(canceled, ctx)['finished'], 0)
+        self.assertEqual(jobs.cancel(canceled, ctx)['status'], 'canceled')
+
+        deadline = time.time() + 30
+        while (time.time() < deadline and
+               not all(jobs.check(j, ctx)['finished'] for j in job_ids + [failed] + slow)):
+            time.sleep(0.1)
+        for i, job_id in enumerate(job_ids):
+            self.assertEqual(jobs.check(job_id, ctx)['result'], [{'i': i}])
+        self.assertIn('trimming failed', jobs.check(failed, ctx)['error']['message'])
+        state = jobs.check(canceled, ctx)
+        self.assertEqual((state['finished'], state['status']), (1, 'canceled'))
+        self.assertNotIn('result', state)
+
+        # job state is kept on disk, and only the submitter may see it
+        self.assertEqual(JobTable(state_dir).check(job_ids[0], ctx)['result'], [{'i': 0}])
+        with self.assertRaises(ValueError):
+            jobs.check(job_ids[0], {'user_id': 'user_b'})
+        with self.assertRaises(ValueError):
+            jobs.check('../' + job_ids[0], ctx)
+
+        # abandoned jobs fail, and old job states are removed; a job ends a
+        # little after its state is saved, and the canceled one once it's dequeued
+        deadline = time.time() + 10
+        while jobs.active() and time.time() < deadline:
+            time.sleep(0.1)
+        self.assertEqual(jobs.active(), 0)
+        left = jobs.submit('trim', trim, ctx, [{'seconds': 1, 'i': 24}])
+        self.assertEqual(jobs.active(), 1)
+        self.assertEqual(jobs.abandon(), 1)
+        self.assertIn('server stopped', jobs.check(left, ctx)['error']['message'])
+        while jobs.active():
+            time.sleep(0.1)
+        self.assertIn('server stopped', jobs.check(left, ctx)['error']['message'])
+        self.assertEqual(JobTable(state_dir).prune(), 0)
+        self.assertEqual(JobTable(state_dir, keep_hours=0).prune(), len(job_ids) + 5)
+        with self.assertRaises(ValueError):
+            jobs.check(job_ids[0], ctx)
+
+
+    ### TEST 24: a JSON-RPC batch returns every call's result or error, in order
+    #
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_batch_calls")
+    def test_batch_calls(self):
+
+        print ("\n\nRUNNING: test_batch_calls()")
+        print ("=========================\n\n")
+
+        port = MultiWorkerServer.start_server(newprocess=True, workers=1, threads=2)
+        url = 'http://localhost:' + str(port)
+        try:
+            client = kb_cutadaptClient(url)
+            results = ClientTransport.call_batch(client, [
+                ('status', None),
+                # the trimming methods need a token
+                ('exec_remove_adapters_OneLibrary', {}),
+                ('no_such_method', None),
+                ('status', None),
+                ('_check_job', 'job_id')])
+            self.assertEqual(len(results), 5)
+            self.assertEqual(results[0][0]['state'], 'OK')
+            self.assertIsNone(results[0][1])
+            self.assertIsNone(results[1][0])
+            self.assertIn('Authentication required', results[1][1].message)
+            self.assertEqual(results[2][1].code, -32601)
+            self.assertEqual(results[3], results[0])
+            # the job methods are served too
+            self.assertIn('Authentication required', results[4][1].message)
+            self.assertEqual(ClientTransport.call_batch(client, []), [])
+
+            # elements that aren't method calls fail on their own
+            ret = requests.post(url, data=json.dumps(
+                [{'version': '1.1', 'id': 'a', 'method': 'kb_cutadapt.status', 'params': []},
+                 {'version': '1.1', 'id': 'b'},
+                 42]))
+            self.assertEqual(ret.status_code, 200)
+            resp = ret.json()
+            self.assertEqual([r.get('id') for r in resp], ['a', 'b', None])
+            self.assertEqual(resp[0]['result'][0]['state'], 'OK')
+            self.assertEqual([r['error']['code'] for r in resp[1:]], [-32600, -32600])
+            self.assertEqual(requests.post(url, data='[]').json()['error']['code'], -32600)
+            # other requests go to the generated application as they are
+            self.assertEqual(client.status()['state'], 'OK')
+        finally:
+            MultiWorkerServer.stop_server()
+
+
+    ### TEST 25: compressed output decompresses to the plain output, also when trimmed in chunks
+    #
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_output_compression")
+    def test_output_compression(self):
+
+        print ("\n\nRUNNING: test_output_compression()")
+        print ("===================================\n\n")
+
+        scratch = self.cfg['scratch']
+        input_file = os.path.join(scratch, 'compression.interleaved.fastq')
+        with open(os.path.join('data', 'interleaved.fastq'), 'rb') as f:
+            pairs = f.read().rstrip(b'\n') + b'\n'
+        with open(input_file, 'wb') as f:
+            for i in range(500):
+                f.write(pairs)
+
+        def trim(compression, chunks=1):
+            ca = CutadaptRunner(scratch)
+            ca.set_input_file(input_file)
+            output_file = os.path.join(scratch, 'compression.' + compression + str(chunks) +
+                                       '.fq' + OutputCompression.SUFFIXES[compression])
+            ca.set_output_file(output_file)
+            ca.set_interleaved(True)
+            ca.set_three_prime_option('ACGTACGTACGT', 0)
+            ca.set_discard_untrimmed(0)
+            ca.set_chunking(chunks, 1)
+            ca.set_output_compression(compression, threads=2)
+            report = ca.run()
+            if compression == 'gzip':
+                with gzip.open(output_file, 'rb') as f:
+                    output = f.read()
+            elif compression == 'zstd':
+                output = subprocess.check_output(['zstd', '-d', '-c', '-q', output_file])
+            else:
+                with open(output_file, 'rb') as f:
+                    output = f.read()
+            return output, ca, report
+
+        plain, _, _ = trim('none')
+        compressions = [('gzip', 1), ('gzip', 4)]
+        if find_executable('zstd'):
+            compressions.append(('zstd', 1))
+        for compression, chunks in compressions:
+            output, ca, report = trim(compression, chunks)
+            self.assertEqual(output, plain)
+            self.assertEqual(ca.compression_stats['bytes_in'], len(plain))
+            self.assertLess(ca.compression_stats['bytes_out'], len(plain))
+            self.assertIn('Output compressed with', report)
+
+        # a failed run doesn't leave the compressor waiting on its FIFO
+        ca = CutadaptRunner(scratch)
+        ca.set_input_file(os.path.join(scratch, 'compression.missing.fastq'))
+        ca.set_output_file(os.path.join(scratch, 'compression.missing.fq.gz'))
+        ca.set_three_prime_option('ACGTACGTACGT', 0)
+        ca.set_discard_untrimmed(0)
+        ca.set_output_compression('gzip')
+        with self.assertRaises(ValueError):
+            ca.run()
+        with self.assertRaises(ValueError):
+            ca.set_output_compression('gzip', level=12)
+
+
+    ### TEST 26: run Cutadapt against a paired end library fetched from Shock as stored
+    #
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_compressed_input_PE_Lib")
+    def test_compressed_input_PE_Lib(self):
+
+        print ("\n\nRUNNING: test_compressed_input_PE_Lib()")
+        print ("=======================================\n\n")
+
+        input_libs = ['cutadapt_1']
+        output_name = 'trim5p_compressed_input.PELib'
+
+        pe_lib_info = self.getPairedEndLibInfo(input_libs[0])
+        pe_lib_ref = str(pe_lib_info[6])+'/'+str(pe_lib_info[0])
+
+        p2 = {
+            'input_reads': pe_lib_ref,
+            'output_workspace': self.getWsName(),
+            'output_object_name': output_name,
+            'min_read_length': 50,
+            'discard_untrimmed': 0,
+            'compressed_input': 1,
+            'five_prime': {
+                'adapter_sequence_5P': 'TGCCCTGCAAAAACGTCTGGAAA',
+                'anchored_5P': 1
+            },
+            'three_prime': None
+        }
+
+        ret = self.getImpl().exec_remove_adapters(self.getContext(), p2)
+        pprint(ret)
+
+        # check the output
+        self.assertEqual(ret[0]['stats']['reads_in'], 2)
+        info_list = self.wsClient.get_object_info([{'ref':pe_lib_info[7] + '/' + output_name}], 1)
+        self.assertEqual(len(info_list),1)
+        output_reads_info = info_list[0]
+        self.assertEqual(output_reads_info[1],output_name)
+        self.assertEqual(output_reads_info[2].split('-')[0],'KBaseFile.PairedEndLibrary')
+
+
+    ### TEST 27: known adapters are detected in the reads and trimmed when none is given
+    #
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_auto_detect")
+    def test_auto_detect(self):
+
+        print ("\n\nRUNNING: test_auto_detect()")
+        print ("===========================\n\n")
+
+        scratch = self.cfg['scratch']
+        rnd = random.Random(1)
+
+        def write_reads(path, adapter):
+            with gzip.open(path, 'wb') as f:
+                for i in range(2000):
+                    insert = ''.join(rnd.choice('ACGT') for _ in range(rnd.randint(30, 80)))
+                    seq = (insert + adapter + 'ACGTACGTACGTACGTACGT')[:100]
+                    f.write('@read%d\n%s\n+\n%s\n' % (i, seq, 'I' * len(seq)))
+
+        truseq = os.path.join(scratch, 'auto_detect.truseq.fq.gz')
+        write_reads(truseq, 'AGATCGGAAGAGCACACGTCTGAACTCCAGTCAC')
+        detected = AdapterDetector(1000).detect([truseq])
+        pprint(detected)
+        self.assertEqual(detected['reads'], 1000)
+        self.assertEqual(detected['three_prime'][0], 'Illumina TruSeq')
+        self.assertGreater(detected['three_prime'][2], 900)
+        self.assertIsNone(detected['five_prime'])
+
+        # only the ends left unset are filled in
+        cutadapt = CutadaptUtil(self.cfg, token=self.getContext()['token'])
+        ca = CutadaptRunner(scratch)
+        ca.set_input_file(truseq)
+        ca.set_output_file(os.path.join(scratch, 'auto_detect.trimmed.fq'))
+        ca.set_five_prime_option('GTTCAGAGTTCTACAGTCCGACGATC', 0)
+        ca.set_discard_untrimmed(0)
+        report = cutadapt._detect_adapters(ca)
+        self.assertIn('Detected 3\' adapter: Illumina TruSeq', report)
+        self.assertEqual(ca.three_prime, ['AGATCGGAAGAGC'])
+        self.assertEqual(ca.five_prime, ['GTTCAGAGTTCTACAGTCCGACGATC'])
+        ca.run()
+        self.assertEqual(ca.stats['reads_in'], 2000)
+        self.assertGreater(ca.stats['reads_with_adapters'], 1900)
+
+        # reads without known adapters need one given
+        plain = os.path.join(scratch, 'auto_detect.plain.fq.gz')
+        write_reads(plain, '')
+        ca = CutadaptRunner(scratch)
+        ca.set_input_file(plain)
+        with self.assertRaisesRegexp(ValueError, 'none of the known adapters'):
+            cutadapt._detect_adapters(ca)
+
+
+    ### TEST 28: several adapters per end are trimmed in one cutadapt pass
+    #
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_multiple_adapters")
+    def test_multiple_adapters(self):
+
+        print ("\n\nRUNNING: test_multiple_adapters()")
+        print ("=================================\n\n")
+
+        scratch = self.cfg['scratch']
+        adapters = ['AGATCGGAAGAGCACACGTC', 'CTGTCTCTTATACACATCTC', 'TGGAATTCTCGGGTGCCAAG']
+        rnd = random.Random(2)
+        input_file = os.path.join(scratch, 'multiple_adapters.fq')
+        with open(input_file, 'w') as f:
+            for i in range(3000):
+                insert = ''.join(rnd.choice('ACGT') for _ in range(50))
+                seq = insert + adapters[i % 3] + 'ACGTACGTAC'
+                f.write('@read%d\n%s\n+\n%s\n' % (i, seq, 'I' * len(seq)))
+
+        cutadapt = CutadaptUtil(self.cfg, token=self.getContext()['token'])
+        params = {'three_prime': {'adapter_sequence_3P': adapters[0],
+                                  'adapter_sequences_3P': [adapters[1]],
+                                  'adapter_fasta_3P': '>small_rna\n' + adapters[2][:10] +
+                                                      '\n' + adapters[2][10:] + '\n',
+                                  'anchored_3P': 0},
+                  'discard_untrimmed': 1,
+                  # plain FASTQ output, whatever the deploy.cfg default
+                  'output_compression': 'none'}
+        self.assertEqual(cutadapt._adapter_sequences(params['three_prime'], '3P'), adapters)
+
+        for chunks in [1, 3]:
+            ca = CutadaptRunner(scratch)
+            ca.set_input_file(input_file)
+            ca.set_output_file(os.path.join(scratch, 'multiple_adapters.' + str(chunks) + '.fq'))
+            cutadapt._build_run(ca, params)
+            ca.set_chunking(chunks, 1)
+            self.assertEqual(ca.three_prime, adapters)
+            report = ca.run()
+            self.assertIn('file:', report)
+            self.assertEqual(ca.stats['reads_in'], 3000)
+            self.assertEqual(ca.stats['reads_with_adapters'], 3000)
+            self.assertEqual(ca.stats['reads_written'], 3000)
+            self.assertEqual(sorted(ca.stats['adapter_matches'].values()), [1000, 1000, 1000])
+            with open(ca.output_filename) as f:
+                lengths = set(len(line.strip()) for i, line in enumerate(f) if i % 4 == 1)
+            self.assertEqual(lengths, set([50]))
+            # the compiled adapter file only lives for the run
+            self.assertEqual([d for d in os.listdir(scratch)
+                              if d.startswith('cutadapt_adapters_')], [])
+
+        ca = CutadaptRunner(scratch)
+        for barcode in ['ACGTAC', 'TGCATG', 'ACGTAC']:
+            ca.add_five_prime_option(barcode, 1)
+        self.assertEqual(ca.five_prime, ['^ACGTAC', '^TGCATG'])
+        with self.assertRaisesRegexp(ValueError, 'no FASTA records'):
+            cutadapt._adapter_sequences({'adapter_fasta_5P': '\n'}, '5P')
+
+
+    ### TEST 29: quality, NextSeq, poly-A, N and length trimming run in the adapter pass
+    #
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_single_pass_trimming")
+    def test_single_pass_trimming(self):
+
+        print ("\n\nRUNNING: test_single_pass_trimming()")
+        print ("====================================\n\n")
+
+        scratch = self.cfg['scratch']
+        adapter = 'AGATCGGAAGAGCACACGTC'
+        rnd = random.Random(3)
+
+        def insert(length):
+            # no A or G, so only the intended trimming applies
+            return ''.join(rnd.choice('CT') for _ in range(length))
+
+        reads = []
+        for i in range(100):
+            reads.append((insert(50) + adapter + 'CTCT', None))
+            reads.append((insert(40) + 'A' * 20 + adapter, None))
+            reads.append((insert(50), 'I' * 40 + '#' * 10))
+            reads.append((insert(40) + 'G' * 20, None))
+            seq = insert(40)
+            reads.append((seq[:10] + 'N' * 10 + seq[20:], None))
+            reads.append((insert(150), None))
+        input_file = os.path.join(scratch, 'single_pass.fq')
+        with open(input_file, 'w') as f:
+            for i, (seq, qual) in enumerate(reads):
+                f.write('@read%d\n%s\n+\n%s\n' % (i, seq, qual or 'I' * len(seq)))
+
+        cutadapt = CutadaptUtil(self.cfg, token=self.getContext()['token'])
+        params = {'input_reads': 'ws/1', 'output_workspace': 'ws', 'output_object_name': 'o',
+                  'three_prime': {'adapter_sequence_3P': adapter, 'anchored_3P': 0},
+                  'discard_untrimmed': 0,
+                  'quality_cutoff_3P': 20,
+                  'nextseq_trim': 20,
+                  'max_n': 5,
+                  'max_read_length': 100,
+                  'trim_poly_a': 1,
+                  # plain FASTQ output, whatever the deploy.cfg default
+                  'output_compression': 'none'}
+        cutadapt.validate_remove_adapters_parameters(params)
+
+        ca = CutadaptRunner(scratch)
+        ca.set_input_file(input_file)
+        ca.set_output_file(os.path.join(scratch, 'single_pass.trimmed.fq'))
+        cutadapt._build_run(ca, params)
+        report = ca.run()
+        self.assertEqual(report.count('This is cutadapt'), 1)
+        self.assertEqual(ca.stats['reads_in'], 600)
+        self.assertEqual(ca.stats['reads_too_many_n'], 100)
+        self.assertEqual(ca.stats['reads_too_long'], 100)
+        self.assertEqual(ca.stats['reads_written'], 400)
+        with open(ca.output_filename) as f:
+            lengths = [len(line.strip()) for i, line in enumerate(f) if i % 4 == 1]
+        self.assertEqual(sorted(set(lengths)), [40, 50])
+        self.assertEqual(lengths.count(50), 100)
+
+        # the second reads of pairs get their poly-T heads trimmed
+        ca.set_interleaved(True)
+        cmd = []
+        ca._build_adapter_removal_options(cmd)
+        self.assertIn('T{100}', cmd)
+        self.assertIn('--times=2', cmd)
+
+        with self.assertRaisesRegexp(ValueError, 'quality_base'):
+            cutadapt.validate_remove_adapters_parameters(dict(params, quality_base=50))
+        # quality trimming alone needs no adapter
+        cutadapt.validate_remove_adapters_parameters(
+            dict(params, three_prime=None, trim_poly_a=0))
+
+
+    ### TEST 30: a multi-worker server's worker serves requests and is replaced after max_requests
+    #
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_multi_worker_recycling")
+    def test_multi_worker_recycling(self):
+
+        print ("\n\nRUNNING: test_multi_worker_recycling()")
+        print ("======================================\n\n")
+
+        port = MultiWorkerServer.start_server(newprocess=True, workers=1, threads=2,
+                                              max_requests=3, app=pid_app)
+        url = 'http://localhost:' + str(port)
+        try:
+            pids = [requests.get(url, timeout=30).text for _ in range(7)]
+        finally:
+            MultiWorkerServer.stop_server()
+        self.assertEqual(len(set(pids[0:3])), 1)
+        self.assertEqual(len(set(pids[3:6])), 1)
+        self.assertNotEqual(pids[3], pids[0])
+        self.assertNotIn(pids[6], pids[0:6])
+        self.assertNotIn(str(os.getpid()), pids)
+
+
+    ### TEST 31: workers with jobs left drain instead of dying, and status polls don't recycle them
+    #
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_multi_worker_draining")
+    def test_multi_worker_draining(self):
+
+        print ("\n\nRUNNING: test_multi_worker_draining()")
+        print ("=====================================\n\n")
+
+        abandoned_path = os.path.join(self.cfg['scratch'], 'test_multi_worker_draining')
+        if os.path.exists(abandoned_path):
+            os.remove(abandoned_path)
+        app = JobsApp(abandoned_path)
+        port = MultiWorkerServer.start_server(newprocess=True, workers=1, threads=2,
+                                              max_requests=2, app=app)
+        url = 'http://localhost:' + str(port)
+        try:
+            first = requests.get(url + '/job?3', timeout=30).text
+            polls = [requests.get(url + '/poll', timeout=30).text for _ in range(5)]
+            self.assertEqual(set(polls), set([first]))
+            self.assertEqual(requests.get(url, timeout=30).text, first)
+            # a new worker takes requests while the old one finishes its job
+            start = time.time()
+            second = requests.get(url, timeout=30).text
+            self.assertNotEqual(second, first)
+            self.assertLess(time.time() - start, 2)
+            self.assertFalse(process_exited(first))
+            deadline = time.time() + 30
+            while not process_exited(first) and time.time() < deadline:
+                time.sleep(0.1)
+            self.assertTrue(process_exited(first))
+            self.assertFalse(os.path.exists(abandoned_path))
+        finally:
+            MultiWorkerServer.stop_server()
+
+        # on shutdown a worker waits shutdown_timeout for its jobs, then abandons them
+        port = MultiWorkerServer.start_server(newprocess=True, workers=1, threads=2,
+                                              shutdown_timeout=0.5, app=app)
+        url = 'http://localhost:' + str(port)
+        requests.get(url + '/job?60', timeout=30)
+        start = time.time()
+        MultiWorkerServer.stop_server()
+        self.assertLess(time.time() - start, 15)
+        with open(abandoned_path) as f:
+            self.assertEqual(f.read(), '1')
+
+        # the kb_cutadapt application doesn't count status polls
+        extended = ServerExtensions.ExtendedApplication(kb_cutadaptServer.application)
+
+        def call(body):
+            environ = {'REQUEST_METHOD': 'POST', 'CONTENT_LENGTH': str(len(body)),
+                       'wsgi.input': StringIO(body), 'REMOTE_ADDR': '127.0.0.1'}
+            return json.loads(''.join(extended(environ, lambda status, headers: None)))
+        status = {'version': '1.1', 'id': '1', 'method': 'kb_cutadapt.status', 'params': []}
+        self.assertEqual(call(json.dumps(status))['result'][0]['state'], 'OK')
+        self.assertEqual(len(call(json.dumps([status, status]))), 2)
+        self.assertEqual(extended.requests_served(), 0)
+        call(json.dumps(dict(status, method='kb_cutadapt.no_such_method')))
+        call(json.dumps([status, dict(status, method='kb_cutadapt.no_such_method')]))
+        self.assertEqual(extended.requests_served(), 2)
+
+
+    ### TEST 32: libraries downloaded ahead in batches count towards the pipeline's cap on staged libraries
+    #
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_batch_stager_staged_cap")
+    def test_batch_stager_staged_cap(self):
+
+        print ("\n\nRUNNING: test_batch_stager_staged_cap()")
+        print ("=======================================\n\n")
+
+        staging_dir = os.path.join(self.cfg['scratch'], 'test_batch_stager_staged_cap')
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        os.makedirs(staging_dir)
+        cutadapt = StagingCutadaptUtil(self.cfg, staging_dir)
+        refs = ['1/' + str(i) + '/1' for i in range(9)]
+        stager = BatchStager(cutadapt, refs, ['KBaseFile.SingleEndLibrary'] * len(refs),
+                             batch_size=3)
+
+        def stage(i):
+            prestaged = stager.get(i, pipeline.slots)
+            params = {'input_reads': refs[i], 'reads_type': 'KBaseFile.SingleEndLibrary',
+                      'output_workspace': 'ws',
+                      'three_prime': {'adapter_sequence_3P': 'AGATCGGAAGAGC'}}
+            if i != 4:
+                params['output_object_name'] = 'trimmed_' + str(i)
+            # fails validation for library 4, whose staged file is removed
+            return cutadapt.stage_library(params, prestaged=prestaged)
+
+        def trim(job):
+            cutadapt.on_scratch()
+            time.sleep(0.1)
+            cutadapt.cleanup_library(job)
+            return job['params']['input_reads']
+
+        pipeline = LibraryPipeline([('download', stage, 1),
+                                    ('trim', trim, 2),
+                                    ('upload', lambda ref: ref, 1)], 3)
+        results = pipeline.run(range(len(refs)))
+        self.assertEqual([r for r, _ in results], refs[:4] + [None] + refs[5:])
+        self.assertIn('"output_object_name" parameter is required', results[4][1])
+        self.assertLessEqual(cutadapt.peak, 3)
+        self.assertEqual(os.listdir(staging_dir), [])
+
+        # libraries staged by a batch but never asked for are removed at the end
+        stager = BatchStager(cutadapt, refs, ['KBaseFile.SingleEndLibrary'] * len(refs),
+                             batch_size=3)
+        self.assertEqual(stager.get(0)['input_ref'], refs[0])
+        self.assertEqual(len(os.listdir(staging_dir)), 3)
+        stager.cleanup()
+        self.assertEqual(sorted(os.listdir(staging_dir)), [refs[0].replace('/', '_') + '.fq'])
+
+
+    ### TEST 33: a request's clients are created once and shared, ReadsUtils jobs included
+    #
+    # Uncomment to skip this test
+    # @unittest.skip("skipped test_client_registry_stub_callback")
+    def test_client_registry_stub_callback(self):
+
+        print ("\n\nRUNNING: test_client_registry_stub_callback()")
+        print ("=============================================\n\n")
+
+        server = StubCallbackServer()
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            config = dict(self.cfg, SDK_CALLBACK_URL=server.url)
+            config.update({'workspace-url': server.url, 'service-wizard-url': server.url})
+            registry = ClientRegistry(config, 'token')
+            reads_utils = []
+            threads = [threading.Thread(target=lambda: reads_utils.append(registry.reads_utils()))
+                       for _ in range(10)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(len(set(id(client) for client in reads_utils)), 1)
+            self.assertIs(registry.reads_utils(), reads_utils[0])
+            self.assertIs(registry.workspace(), registry.workspace())
+            self.assertIs(registry.set_api(), registry.set_api())
+            self.assertIs(registry.report(), registry.report('release'))
+            self.assertIsInstance(reads_utils[0]._client, ClientTransport.PooledClient)
+            self.assertEqual(reads_utils[0]._client._headers['AUTHORIZATION'], 'token')
+
+            # the libraries' ReadsUtils jobs go through the registry's client
+            cutadapt = CutadaptUtil(config, token='token', clients=registry)
+            self.assertEqual(cutadapt._reads_utils('download_reads', {'seconds': 0.1}),
+                             {'seconds': 0.1})
+            self.assertIs(cutadapt.clients.reads_utils(), reads_utils[0])
+            self.assertEqual(len(server.jobs), 1)
+        finally:
+            server.shutdown()